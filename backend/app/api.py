@@ -5,17 +5,16 @@ from pydantic import BaseModel
 from sse_starlette.sse import EventSourceResponse
 from app.db import get_redis, create_chat, chat_exists
 from app.assistants.assistant import RAGAssistant
+from app.turns import TurnLimitExceeded, ShuttingDown
 
 class ChatIn(BaseModel):
     message: str
 
-# Get Redis db dependency
-async def get_rdb():
-    rdb = get_redis()
-    try:
-        yield rdb
-    finally:
-        await rdb.aclose()
+# Get Redis db dependency. Clients use the shared connection pool created in the app lifespan,
+# so there is nothing to close at the end of the request (connections go back to the pool
+# after each command), which also makes it safe to use with streaming responses
+def get_rdb():
+    return get_redis()
 
 router = APIRouter()
 
@@ -27,13 +26,15 @@ async def create_new_chat(rdb = Depends(get_rdb)):
     return {'id': chat_id}
 
 @router.post('/chats/{chat_id}')
-async def chat(chat_id: str, chat_in: ChatIn):
-    # Dependencies with yield don't work with Streaming responses after version 0.106
-    # So we are closing the Redis db connection with a background task
-    # See issue: https://github.com/fastapi/fastapi/issues/11143
-    rdb = get_redis()
+async def chat(chat_id: str, chat_in: ChatIn, rdb = Depends(get_rdb)):
     if not await chat_exists(rdb, chat_id):
         raise HTTPException(status_code=404, detail=f'Chat {chat_id} does not exist')
     assistant = RAGAssistant(chat_id=chat_id, rdb=rdb)
-    sse_stream = assistant.run(message=chat_in.message)
-    return EventSourceResponse(sse_stream, background=rdb.aclose)
\ No newline at end of file
+    try:
+        sse_stream = assistant.run(message=chat_in.message)
+    except TurnLimitExceeded:
+        raise HTTPException(status_code=429, detail='Too many conversations in progress, try again later',
+                            headers={'Retry-After': '1'})
+    except ShuttingDown:
+        raise HTTPException(status_code=503, detail='The server is shutting down')
+    return EventSourceResponse(sse_stream)
\ No newline at end of file
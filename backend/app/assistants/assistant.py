@@ -1,11 +1,13 @@
 import asyncio
-from openai import pydantic_function_tool
 from time import time
-from app.openaiutils import chat_stream
-from app.db import get_chat_messages, add_chat_messages
-from app.assistants.tools import QueryKnowledgeBaseTool
-from app.assistants.prompts import MAIN_SYSTEM_PROMPT, RAG_SYSTEM_PROMPT
-from app.utils.sse_stream import SSEStream
+from app.openaiutils import chat_stream, get_embedding
+from app.db import get_chat_messages, add_chat_messages, get_kb_version
+from app.semantic_cache import semantic_cache
+from app.assistants.tools import QueryKnowledgeBaseTool, run_tool_calls
+from app.assistants.context_packer import ContextPacker
+from app.assistants.registry import prompt_registry
+from app.utils.sse_stream import SSEStream, StreamClosed
+from app.turns import turn_registry
 from app.config import Config
 
 class RAGAssistant:
@@ -13,11 +15,14 @@ class RAGAssistant:
         self.chat_id = chat_id
         self.rdb = rdb
         self.sse_stream = None
-        self.main_system_message = {'role': 'system', 'content': MAIN_SYSTEM_PROMPT}
-        self.rag_system_message = {'role': 'system', 'content': RAG_SYSTEM_PROMPT}
-        self.tools_schema = [pydantic_function_tool(QueryKnowledgeBaseTool)]
+        # Shared by every assistant, see PromptRegistry
+        self.main_system_message = prompt_registry.system_message('main')
+        self.rag_system_message = prompt_registry.system_message('rag')
+        self.tools_schema = prompt_registry.tool_schemas(QueryKnowledgeBaseTool)
         self.history_size = history_size
         self.max_tool_calls = max_tool_calls
+        self.context_packer = ContextPacker()
+        self.prompt_hash = prompt_registry.prompt_hash(QueryKnowledgeBaseTool)
 
     async def _generate_chat_response(self, system_message, chat_messages, **kwargs):
          messages = [system_message, *chat_messages]
@@ -30,47 +35,81 @@ class RAGAssistant:
             assistant_message = final_completion.choices[0].message
             return assistant_message
     
-    async def _handle_tool_calls(self, tool_calls, chat_messages):
-        for tool_call in tool_calls[:self.max_tool_calls]:
-            # There is only one tool in our RAGAssistant, the QueryKnowledgeBaseTool
-            kb_tool = tool_call.function.parsed_arguments
-            kb_result = await kb_tool(self.rdb)
-            chat_messages.append(
-                {'role': 'tool', 'tool_call_id': tool_call.id, 'content': kb_result}
-            )
-        return await self._generate_chat_response(
+    async def _handle_tool_calls(self, tool_calls, history, turn_messages):
+        # There is only one tool in our RAGAssistant, the QueryKnowledgeBaseTool
+        tool_messages = await run_tool_calls(tool_calls[:self.max_tool_calls], self.rdb)
+        turn_messages.extend(tool_messages)
+        chat_messages, _ = self.context_packer.pack(self.rag_system_message, history, turn_messages)
+        assistant_message = await self._generate_chat_response(
             system_message=self.rag_system_message,
             chat_messages=chat_messages,
         )
+        return assistant_message, tool_messages.all_ok
     
+    async def _replay_cached_answer(self, user_db_message, cached):
+        await self.sse_stream.send(cached['answer'])
+        assistant_db_message = {
+            'role': 'assistant',
+            'content': cached['answer'],
+            'tool_calls': cached['tool_calls'],
+            'created': int(time())
+        }
+        await add_chat_messages(self.rdb, self.chat_id, [user_db_message, assistant_db_message])
+
     async def _run_conversation_step(self, message):
         user_db_message = {'role': 'user', 'content': message, 'created': int(time())}
-        chat_messages = await get_chat_messages(self.rdb, self.chat_id, last_n=self.history_size)
-        chat_messages.append({'role': 'user', 'content': message})
+        history = await get_chat_messages(self.rdb, self.chat_id, last_n=self.history_size)
+
+        # Only the first message of a chat is a standalone question whose answer can be reused
+        cache_key = None
+        if semantic_cache.enabled and not history:
+            query_vector = await get_embedding(message)
+            kb_version = await get_kb_version(self.rdb)
+            cached = await semantic_cache.lookup(query_vector, kb_version, self.prompt_hash)
+            if cached:
+                return await self._replay_cached_answer(user_db_message, cached)
+            cache_key = (query_vector, kb_version)
+
+        turn_messages = [{'role': 'user', 'content': message}]
+        chat_messages, _ = self.context_packer.pack(self.main_system_message, history, turn_messages,
+                                                    tools=self.tools_schema)
         assistant_message = await self._generate_chat_response(
             system_message=self.main_system_message,
             chat_messages=chat_messages,
             tools=self.tools_schema
         )
         tool_calls = assistant_message.tool_calls
+        tools_ok = True
 
         if tool_calls:
-            chat_messages.append(assistant_message)
-            assistant_message = await self._handle_tool_calls(tool_calls, chat_messages)
+            turn_messages.append(assistant_message)
+            assistant_message, tools_ok = await self._handle_tool_calls(tool_calls, history, turn_messages)
         
         assistant_db_message = {
             'role': 'assistant',
             'content': assistant_message.content,
             'tool_calls': [
-                {'name': tc.function.name, 'arguments': tc.function.arguments} for tc in tool_calls
+                {'name': tc.function.name, 'arguments': tc.function.arguments} for tc in tool_calls or []
             ],
             'created': int(time())
         }
         await add_chat_messages(self.rdb, self.chat_id, [user_db_message, assistant_db_message])
+        # An answer written without the results of a failed or timed out tool call isn't reused
+        if cache_key and assistant_message.content and tools_ok:
+            query_vector, kb_version = cache_key
+            await semantic_cache.store(message, query_vector, assistant_message.content,
+                                       assistant_db_message['tool_calls'], kb_version, self.prompt_hash)
 
     async def _handle_conversation_task(self, message):
         try:
             await self._run_conversation_step(message)
+        except StreamClosed:
+            # Leaving the chat completion stream early closes the upstream request
+            print(f'Chat {self.chat_id}: client disconnected, response cancelled')
+        except asyncio.CancelledError:
+            # Cancelled by the turn registry, on disconnect or at shutdown
+            print(f'Chat {self.chat_id}: turn cancelled')
+            raise
         except Exception as e:
             # TODO: Improve error handling (send SSE message to client)
             print(f'Error: {str(e)}')
@@ -78,6 +117,8 @@ class RAGAssistant:
             await self.sse_stream.close()
 
     def run(self, message):
+        # The turn runs in the background, cancelled if the client disconnects (see TurnRegistry)
         self.sse_stream = SSEStream()
-        asyncio.create_task(self._handle_conversation_task(message))
+        turn_registry.start(lambda: self._handle_conversation_task(message), self.sse_stream,
+                            name=f'chat-{self.chat_id}')
         return self.sse_stream
@@ -0,0 +1,167 @@
+import json
+import logging
+from app.assistants.tools import format_source, format_sources
+from app.utils.token_utils import token_size, token_sizes
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+# Tokens the chat format adds around each message (role and separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Separator between two formatted sources in a tool result
+SOURCE_SEPARATOR_TOKENS = 3
+TRUNCATION_MARKER = ' [...]'
+
+def message_field(message, name):
+    # Messages are dicts, except the assistant messages returned by the API
+    return message.get(name) if isinstance(message, dict) else getattr(message, name, None)
+
+def message_text(message):
+    """The text of a message that counts towards the prompt: its content and tool call arguments"""
+    parts = [message_field(message, 'content') or '']
+    for tool_call in message_field(message, 'tool_calls') or []:
+        function = message_field(tool_call, 'function')
+        parts += [message_field(function, 'name') or '', message_field(function, 'arguments') or '']
+    return '\n'.join(parts)
+
+def has_span(chunk):
+    # Chunks indexed before span tracking, or whose text isn't their exact span, can't be merged
+    start, end = chunk.get('start'), chunk.get('end')
+    return start is not None and end is not None and end - start == len(chunk['text'])
+
+def merge_chunks(kept, chunk):
+    """Merge `chunk` into `kept`, an overlapping chunk of the same document"""
+    first, second = sorted((kept, chunk), key=lambda c: c['start'])
+    text = first['text'] + second['text'][first['end'] - second['start']:]
+    kept.update(text=text, start=first['start'], end=max(first['end'], second['end']), page=first.get('page'))
+
+def dedupe_chunks(chunk_lists):
+    """Merge the chunks of several search results that overlap a higher ranked chunk of the same
+    document (from an earlier result, or earlier in the same one) into that chunk, using their
+    character spans. Returns the deduplicated lists and the number of chunks merged away."""
+    seen = set()
+    by_doc = {}
+    deduped = []
+    merged = 0
+    for chunks in chunk_lists:
+        unique = []
+        for chunk in chunks:
+            key = chunk.get('chunk_id') or (chunk['doc_name'], chunk['text'])
+            if key in seen:
+                merged += 1
+                continue
+            seen.add(key)
+            doc_chunks = by_doc.setdefault(chunk['doc_name'], [])
+            if has_span(chunk):
+                overlapping = next((c for c in doc_chunks if chunk['start'] < c['end'] and c['start'] < chunk['end']), None)
+                if overlapping is not None:
+                    merge_chunks(overlapping, chunk)
+                    merged += 1
+                    continue
+            # Copied, since merging changes it and search results may be cached
+            chunk = dict(chunk)
+            if has_span(chunk):
+                doc_chunks.append(chunk)
+            unique.append(chunk)
+        deduped.append(unique)
+    return deduped, merged
+
+def truncate_text(text, size, max_tokens):
+    """The start of `text` (of `size` tokens) that fits in `max_tokens`, with a truncation marker"""
+    chars = len(text) * max_tokens // max(size, 1)
+    while chars > 0:
+        truncated = text[:chars] + TRUNCATION_MARKER
+        if token_size(truncated) <= max_tokens:
+            return truncated
+        chars = chars * 9 // 10
+    return None
+
+class ContextPacker:
+    """Fits the messages of a chat completion into a token budget.
+
+    The system prompt, the tool schemas and the messages of the current turn (the user message and
+    the assistant's tool calls) are always sent. Knowledge base results come next: chunks that
+    overlap a chunk of the same document are merged into it, and the lowest ranked chunks are
+    dropped only if the results don't fit on their own. The history fills the remaining budget,
+    newest messages first: the first one that doesn't fit is truncated, when at least
+    `min_truncated_tokens` of it fit, and the older ones are dropped.
+    """
+    def __init__(self, budget=Config.CONTEXT_TOKEN_BUDGET, min_truncated_tokens=Config.CONTEXT_MIN_TRUNCATED_TOKENS):
+        self.budget = budget
+        self.min_truncated_tokens = min_truncated_tokens
+
+    def pack(self, system_message, history, turn_messages, tools=None):
+        """Returns the chat messages to send after the system message, and a report of their token counts"""
+        results = {i for i, m in enumerate(turn_messages) if isinstance(m, dict) and 'chunks' in m}
+        chunk_lists, merged = dedupe_chunks([turn_messages[i]['chunks'] for i in sorted(results)])
+
+        # Everything is counted in one batch
+        fixed_texts = [system_message['content'], json.dumps(tools) if tools else '']
+        fixed_texts += [message_text(m) for i, m in enumerate(turn_messages) if i not in results]
+        chunk_texts = [format_source(c) for chunks in chunk_lists for c in chunks]
+        history_texts = [message_text(m) for m in history]
+        sizes = token_sizes(fixed_texts + chunk_texts + history_texts)
+        fixed_size = sum(sizes[:len(fixed_texts)]) + MESSAGE_OVERHEAD_TOKENS * (len(fixed_texts) - 1)
+        chunk_sizes = iter(sizes[len(fixed_texts):len(fixed_texts) + len(chunk_texts)])
+        history_sizes = sizes[len(fixed_texts) + len(chunk_texts):]
+
+        # Drop the lowest ranked chunks, across results, until the results fit
+        available = self.budget - fixed_size - MESSAGE_OVERHEAD_TOKENS * len(results)
+        ranked = [(rank, n, next(chunk_sizes) + SOURCE_SEPARATOR_TOKENS)
+                  for n, chunks in enumerate(chunk_lists) for rank in range(len(chunks))]
+        ranked.sort()
+        results_size = sum(size for *_, size in ranked)
+        dropped = 0
+        while ranked and results_size > available:
+            rank, n, size = ranked.pop()
+            del chunk_lists[n][rank]
+            results_size -= size
+            dropped += 1
+        available -= results_size
+        if available < 0:
+            logger.warning(f'The system prompt, tools and current turn take {fixed_size} tokens, '
+                           f'over the {self.budget} tokens context budget')
+
+        # Newest history first, up to the first message that doesn't fit
+        packed_history = []
+        history_size = 0
+        truncated = False
+        for message, size in zip(reversed(history), reversed(history_sizes)):
+            room = available - MESSAGE_OVERHEAD_TOKENS
+            if size <= room:
+                packed_history.append(message)
+                history_size += size + MESSAGE_OVERHEAD_TOKENS
+                available -= size + MESSAGE_OVERHEAD_TOKENS
+                continue
+            content = room >= self.min_truncated_tokens and truncate_text(message_text(message), size, room)
+            if content:
+                packed_history.append({**message, 'content': content})
+                history_size += token_size(content) + MESSAGE_OVERHEAD_TOKENS
+                truncated = True
+            break
+        packed_history.reverse()
+
+        chat_messages = [*packed_history]
+        packed_results = iter(chunk_lists)
+        for i, message in enumerate(turn_messages):
+            if i in results:
+                chunks = next(packed_results)
+                message = {k: v for k, v in message.items() if k != 'chunks'}
+                message['content'] = format_sources(chunks) if chunks else 'No results fit in the context.'
+            chat_messages.append(message)
+
+        report = {
+            'budget': self.budget,
+            'total': fixed_size + results_size + MESSAGE_OVERHEAD_TOKENS * len(results) + history_size,
+            'fixed': fixed_size,
+            'results': results_size,
+            'history': history_size,
+            'chunks': len(ranked),
+            'chunks_merged': merged,
+            'chunks_dropped': dropped,
+            'history_messages': len(packed_history),
+            'history_dropped': len(history) - len(packed_history),
+            'history_truncated': truncated,
+        }
+        logger.info('Packed context: ' + ', '.join(f'{k} {v}' for k, v in report.items()))
+        return chat_messages, report
@@ -1,22 +1,25 @@
 import asyncio
 from rich.console import Console
-from backend.app.openaiutils import pydantic_function_tool
 from app.db import get_redis
-from backend.app.openaiutils import chat_stream
-from app.assistants.tools import QueryByTemplateIdTool, QueryKnowledgeBaseTool, SaveTemplateTool
-from app.assistants.prompts import MAIN_SYSTEM_PROMPT, RAG_SYSTEM_PROMPT
+from app.openaiutils import chat_stream
+from app.assistants.tools import QueryByTemplateIdTool, QueryKnowledgeBaseTool, SaveTemplateTool, run_tool_calls
+from app.assistants.context_packer import ContextPacker
+from app.assistants.registry import prompt_registry
+from app.templates_service import Template
 
 class LocalRAGAssistant:
     def __init__(self, rdb, history_size=4, max_tool_calls=3, log_tool_calls=True, log_tool_results=False):
         self.console = Console()
         self.rdb = rdb
         self.chat_history = []
-        self.main_system_message = {'role': 'system', 'content': MAIN_SYSTEM_PROMPT}
-        self.rag_system_message = {'role': 'system', 'content': RAG_SYSTEM_PROMPT}
+        self.main_system_message = prompt_registry.system_message('main')
+        self.rag_system_message = prompt_registry.system_message('rag')
         self.history_size = history_size
         self.max_tool_calls = max_tool_calls
         self.log_tool_calls = log_tool_calls
         self.log_tool_results = log_tool_results
+        self.context_packer = ContextPacker()
+        self.tools_schema = prompt_registry.tool_schemas(QueryKnowledgeBaseTool, QueryByTemplateIdTool, SaveTemplateTool)
 
     async def _generate_chat_response(self, system_message, chat_messages, **kwargs):
          messages = [system_message, *chat_messages]
@@ -34,34 +37,32 @@ class LocalRAGAssistant:
     async def run(self):
         self.console.print('How can I help you?\n', style='cyan')
         while True:
-            chat_messages = self.chat_history[-self.history_size:]
+            history = self.chat_history[-self.history_size:]
             user_input = input()
             self.console.print()
             user_message = {'role': 'user', 'content': user_input}
-            chat_messages.append(user_message)
+            turn_messages = [user_message]
+            chat_messages, _ = self.context_packer.pack(self.main_system_message, history, turn_messages,
+                                                        tools=self.tools_schema)
             assistant_message = await self._generate_chat_response(
                 system_message=self.main_system_message,
                 chat_messages=chat_messages,
-                tools=[
-                    pydantic_function_tool(QueryKnowledgeBaseTool),
-                    pydantic_function_tool(QueryByTemplateIdTool),
-                    pydantic_function_tool(SaveTemplateTool)
-                ],
+                tools=self.tools_schema,
                 tool_choice='auto'
             )
 
             if assistant_message.tool_calls:
-                chat_messages.append(assistant_message)
-                for tool_call in assistant_message.tool_calls[:self.max_tool_calls]:
-                    if self.log_tool_calls:
+                turn_messages.append(assistant_message)
+                tool_calls = assistant_message.tool_calls[:self.max_tool_calls]
+                if self.log_tool_calls:
+                    for tool_call in tool_calls:
                         self.console.print(f'TOOL CALL:\n{tool_call.to_dict()}', style='red', end='\n\n')
-                    kb_tool = tool_call.function.parsed_arguments
-                    kb_result = await kb_tool(self.rdb)
-                    if self.log_tool_results:
-                        self.console.print(f'TOOL RESULT:\n{kb_result}', style='magenta', end='\n\n')
-                    chat_messages.append(
-                        {'role': 'tool', 'tool_call_id': tool_call.id, 'content': kb_result}
-                    )
+                tool_messages = await run_tool_calls(tool_calls, self.rdb)
+                if self.log_tool_results:
+                    for tool_message in tool_messages:
+                        self.console.print(f'TOOL RESULT:\n{tool_message["content"]}', style='magenta', end='\n\n')
+                turn_messages.extend(tool_messages)
+                chat_messages, _ = self.context_packer.pack(self.rag_system_message, history, turn_messages)
                 assistant_message = await self._generate_chat_response(
                     system_message=self.rag_system_message,
                     chat_messages=chat_messages,
@@ -74,6 +75,7 @@ class LocalRAGAssistant:
 
 
 async def run_local_assistant():
+    Template.connect()
     async with get_redis() as rdb:
         await LocalRAGAssistant(rdb).run()
 
@@ -2,34 +2,34 @@ import json
 from app.config import Config
 from app.templates_service import TemplateModel
 
-MAIN_SYSTEM_PROMPT = f"""
+# Computed once: the schema is large and the prompts below embed it three times
+TEMPLATE_SCHEMA_JSON = json.dumps(TemplateModel.model_json_schema())
+
+# Shared, unchanging start of every system prompt, so the prompts have a common prefix
+# for upstream prompt caching
+PROMPT_PREFIX = """
 You are a knowledgeable assistant specialized in building insurance policy templates from other insurance policy documents.
 
 You have access to the 'QueryKnowledgeBaseTool' which includes templates from other insurance policy documents. 
 Use this tool to query the knowledge base and answer the user questions to best of your abilities.
 
 Use this information to build a template for the insurance policy template document. 
+"""
 
+MAIN_SYSTEM_PROMPT = PROMPT_PREFIX + f"""
 if the user asks for retrieval of a template, then use the 'QueryByTemplateIdTool' to retrieve the template from the database.
 
 If the user asks for a template generation, then respond with the following pydantic json array format.
 Make sure to breakdown the template into logical sections and create an array of of templates with the following JSON format:
-[{json.dumps(TemplateModel.model_json_schema())}, {json.dumps(TemplateModel.model_json_schema())}, ...]
+[{TEMPLATE_SCHEMA_JSON}, {TEMPLATE_SCHEMA_JSON}, ...]
 
 If the user asks for a template generation, then use the 'SaveTemplateTool' to save the template to the database.
 """
 
 
-RAG_SYSTEM_PROMPT = f"""
-You are a knowledgeable assistant specialized in building insurance policy templates from other insurance policy documents.
-
-You have access to the 'QueryKnowledgeBaseTool' which includes templates from other insurance policy documents. 
-Use this tool to query the knowledge base and answer the user questions to best of your abilities.
-
-Use this information to build a template for the insurance policy template document. 
-
+RAG_SYSTEM_PROMPT = PROMPT_PREFIX + f"""
 If the user asks for a template generation, then respond with the following pydantic json format:
-{json.dumps(TemplateModel.model_json_schema())}
+{TEMPLATE_SCHEMA_JSON}
 and use the 'SaveTemplateTool' to save the template to the database.
 """
 
@@ -0,0 +1,48 @@
+from openai import pydantic_function_tool
+from app.semantic_cache import prompt_hash
+from app.assistants.prompts import MAIN_SYSTEM_PROMPT, RAG_SYSTEM_PROMPT
+from app.config import Config
+
+SYSTEM_PROMPTS = {
+    'main': MAIN_SYSTEM_PROMPT,
+    'rag': RAG_SYSTEM_PROMPT,
+}
+
+class PromptRegistry:
+    """System messages, tool schemas and prompt hashes, built once per process and shared.
+
+    Assistants are created for every request; they get the same message and schema objects
+    instead of rebuilding them, and the requests they send start with byte-identical system
+    prompts and tools, which upstream prompt caching needs. The returned objects are shared:
+    they must not be modified.
+    """
+    def __init__(self, prompts=SYSTEM_PROMPTS):
+        self.prompts = prompts
+        self._system_messages = {}
+        self._tool_schemas = {}
+        self._prompt_hashes = {}
+
+    def system_message(self, name):
+        message = self._system_messages.get(name)
+        if message is None:
+            message = self._system_messages[name] = {'role': 'system', 'content': self.prompts[name]}
+        return message
+
+    def tool_schemas(self, *tools):
+        """The function tool schemas of the given tool models, in order"""
+        schemas = self._tool_schemas.get(tools)
+        if schemas is None:
+            schemas = self._tool_schemas[tools] = [pydantic_function_tool(tool) for tool in tools]
+        return schemas
+
+    def prompt_hash(self, *tools):
+        """Hash of the prompts, the model and the tools, for the semantic cache"""
+        digest = self._prompt_hashes.get(tools)
+        if digest is None:
+            digest = self._prompt_hashes[tools] = prompt_hash(
+                *self.prompts.values(), Config.MODEL, self.tool_schemas(*tools)
+            )
+        return digest
+
+
+prompt_registry = PromptRegistry()
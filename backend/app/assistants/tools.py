@@ -1,34 +1,201 @@
-from typing import List
+import re
+import json
+import asyncio
+import logging
+from time import perf_counter
+from typing import List, Optional
 from pydantic import BaseModel, Field
-from app.db import search_vector_db
+from redis.exceptions import ResponseError
+from app.db import search_vector_db, search_text_db, use_local_vector_store, get_manifest_doc_names
 from app.openaiutils import get_embedding
+from app.retrieval_cache import retrieval_cache
+from app.utils.fusion import fuse
 from app.templates_service import Template, TemplateModel
-from logging import log
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+def source_name(chunk):
+    return f'{chunk["doc_name"]}, page {chunk["page"]}' if chunk.get('page') else chunk['doc_name']
+
+def format_source(chunk):
+    return f'SOURCE: {source_name(chunk)}\n"""\n{chunk["text"]}\n"""'
+
+def format_sources(chunks):
+    return f"\n\n---\n\n".join(map(format_source, chunks)) + f"\n\n---"
+
+def doc_name_key(doc_name):
+    return re.sub(r'\.pdf$', '', doc_name.strip(), flags=re.IGNORECASE).lower()
+
+async def resolve_doc_names(rdb, doc_names):
+    """The knowledge base documents that `doc_names` (written by the model) refer to, matched without
+    case or file extension, or None to search every document when none of them is known"""
+    if not doc_names:
+        return None
+    known = {doc_name_key(doc_name): doc_name for doc_name in await get_manifest_doc_names(rdb)}
+    keys = list(dict.fromkeys(map(doc_name_key, doc_names)))
+    unknown = [key for key in keys if key not in known]
+    if unknown:
+        logger.warning(f'Unknown documents {unknown} left out of the knowledge base query filter')
+    return [known[key] for key in keys if key in known] or None
+
+async def filtered_search(search, doc_names, fallback_on_empty):
+    """`search(doc_names)`, or `search(None)` over every document if the index can't filter by
+    document (it predates the doc_tag field) or, with `fallback_on_empty`, if nothing matched"""
+    if doc_names:
+        try:
+            chunks = await search(doc_names)
+            if chunks or not fallback_on_empty:
+                return chunks
+            logger.warning(f'No chunks found in {doc_names}, searching every document')
+        except ResponseError as e:
+            logger.warning(f'Searching by document failed ({e}), searching every document. '
+                           f'Run `migrate index` to add document filters to the index.')
+    return await search(None)
 
 class QueryKnowledgeBaseTool(BaseModel):
     """Query the knowledge base to answer user questions"""
     query_input: str = Field(description='The natural language query input string. The query input should be clear and standalone.')
+    doc_names: Optional[List[str]] = Field(default=None, description='Only search these documents, named as in the SOURCE lines of earlier results, when the user asks about specific documents. Leave empty to search every document.')
+
+    async def search(self, rdb, top_k, doc_names=None):
+        if Config.SEARCH_MODE == 'hybrid' and not use_local_vector_store():
+            return await self.hybrid_search(rdb, top_k, doc_names)
+        start = perf_counter()
+        query_vector = await get_embedding(self.query_input)
+        embedded = perf_counter()
+        chunks = await filtered_search(
+            lambda names: search_vector_db(rdb, query_vector, top_k=top_k, doc_names=names), doc_names, True
+        )
+        logger.info(f'Knowledge base query: embedding {(embedded - start) * 1000:.0f} ms, '
+                    f'search {(perf_counter() - embedded) * 1000:.0f} ms, {len(chunks)} chunks')
+        return chunks
+
+    async def hybrid_search(self, rdb, top_k, doc_names=None):
+        # The full-text query runs while the query is embedded and searched by vector
+        candidates = max(top_k, Config.HYBRID_CANDIDATES)
+        timings = {}
+
+        async def timed(name, search):
+            start = perf_counter()
+            chunks = await search()
+            timings[name] = (perf_counter() - start) * 1000
+            return chunks
+
+        async def vector_search():
+            query_vector = await timed('embedding', lambda: get_embedding(self.query_input))
+            return await timed('knn', lambda: filtered_search(
+                lambda names: search_vector_db(rdb, query_vector, top_k=candidates, doc_names=names), doc_names, True
+            ))
+
+        # The full-text query legitimately finds nothing when no word of the query is in the documents
+        vector_chunks, text_chunks = await asyncio.gather(
+            vector_search(),
+            timed('bm25', lambda: filtered_search(
+                lambda names: search_text_db(rdb, self.query_input, top_k=candidates, doc_names=names), doc_names, False
+            ))
+        )
+        start = perf_counter()
+        weight = Config.HYBRID_VECTOR_WEIGHT
+        chunks = fuse([vector_chunks, text_chunks], top_k, weights=[weight, 1 - weight])
+        timings['fusion'] = (perf_counter() - start) * 1000
+        logger.info('Hybrid knowledge base query: ' + ', '.join(f'{name} {ms:.1f} ms' for name, ms in timings.items())
+                    + f', {len(vector_chunks)} vector and {len(text_chunks)} full-text results fused into {len(chunks)} chunks')
+        return chunks
 
     async def __call__(self, rdb):
-        query_vector = await get_embedding(self.query_input)        
-        chunks = await search_vector_db(rdb, query_vector)        
-        formatted_sources = [f'SOURCE: {c["doc_name"]}\n"""\n{c["text"]}\n"""' for c in chunks]
-        return f"\n\n---\n\n".join(formatted_sources) + f"\n\n---"
+        # The chunks themselves, formatted by run_tool_call and packed into the prompt by the ContextPacker
+        top_k = Config.VECTOR_SEARCH_TOP_K
+        doc_names = await resolve_doc_names(rdb, self.doc_names)
+        return await retrieval_cache.search(self.query_input, top_k, lambda: self.search(rdb, top_k, doc_names),
+                                            doc_names=doc_names)
 
 class QueryByTemplateIdTool(BaseModel):
     """Query the templates using the template id"""
     query_input: str = Field(description='the template id to be retrieved')
 
-    async def __call__(self):
-        log.info(f"Querying template: {self.query_input}")
+    async def __call__(self, rdb=None):
+        logger.info(f"Querying template: {self.query_input}")
         templates = await Template.get_chunks(self.query_input)
-        return templates
+        return json.dumps([template.model_dump(mode='json') for template in templates])
 
 class SaveTemplateTool(BaseModel):
     """This tool saves the template to the database"""
     templates: List[TemplateModel]
 
-    async def __call__(self):
-        print(f"Saving templates: {self.templates}")
-        templates = await Template.create_many(self.templates)       
-        return "Successfully saved the templates"
\ No newline at end of file
+    async def __call__(self, rdb=None):
+        logger.info(f"Saving {len(self.templates)} templates")
+        for template in self.templates:
+            await Template.create(template)
+        return "Successfully saved the templates"
+
+class ToolStats:
+    """Call counts and timings per tool, for the metrics endpoint"""
+    def __init__(self):
+        self.tools = {}
+
+    def record(self, name, status, elapsed):
+        stats = self.tools.setdefault(name, {'calls': 0, 'timeouts': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        stats['calls'] += 1
+        stats['timeouts'] += status == 'timeout'
+        stats['errors'] += status == 'error'
+        stats['total_ms'] += elapsed * 1000
+        stats['max_ms'] = max(stats['max_ms'], elapsed * 1000)
+
+    def stats(self):
+        return {
+            name: {**stats, 'avg_ms': stats['total_ms'] / stats['calls']}
+            for name, stats in self.tools.items()
+        }
+
+
+tool_stats = ToolStats()
+
+class ToolMessages(list):
+    """The tool messages of run_tool_calls, with the status of each call ('ok', 'timeout' or 'error')"""
+    def __init__(self, results):
+        super().__init__(message for message, _ in results)
+        self.statuses = [status for _, status in results]
+
+    @property
+    def all_ok(self):
+        return all(status == 'ok' for status in self.statuses)
+
+async def run_tool_call(tool_call, rdb, semaphore, timeout):
+    name = tool_call.function.name
+    tool = tool_call.function.parsed_arguments
+    chunks = None
+    async with semaphore:
+        start = perf_counter()
+        try:
+            content = await asyncio.wait_for(tool(rdb), timeout)
+            if isinstance(content, list):
+                chunks, content = content, format_sources(content)
+            status = 'ok'
+        except asyncio.TimeoutError:
+            content = f'The {name} call timed out, no results.'
+            status = 'timeout'
+        except Exception as e:
+            logger.exception(f'Tool call {name} failed')
+            content = f'The {name} call failed: {e}'
+            status = 'error'
+        elapsed = perf_counter() - start
+    tool_stats.record(name, status, elapsed)
+    logger.info(f'Tool call {name} ({tool_call.id}): {status} in {elapsed * 1000:.0f} ms')
+    message = {'role': 'tool', 'tool_call_id': tool_call.id, 'content': content}
+    if chunks is not None:
+        # Kept for the ContextPacker, which removes it before the message is sent
+        message['chunks'] = chunks
+    return message, status
+
+async def run_tool_calls(tool_calls, rdb, timeout=Config.TOOL_TIMEOUT, concurrency=Config.TOOL_CONCURRENCY):
+    """Run the tool calls of an assistant message concurrently (at most `concurrency` at a time)
+    and return their tool messages in call order. A call that fails or takes longer than `timeout`
+    seconds gets an error message as its result, so every tool call is answered. Tools returning
+    knowledge base chunks get them formatted as content, and listed under 'chunks'. The returned
+    ToolMessages tell which calls succeeded."""
+    semaphore = asyncio.Semaphore(concurrency)
+    start = perf_counter()
+    results = await asyncio.gather(*[run_tool_call(tc, rdb, semaphore, timeout) for tc in tool_calls])
+    logger.info(f'{len(tool_calls)} tool calls in {(perf_counter() - start) * 1000:.0f} ms')
+    return ToolMessages(results)
@@ -11,6 +11,11 @@ class Config:
     MONGODB_URI: str = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
     MONGODB_DB_NAME: str = os.getenv("MONGODB_DB_NAME", "templates_gen_db")
     MONGODB_TEST_DB_NAME: str = os.getenv("MONGODB_TEST_DB_NAME", "templates_gen_db_test")
+    MONGODB_MAX_POOL_SIZE: int = int(os.getenv("MONGODB_MAX_POOL_SIZE", 100))
+    MONGODB_MIN_POOL_SIZE: int = int(os.getenv("MONGODB_MIN_POOL_SIZE", 0))
+    MONGODB_SERVER_SELECTION_TIMEOUT_MS: int = int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", 5000))
+    MONGODB_CONNECT_TIMEOUT_MS: int = int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", 5000))
+    MONGODB_SOCKET_TIMEOUT_MS: int = int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", 30000))
     
     # API settings
     API_VERSION: str = "v1"
@@ -29,17 +34,109 @@ class Config:
     # OpenAI and other settings
     ALLOW_ORIGINS: str = os.getenv("ALLOW_ORIGINS", "*")
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY")
+    # Alternative API endpoint, e.g. a proxy or a local fake embeddings server
+    OPENAI_BASE_URL: Optional[str] = os.getenv("OPENAI_BASE_URL")
     MODEL: str = os.getenv("MODEL", "gpt-4o-mini")   
     EMBEDDING_MODEL: str = os.getenv("EMBEDDING_MODEL", "text-embedding-3-large")
     EMBEDDING_DIMENSIONS: int = int(os.getenv("EMBEDDING_DIMENSIONS", 1024))
+    EMBEDDING_CACHE_ENABLED: bool = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+    EMBEDDING_CACHE_REDIS: bool = os.getenv("EMBEDDING_CACHE_REDIS", "true").lower() == "true"
+    EMBEDDING_CACHE_SIZE: int = int(os.getenv("EMBEDDING_CACHE_SIZE", 10000))
+    EMBEDDING_CACHE_TTL: int = int(os.getenv("EMBEDDING_CACHE_TTL", 604800))
+    # Concurrent get_embedding calls within the window are sent as one request (0 = no coalescing)
+    EMBEDDING_COALESCE_WINDOW_MS: float = float(os.getenv("EMBEDDING_COALESCE_WINDOW_MS", 5))
+    EMBEDDING_COALESCE_MAX_BATCH: int = int(os.getenv("EMBEDDING_COALESCE_MAX_BATCH", 64))
     REDIS_HOST: str = os.getenv("REDIS_HOST", "localhost")  
     REDIS_PORT: int = int(os.getenv("REDIS_PORT", 6379))
+    REDIS_PAGE_SIZE: int = int(os.getenv("REDIS_PAGE_SIZE", 500))
+    REDIS_MAX_CONNECTIONS: int = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+    REDIS_POOL_TIMEOUT: float = float(os.getenv("REDIS_POOL_TIMEOUT", 20))
+    REDIS_SOCKET_KEEPALIVE: bool = os.getenv("REDIS_SOCKET_KEEPALIVE", "true").lower() == "true"
+    REDIS_HEALTH_CHECK_INTERVAL: int = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30))
     DOCS_DIR: str = os.getenv("DOCS_DIR", "data/docs")
     EXPORT_DIR: str = os.getenv("EXPORT_DIR", "data")
     VECTOR_SEARCH_TOP_K: int = int(os.getenv("VECTOR_SEARCH_TOP_K", 10))
+    # Knowledge base search: 'vector' (KNN only) or 'hybrid' (BM25 full-text and KNN queries, fused
+    # with 'rrf' reciprocal rank fusion or 'weighted' normalized scores). HYBRID_CANDIDATES results
+    # (at least top_k) are fetched from each query, and the vector results get HYBRID_VECTOR_WEIGHT
+    # (the full-text ones the rest)
+    SEARCH_MODE: str = os.getenv("SEARCH_MODE", "vector").lower()
+    HYBRID_FUSION: str = os.getenv("HYBRID_FUSION", "rrf").lower()
+    HYBRID_RRF_K: int = int(os.getenv("HYBRID_RRF_K", 60))
+    HYBRID_VECTOR_WEIGHT: float = float(os.getenv("HYBRID_VECTOR_WEIGHT", 0.5))
+    HYBRID_CANDIDATES: int = int(os.getenv("HYBRID_CANDIDATES", 20))
+    # Vector search backend: 'redis' (RediSearch) or 'local' (in-process NumPy store in LOCAL_VECTOR_STORE_DIR)
+    VECTOR_SEARCH_BACKEND: str = os.getenv("VECTOR_SEARCH_BACKEND", "redis").lower()
+    LOCAL_VECTOR_STORE_DIR: str = os.getenv("LOCAL_VECTOR_STORE_DIR", "data/vectors")
+    # Vector storage: 'json' (RedisJSON documents) or 'hash' (HASH keys with packed FLOAT32 vectors)
+    VECTOR_STORAGE: str = os.getenv("VECTOR_STORAGE", "json").lower()
+    # Vector index settings: FLAT (brute force) or HNSW (approximate), INITIAL_CAP 0 = RediSearch default
+    VECTOR_INDEX_ALGORITHM: str = os.getenv("VECTOR_INDEX_ALGORITHM", "FLAT").upper()
+    VECTOR_INDEX_INITIAL_CAP: int = int(os.getenv("VECTOR_INDEX_INITIAL_CAP", 0))
+    HNSW_M: int = int(os.getenv("HNSW_M", 16))
+    HNSW_EF_CONSTRUCTION: int = int(os.getenv("HNSW_EF_CONSTRUCTION", 200))
+    HNSW_EF_RUNTIME: int = int(os.getenv("HNSW_EF_RUNTIME", 10))
     OWNER_NAME: str = os.getenv("OWNER_NAME", "")
 
     # Chat settings
     HISTORY_SIZE: int = 10
     MAX_TOOL_CALLS: int = 3
+    # Prompt tokens per chat completion (system prompt, tools, history and tool results), and the
+    # smallest part of an old message worth keeping when it has to be truncated to fit
+    CONTEXT_TOKEN_BUDGET: int = int(os.getenv("CONTEXT_TOKEN_BUDGET", 8000))
+    CONTEXT_MIN_TRUNCATED_TOKENS: int = int(os.getenv("CONTEXT_MIN_TRUNCATED_TOKENS", 64))
+    # Conversation turns running at once per process, turns waiting for one of them beyond which
+    # requests get a 429, and how long shutdown waits for running turns before cancelling them
+    MAX_ACTIVE_TURNS: int = int(os.getenv("MAX_ACTIVE_TURNS", 32))
+    MAX_QUEUED_TURNS: int = int(os.getenv("MAX_QUEUED_TURNS", 64))
+    SHUTDOWN_DRAIN_TIMEOUT: float = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", 30))
+    # Messages kept per chat (0 = all), older ones are archived compressed or, without CHAT_ARCHIVE, dropped
+    CHAT_MAX_MESSAGES: int = int(os.getenv("CHAT_MAX_MESSAGES", 0))
+    CHAT_ARCHIVE: bool = os.getenv("CHAT_ARCHIVE", "true").lower() == "true"
+    # Tool calls of one assistant message run concurrently, each within TOOL_TIMEOUT seconds
+    TOOL_TIMEOUT: float = float(os.getenv("TOOL_TIMEOUT", 20))
+    TOOL_CONCURRENCY: int = int(os.getenv("TOOL_CONCURRENCY", 4))
+
+    # Streamed responses: deltas are sent together every SSE_FLUSH_INTERVAL_MS or SSE_FLUSH_BYTES,
+    # and the response generation waits while SSE_MAX_BUFFER_BYTES are waiting to be sent
+    SSE_FLUSH_INTERVAL_MS: float = float(os.getenv("SSE_FLUSH_INTERVAL_MS", 30))
+    SSE_FLUSH_BYTES: int = int(os.getenv("SSE_FLUSH_BYTES", 1024))
+    SSE_MAX_BUFFER_BYTES: int = int(os.getenv("SSE_MAX_BUFFER_BYTES", 65536))
+
+    # Cache of knowledge base search results by query text, invalidated when the knowledge base changes
+    RETRIEVAL_CACHE_ENABLED: bool = os.getenv("RETRIEVAL_CACHE_ENABLED", "true").lower() == "true"
+    RETRIEVAL_CACHE_SIZE: int = int(os.getenv("RETRIEVAL_CACHE_SIZE", 1000))
+    RETRIEVAL_CACHE_TTL: int = int(os.getenv("RETRIEVAL_CACHE_TTL", 3600))
+
+    # Semantic cache of answers to standalone questions (the first message of a chat): a question
+    # whose embedding has at least SEMANTIC_CACHE_THRESHOLD cosine similarity with a cached one
+    # gets its answer replayed, as long as the knowledge base and the prompts haven't changed
+    SEMANTIC_CACHE_ENABLED: bool = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+    SEMANTIC_CACHE_THRESHOLD: float = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95))
+    SEMANTIC_CACHE_TTL: int = int(os.getenv("SEMANTIC_CACHE_TTL", 86400))
+    SEMANTIC_CACHE_MAX_ENTRIES: int = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 10000))
+
+    # Tokenizer settings: 'tiktoken' (BPE, from TOKENIZER_VOCAB_FILE when set) or 'whitespace'
+    TOKENIZER: str = os.getenv("TOKENIZER", "tiktoken").lower()
+    TOKENIZER_ENCODING: str = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+    TOKENIZER_VOCAB_FILE: Optional[str] = os.getenv("TOKENIZER_VOCAB_FILE")
+    TOKEN_CACHE_SIZE: int = int(os.getenv("TOKEN_CACHE_SIZE", 100000))
+
+    # Loader settings
+    CHUNK_SIZE: int = int(os.getenv("CHUNK_SIZE", 512))
+    CHUNK_OVERLAP: int = int(os.getenv("CHUNK_OVERLAP", 150))
+    LOADER_WORKERS: int = int(os.getenv("LOADER_WORKERS", os.cpu_count() or 1))
+    LOADER_MAX_PENDING_DOCS: int = int(os.getenv("LOADER_MAX_PENDING_DOCS", 2 * LOADER_WORKERS))
+    # Text held in memory while splitting a document, and per-document extraction budget (0 = no limit)
+    EXTRACT_WINDOW_CHARS: int = int(os.getenv("EXTRACT_WINDOW_CHARS", 200000))
+    EXTRACT_MAX_PAGES: int = int(os.getenv("EXTRACT_MAX_PAGES", 0))
+    EXTRACT_TIME_BUDGET: float = float(os.getenv("EXTRACT_TIME_BUDGET", 300))
+    # Embedding requests: at most EMBEDDING_BATCH_SIZE inputs and EMBEDDING_BATCH_TOKENS tokens each,
+    # up to EMBEDDING_CONCURRENCY in flight (fewer while rate limited)
+    EMBEDDING_BATCH_SIZE: int = int(os.getenv("EMBEDDING_BATCH_SIZE", 256))
+    EMBEDDING_BATCH_TOKENS: int = int(os.getenv("EMBEDDING_BATCH_TOKENS", 64000))
+    EMBEDDING_CONCURRENCY: int = int(os.getenv("EMBEDDING_CONCURRENCY", 4))
+    EMBEDDING_MAX_RETRIES: int = int(os.getenv("EMBEDDING_MAX_RETRIES", 8))
+    EMBEDDING_RETRY_BASE_DELAY: float = float(os.getenv("EMBEDDING_RETRY_BASE_DELAY", 1))
+    EMBEDDING_RETRY_MAX_DELAY: float = float(os.getenv("EMBEDDING_RETRY_MAX_DELAY", 60))
 
@@ -1,73 +1,434 @@
+import re
 import json
+import zlib
+import asyncio
 import numpy as np
-from redis.asyncio import Redis
-from redis.commands.search.field import TextField, VectorField, NumericField
+from time import time
+from redis.asyncio import Redis, BlockingConnectionPool
+from redis.exceptions import ConnectionError
+from redis.commands.search.field import TextField, TagField, VectorField, NumericField
 from redis.commands.search.indexDefinition import IndexDefinition, IndexType
 from redis.commands.search.query import Query
+from redis.commands.search.aggregation import AggregateRequest, Cursor, Desc
 from redis.commands.json.path import Path
+from app.local_vector_store import local_vector_store
 from app.config import Config
 
 VECTOR_IDX_NAME = 'idx:vector'
 VECTOR_IDX_PREFIX = 'vector:'
 CHAT_IDX_NAME = 'idx:chat'
 CHAT_IDX_PREFIX = 'chat:'
+# Chat messages are a list per chat, next to the chat's JSON metadata document, and messages
+# trimmed from the list are kept as compressed batches in the chat's archive list
+CHAT_MESSAGES_PREFIX = 'chatmsgs:'
+CHAT_ARCHIVE_PREFIX = 'chatarchive:'
+MANIFEST_KEY = 'manifest:docs'
+# Incremented whenever the knowledge base content changes, so caches of answers can tell
+KB_VERSION_KEY = 'kb:version'
+# Layout of the vector store, set by setup_db. A store without it (and without a manifest)
+# predates the incremental loader and is rebuilt from scratch
+KB_LAYOUT_KEY = 'kb:layout'
+KB_LAYOUT_VERSION = 1
+
+class MonitoredConnectionPool(BlockingConnectionPool):
+    """BlockingConnectionPool that keeps track of the tasks waiting for a connection and
+    of the requests that timed out because the pool stayed saturated"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.waiting = 0
+        self.timeouts = 0
+
+    async def get_connection(self, *args, **kwargs):
+        self.waiting += 1
+        try:
+            return await super().get_connection(*args, **kwargs)
+        except ConnectionError as e:
+            # Only waits for a free connection that ran out of time; failing to connect is not a timeout
+            if isinstance(e.__cause__, asyncio.TimeoutError):
+                self.timeouts += 1
+            raise
+        finally:
+            self.waiting -= 1
+
+    def stats(self):
+        in_use = len(self._in_use_connections)
+        return {
+            'max_connections': self.max_connections,
+            'in_use': in_use,
+            'idle': len(self._available_connections),
+            'waiting': self.waiting,
+            'timeouts': self.timeouts,
+            'utilization': in_use / self.max_connections,
+        }
+
+_redis_pool = None
+
+def init_redis_pool():
+    global _redis_pool
+    if _redis_pool is None:
+        _redis_pool = MonitoredConnectionPool(
+            host=Config.REDIS_HOST,
+            port=Config.REDIS_PORT,
+            max_connections=Config.REDIS_MAX_CONNECTIONS,
+            timeout=Config.REDIS_POOL_TIMEOUT,
+            socket_keepalive=Config.REDIS_SOCKET_KEEPALIVE,
+            health_check_interval=Config.REDIS_HEALTH_CHECK_INTERVAL,
+        )
+    return _redis_pool
+
+async def close_redis_pool():
+    global _redis_pool
+    if _redis_pool is not None:
+        await _redis_pool.disconnect()
+        _redis_pool = None
+
+def get_redis_pool_stats():
+    return _redis_pool.stats() if _redis_pool is not None else None
 
 def get_redis():
-    return Redis(host=Config.REDIS_HOST, port=Config.REDIS_PORT)
+    # Clients share the process-wide pool (created on first use outside of the app lifespan),
+    # closing a client doesn't close its connections, they go back to the pool
+    return Redis(connection_pool=init_redis_pool())
 
 # VECTORS
-async def create_vector_index(rdb):
-    schema = (
-        TextField('$.chunk_id', no_stem=True, as_name='chunk_id'),
-        TextField('$.text', as_name='text'),
-        TextField('$.doc_name', as_name='doc_name'),
+def vector_field_attributes(algorithm=Config.VECTOR_INDEX_ALGORITHM):
+    attributes = {
+        'TYPE': 'FLOAT32',
+        'DIM': Config.EMBEDDING_DIMENSIONS,
+        'DISTANCE_METRIC': 'COSINE'
+    }
+    if Config.VECTOR_INDEX_INITIAL_CAP:
+        attributes['INITIAL_CAP'] = Config.VECTOR_INDEX_INITIAL_CAP
+    if algorithm == 'HNSW':
+        attributes['M'] = Config.HNSW_M
+        attributes['EF_CONSTRUCTION'] = Config.HNSW_EF_CONSTRUCTION
+        attributes['EF_RUNTIME'] = Config.HNSW_EF_RUNTIME
+    elif algorithm != 'FLAT':
+        raise ValueError(f"Unsupported vector index algorithm '{algorithm}', expected FLAT or HNSW")
+    return attributes
+
+def vector_index_schema(algorithm, storage):
+    # HASH fields are indexed by name, JSON fields by path
+    path = (lambda name: name) if storage == 'hash' else (lambda name: f'$.{name}')
+    return (
+        TextField(path('chunk_id'), no_stem=True, as_name='chunk_id'),
+        TextField(path('text'), as_name='text'),
+        TextField(path('doc_name'), as_name='doc_name'),
+        # Exact document names, for filtering searches to some documents
+        TagField(path('doc_name'), separator='|', as_name='doc_tag'),
         VectorField(
-            '$.vector',
-            'FLAT',
-            {
-                'TYPE': 'FLOAT32',
-                'DIM': Config.EMBEDDING_DIMENSIONS,
-                'DISTANCE_METRIC': 'COSINE'
-            },
+            path('vector'),
+            algorithm,
+            vector_field_attributes(algorithm),
             as_name='vector'
         )
     )
+
+async def create_vector_index(rdb, index_name=VECTOR_IDX_NAME, algorithm=Config.VECTOR_INDEX_ALGORITHM,
+                              storage=Config.VECTOR_STORAGE, prefix=VECTOR_IDX_PREFIX):
+    index_type = IndexType.HASH if storage == 'hash' else IndexType.JSON
     try:
-        await rdb.ft(VECTOR_IDX_NAME).create_index(
-            fields=schema,
-            definition=IndexDefinition(prefix=[VECTOR_IDX_PREFIX], index_type=IndexType.JSON)
+        await rdb.ft(index_name).create_index(
+            fields=vector_index_schema(algorithm, storage),
+            definition=IndexDefinition(prefix=[prefix], index_type=index_type)
         )
-        print(f"Vector index '{VECTOR_IDX_NAME}' created successfully")
+        print(f"Vector index '{index_name}' ({algorithm}, {storage}) created successfully")
     except Exception as e:
-        print(f"Error creating vector index '{VECTOR_IDX_NAME}': {e}")
+        print(f"Error creating vector index '{index_name}': {e}")
+
+async def resolve_vector_index(rdb):
+    # VECTOR_IDX_NAME is either the index itself or, once it has been migrated, an alias to it
+    info = await rdb.ft(VECTOR_IDX_NAME).info()
+    return info['index_name']
+
+async def wait_for_indexing(rdb, index_name, poll_interval=1.0):
+    while True:
+        info = await rdb.ft(index_name).info()
+        if int(info['indexing']) == 0:
+            return info
+        print(f"Indexing '{index_name}': {float(info['percent_indexed']) * 100:.1f}%")
+        await asyncio.sleep(poll_interval)
+
+async def swap_vector_index(rdb, old_index, new_index):
+    # Indexes created before aliases were used are named VECTOR_IDX_NAME themselves, so the old
+    # index has to be dropped before the alias can take its name, otherwise the swap is atomic
+    if old_index == VECTOR_IDX_NAME:
+        await rdb.ft(old_index).dropindex(delete_documents=False)
+        await rdb.ft(new_index).aliasadd(VECTOR_IDX_NAME)
+    else:
+        await rdb.ft(new_index).aliasupdate(VECTOR_IDX_NAME)
+        await rdb.ft(old_index).dropindex(delete_documents=False)
+    print(f"Alias '{VECTOR_IDX_NAME}' now points to '{new_index}', dropped '{old_index}'")
+
+async def migrate_vector_index(rdb, algorithm=Config.VECTOR_INDEX_ALGORITHM):
+    """Rebuild the vector index with the current settings without downtime.
+
+    A new index is built next to the current one over the same documents, and once it has
+    finished indexing the VECTOR_IDX_NAME alias is switched to it and the old index dropped
+    (its documents are kept). Searches keep hitting the old index until the swap. Indexes
+    created before aliases were used are named VECTOR_IDX_NAME themselves, so the first
+    migration has to drop the old index before the alias can take its name, leaving a short
+    window where searches fail.
+    """
+    old_index = await resolve_vector_index(rdb)
+    new_index = f'{VECTOR_IDX_NAME}:{int(time())}'
+    await create_vector_index(rdb, index_name=new_index, algorithm=algorithm)
+    info = await wait_for_indexing(rdb, new_index)
+    print(f"Vector index '{new_index}' built with {info['num_docs']} documents")
+    await swap_vector_index(rdb, old_index, new_index)
+    return new_index
+
+async def convert_chunks(rdb, keys, storage):
+    async with rdb.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.type(key)
+        key_types = await pipe.execute()
+    # SCAN may return a key that was already converted, so only convert keys of the other type
+    source_type = b'ReJSON-RL' if storage == 'hash' else b'hash'
+    keys = [key for key, key_type in zip(keys, key_types) if key_type == source_type]
+    if not keys:
+        return 0
 
-async def add_chunks_to_vector_db(rdb, chunks):
+    async with rdb.pipeline(transaction=False) as pipe:
+        for key in keys:
+            if storage == 'hash':
+                pipe.json().get(key)
+            else:
+                pipe.hgetall(key)
+        chunks = await pipe.execute()
+
+    async with rdb.pipeline(transaction=True) as pipe:
+        for key, chunk in zip(keys, chunks):
+            pipe.delete(key)
+            if storage == 'hash':
+                pipe.hset(key, mapping=chunk_to_hash(chunk))
+            else:
+                pipe.json().set(key, Path.root_path(), chunk_from_hash(chunk))
+        await pipe.execute()
+    return len(keys)
+
+async def migrate_vector_storage(rdb, storage, batch_size=500):
+    """Convert every chunk to the given storage ('json' or 'hash') and index it with a new index.
+
+    The new index is created first over the same prefix; chunks are then converted in batches
+    (each key is deleted and rewritten in a single transaction), moving from the old index to
+    the new one, and the VECTOR_IDX_NAME alias is switched once every chunk is converted.
+    Searches return partial results while the conversion runs.
+    """
+    old_index = await resolve_vector_index(rdb)
+    new_index = f'{VECTOR_IDX_NAME}:{int(time())}'
+    await create_vector_index(rdb, index_name=new_index, storage=storage)
+
+    converted = 0
+    keys = []
+    async for key in rdb.scan_iter(match=f'{VECTOR_IDX_PREFIX}*', count=batch_size):
+        keys.append(key)
+        if len(keys) >= batch_size:
+            converted += await convert_chunks(rdb, keys, storage)
+            keys = []
+            print(f'Converted {converted} chunks')
+    converted += await convert_chunks(rdb, keys, storage)
+    print(f'Converted {converted} chunks to {storage}')
+
+    info = await wait_for_indexing(rdb, new_index)
+    print(f"Vector index '{new_index}' built with {info['num_docs']} documents")
+    await swap_vector_index(rdb, old_index, new_index)
+    print(f"Set VECTOR_STORAGE={storage} before restarting the application and the loader")
+    return new_index
+
+def chunk_to_hash(chunk):
+    fields = {k: v for k, v in chunk.items() if k != 'vector' and v is not None}
+    fields['vector'] = np.array(chunk['vector'], dtype=np.float32).tobytes()
+    return fields
+
+# Chunk fields that are stored as strings in HASH keys but are integers in the chunk
+INT_CHUNK_FIELDS = ('page', 'start', 'end')
+
+def chunk_from_hash(fields):
+    chunk = {k.decode(): v.decode() for k, v in fields.items() if k != b'vector'}
+    for field in INT_CHUNK_FIELDS:
+        if field in chunk:
+            chunk[field] = int(chunk[field])
+    chunk['vector'] = np.frombuffer(fields[b'vector'], dtype=np.float32).tolist()
+    return chunk
+
+def use_local_vector_store():
+    return Config.VECTOR_SEARCH_BACKEND == 'local'
+
+async def add_chunks_to_vector_db(rdb, chunks, storage=Config.VECTOR_STORAGE, prefix=VECTOR_IDX_PREFIX):
+    if use_local_vector_store():
+        return await asyncio.to_thread(local_vector_store.add_chunks, chunks)
     async with rdb.pipeline(transaction=True) as pipe:
         for chunk in chunks:
-            pipe.json().set(VECTOR_IDX_PREFIX + chunk['chunk_id'], Path.root_path(), chunk)
+            if storage == 'hash':
+                pipe.hset(prefix + chunk['chunk_id'], mapping=chunk_to_hash(chunk))
+            else:
+                pipe.json().set(prefix + chunk['chunk_id'], Path.root_path(), chunk)
         await pipe.execute()
 
-async def search_vector_db(rdb, query_vector, top_k=Config.VECTOR_SEARCH_TOP_K):
-    query = (
-        Query(f'(*)=>[KNN {top_k} @vector $query_vector AS score]')
-        .sort_by('score')
-        .return_fields('score', 'chunk_id', 'text', 'doc_name')
-        .dialect(2)
-    )
-    res = await rdb.ft(VECTOR_IDX_NAME).search(query, {
-        'query_vector': np.array(query_vector, dtype=np.float32).tobytes()
-    })
-    return [{
-        'score': 1 - float(d.score),
+async def update_chunk_positions(rdb, chunks, storage=Config.VECTOR_STORAGE, prefix=VECTOR_IDX_PREFIX):
+    """Rewrite the page, start and end of stored chunks, which move whenever text is inserted
+    or removed before them, without touching their text or vectors"""
+    if not chunks:
+        return
+    if use_local_vector_store():
+        return await asyncio.to_thread(local_vector_store.update_positions, chunks)
+    async with rdb.pipeline(transaction=True) as pipe:
+        for chunk in chunks:
+            positions = {field: chunk[field] for field in INT_CHUNK_FIELDS if chunk.get(field) is not None}
+            if storage == 'hash':
+                pipe.hset(prefix + chunk['chunk_id'], mapping=positions)
+            else:
+                for field, value in positions.items():
+                    pipe.json().set(prefix + chunk['chunk_id'], f'$.{field}', value)
+        await pipe.execute()
+
+async def existing_chunk_ids(rdb, chunk_ids):
+    """The subset of `chunk_ids` that are already stored"""
+    if not chunk_ids:
+        return set()
+    if use_local_vector_store():
+        return await asyncio.to_thread(local_vector_store.existing_ids, chunk_ids)
+    async with rdb.pipeline(transaction=False) as pipe:
+        for chunk_id in chunk_ids:
+            pipe.exists(VECTOR_IDX_PREFIX + chunk_id)
+        res = await pipe.execute()
+    return {chunk_id for chunk_id, exists in zip(chunk_ids, res) if exists}
+
+async def delete_chunks_from_vector_db(rdb, chunk_ids):
+    # The knowledge base version is bumped right after the chunks are gone, so that cached search
+    # results and answers that may include them are never served again
+    if not chunk_ids:
+        return
+    if use_local_vector_store():
+        await asyncio.to_thread(local_vector_store.delete_chunks, chunk_ids)
+        await bump_kb_version(rdb)
+        return
+    async with rdb.pipeline(transaction=True) as pipe:
+        pipe.delete(*[VECTOR_IDX_PREFIX + chunk_id for chunk_id in chunk_ids])
+        pipe.incr(KB_VERSION_KEY)
+        await pipe.execute()
+
+def escape_tag(value):
+    return re.sub(r'([^\w])', r'\\\1', value)
+
+def doc_filter(doc_names):
+    # Query clause restricting a search to the given documents ('*' matches every chunk)
+    if not doc_names:
+        return '*'
+    return '@doc_tag:{' + ' | '.join(escape_tag(doc_name) for doc_name in doc_names) + '}'
+
+def text_query_terms(text):
+    # Words of a natural language query, OR'ed for BM25 so any of them can match, without any
+    # query syntax; stopwords are dropped by RediSearch
+    return ' | '.join(dict.fromkeys(re.findall(r'\w+', text.lower())))
+
+def chunk_query(query_string, fields, storage):
+    query = Query(query_string).return_fields(*fields, 'chunk_id', 'text', 'doc_name').dialect(2)
+    # The position fields aren't indexed: returned by name from HASH keys, by path from JSON documents
+    for field in INT_CHUNK_FIELDS:
+        query.return_field(field if storage == 'hash' else f'$.{field}', as_field=field)
+    return query
+
+def chunk_from_doc(d, score):
+    return {
+        'score': score,
         'chunk_id': d.chunk_id,
         'text': d.text,
-        'doc_name': d.doc_name
-    } for d in res.docs]
+        'doc_name': d.doc_name,
+        # Chunks indexed before page and span tracking have none
+        **{field: int(getattr(d, field)) if getattr(d, field, None) else None for field in INT_CHUNK_FIELDS}
+    }
+
+async def search_vector_db(rdb, query_vector, top_k=Config.VECTOR_SEARCH_TOP_K, ef_runtime=None,
+                           index_name=VECTOR_IDX_NAME, storage=Config.VECTOR_STORAGE, doc_names=None):
+    """The `top_k` chunks closest to `query_vector`, only among chunks of `doc_names` if given"""
+    if use_local_vector_store():
+        return await asyncio.to_thread(local_vector_store.search, query_vector, top_k, doc_names)
+    # ef_runtime overrides the HNSW index's EF_RUNTIME for this query (it isn't valid for FLAT indexes)
+    knn_params = f' EF_RUNTIME {int(ef_runtime)}' if ef_runtime and Config.VECTOR_INDEX_ALGORITHM == 'HNSW' else ''
+    query = chunk_query(
+        f'({doc_filter(doc_names)})=>[KNN {top_k} @vector $query_vector{knn_params} AS score]', ['score'], storage
+    ).sort_by('score').paging(0, top_k)
+    res = await rdb.ft(index_name).search(query, {
+        'query_vector': np.array(query_vector, dtype=np.float32).tobytes()
+    })
+    return [chunk_from_doc(d, 1 - float(d.score)) for d in res.docs]
+
+async def search_text_db(rdb, query_text, top_k=Config.VECTOR_SEARCH_TOP_K, index_name=VECTOR_IDX_NAME,
+                         storage=Config.VECTOR_STORAGE, doc_names=None):
+    """The `top_k` chunks matching the words of `query_text` best by BM25, only among chunks of
+    `doc_names` if given. The local vector store has no full-text index and returns nothing."""
+    terms = text_query_terms(query_text)
+    if use_local_vector_store() or not terms:
+        return []
+    filter_clause = '' if not doc_names else f' {doc_filter(doc_names)}'
+    query = chunk_query(f'@text:({terms}){filter_clause}', [], storage).scorer('BM25').with_scores().paging(0, top_k)
+    res = await rdb.ft(index_name).search(query)
+    return [chunk_from_doc(d, float(d.score)) for d in res.docs]
+
+async def search_many_vector_db(rdb, query_vectors, top_k=Config.VECTOR_SEARCH_TOP_K):
+    # Batched queries (e.g. for evaluations): one matmul with the local store, concurrent KNN queries with Redis
+    if use_local_vector_store():
+        return await asyncio.to_thread(local_vector_store.search_many, query_vectors, top_k)
+    return await asyncio.gather(*[search_vector_db(rdb, v, top_k=top_k) for v in query_vectors])
+
+async def iter_all_vectors(rdb, page_size=Config.REDIS_PAGE_SIZE, storage=Config.VECTOR_STORAGE):
+    """Yield every stored chunk, reading `page_size` keys per SCAN/pipeline round trip"""
+    if use_local_vector_store():
+        for chunk in local_vector_store.iter_all():
+            yield chunk
+        return
+
+    async def read_page(keys):
+        async with rdb.pipeline(transaction=False) as pipe:
+            for key in keys:
+                if storage == 'hash':
+                    pipe.hgetall(key)
+                else:
+                    pipe.json().get(key)
+            res = await pipe.execute()
+        # Keys deleted between SCAN and the read come back empty
+        if storage == 'hash':
+            return [chunk_from_hash(fields) for fields in res if fields]
+        return [chunk for chunk in res if chunk]
+
+    keys = []
+    async for key in rdb.scan_iter(match=f'{VECTOR_IDX_PREFIX}*', count=page_size):
+        keys.append(key)
+        if len(keys) >= page_size:
+            for chunk in await read_page(keys):
+                yield chunk
+            keys = []
+    if keys:
+        for chunk in await read_page(keys):
+            yield chunk
+
+async def get_all_vectors(rdb, storage=Config.VECTOR_STORAGE):
+    return [chunk async for chunk in iter_all_vectors(rdb, storage=storage)]
 
-async def get_all_vectors(rdb):
-    count = await rdb.ft(VECTOR_IDX_NAME).search(Query('*').paging(0, 0))
-    res = await rdb.ft(VECTOR_IDX_NAME).search(Query('*').paging(0, count.total))
-    return [json.loads(doc.json) for doc in res.docs]
+
+# MANIFEST
+# Hash of doc_name -> {'file_hash': ..., 'settings': ..., 'chunks': {chunk_id: chunk_hash}}
+# used by the loader to re-index only the documents that changed since the last run
+async def get_manifest(rdb):
+    entries = await rdb.hgetall(MANIFEST_KEY)
+    return {doc_name.decode(): json.loads(entry) for doc_name, entry in entries.items()}
+
+async def get_manifest_doc_names(rdb):
+    return [doc_name.decode() for doc_name in await rdb.hkeys(MANIFEST_KEY)]
+
+async def set_manifest_entry(rdb, doc_name, entry):
+    await rdb.hset(MANIFEST_KEY, doc_name, json.dumps(entry))
+
+async def delete_manifest_entry(rdb, doc_name):
+    await rdb.hdel(MANIFEST_KEY, doc_name)
+
+async def get_kb_version(rdb):
+    return int(await rdb.get(KB_VERSION_KEY) or 0)
+
+async def bump_kb_version(rdb):
+    return await rdb.incr(KB_VERSION_KEY)
 
 
 # CHATS
@@ -85,43 +446,153 @@ async def create_chat_index(rdb):
         print(f"Error creating chat index '{CHAT_IDX_NAME}': {e}")
 
 async def create_chat(rdb, chat_id, created):
-    chat = {'id': chat_id, 'created': created, 'messages': []}
+    chat = {'id': chat_id, 'created': created}
     await rdb.json().set(CHAT_IDX_PREFIX + chat_id, Path.root_path(), chat)
     return chat
 
-async def add_chat_messages(rdb, chat_id, messages):
-    await rdb.json().arrappend(CHAT_IDX_PREFIX + chat_id, '$.messages', *messages)
+async def archive_chat_messages(rdb, chat_id, count, archive=Config.CHAT_ARCHIVE):
+    """Trim the `count` oldest messages of a chat, keeping them compressed in its archive"""
+    messages = await rdb.lpop(CHAT_MESSAGES_PREFIX + chat_id, count)
+    if messages and archive:
+        batch = zlib.compress(b'[' + b','.join(messages) + b']')
+        await rdb.rpush(CHAT_ARCHIVE_PREFIX + chat_id, batch)
+
+async def add_chat_messages(rdb, chat_id, messages, max_messages=Config.CHAT_MAX_MESSAGES):
+    # O(1) appends; beyond `max_messages` (0 = no limit) the oldest messages are trimmed
+    length = await rdb.rpush(CHAT_MESSAGES_PREFIX + chat_id, *[json.dumps(m) for m in messages])
+    if max_messages and length > max_messages:
+        await archive_chat_messages(rdb, chat_id, length - max_messages)
 
 async def chat_exists(rdb, chat_id):
     return await rdb.exists(CHAT_IDX_PREFIX + chat_id)
 
+async def get_archived_chat_messages(rdb, chat_id):
+    batches = await rdb.lrange(CHAT_ARCHIVE_PREFIX + chat_id, 0, -1)
+    return [m for batch in batches for m in json.loads(zlib.decompress(batch))]
+
 async def get_chat_messages(rdb, chat_id, last_n=None):
-    if last_n is None:
-        messages = await rdb.json().get(CHAT_IDX_PREFIX + chat_id, '$.messages[*]')
-    else:
-        messages = await rdb.json().get(CHAT_IDX_PREFIX + chat_id, f'$.messages[-{last_n}:]')
-    return [{'role': m['role'], 'content': m['content']} for m in messages] if messages else []
+    # The last messages are read from the list only, archived messages are for exports
+    start = -last_n if last_n else 0
+    messages = await rdb.lrange(CHAT_MESSAGES_PREFIX + chat_id, start, -1)
+    return [{'role': m['role'], 'content': m['content']} for m in map(json.loads, messages)]
+
+async def read_chats(rdb, keys):
+    """Chats (metadata with every message, archived ones included) of the given chat keys"""
+    chat_ids = [(key.decode() if isinstance(key, bytes) else key)[len(CHAT_IDX_PREFIX):] for key in keys]
+    async with rdb.pipeline(transaction=False) as pipe:
+        for chat_id in chat_ids:
+            pipe.json().get(CHAT_IDX_PREFIX + chat_id)
+            pipe.lrange(CHAT_ARCHIVE_PREFIX + chat_id, 0, -1)
+            pipe.lrange(CHAT_MESSAGES_PREFIX + chat_id, 0, -1)
+        res = await pipe.execute()
+    chats = []
+    for chat, archive, messages in zip(res[::3], res[1::3], res[2::3]):
+        # Chats deleted between listing and reading come back empty
+        if chat:
+            chat['messages'] = [
+                *(m for batch in archive for m in json.loads(zlib.decompress(batch))),
+                *map(json.loads, messages)
+            ]
+            chats.append(chat)
+    return chats
 
 async def get_chat(rdb, chat_id):
-    return await rdb.json().get(chat_id)
+    chats = await read_chats(rdb, [CHAT_IDX_PREFIX + chat_id])
+    return chats[0] if chats else None
+
+async def iter_all_chats(rdb, page_size=Config.REDIS_PAGE_SIZE):
+    """Yield every chat, newest first, reading `page_size` chats per round trip with an FT.AGGREGATE cursor"""
+    count = await rdb.ft(CHAT_IDX_NAME).search(Query('*').paging(0, 0))
+    if not count.total:
+        return
+    # Without MAX, SORTBY only sorts the first 10 results
+    request = (
+        AggregateRequest('*')
+        .load('@__key')
+        .sort_by(Desc('@created'), max=count.total)
+        .cursor(count=page_size)
+    )
+    res = await rdb.ft(CHAT_IDX_NAME).aggregate(request)
+    while True:
+        keys = [dict(zip(row[::2], row[1::2]))[b'__key'] for row in res.rows]
+        if keys:
+            for chat in await read_chats(rdb, keys):
+                yield chat
+        if not res.cursor or res.cursor.cid == 0:
+            break
+        cursor = Cursor(res.cursor.cid)
+        cursor.count = page_size
+        res = await rdb.ft(CHAT_IDX_NAME).aggregate(cursor)
 
 async def get_all_chats(rdb):
-    q = Query('*').sort_by('created', asc=False)
-    count = await rdb.ft(CHAT_IDX_NAME).search(q.paging(0, 0))
-    res = await rdb.ft(CHAT_IDX_NAME).search(q.paging(0, count.total))
-    return [json.loads(doc.json) for doc in res.docs]
+    return [chat async for chat in iter_all_chats(rdb)]
+
+async def migrate_chat_messages(rdb, page_size=Config.REDIS_PAGE_SIZE):
+    """Move the messages of chats stored as one JSON document with a `messages` array to the
+    chat's message list. Each chat is converted in one transaction, so the migration can be
+    interrupted and run again."""
+    migrated = 0
+    async for key in rdb.scan_iter(match=f'{CHAT_IDX_PREFIX}*', count=page_size):
+        messages = await rdb.json().get(key, '$.messages')
+        if not messages:
+            continue
+        chat_id = key.decode()[len(CHAT_IDX_PREFIX):]
+        legacy = [json.dumps(m) for m in messages[0]]
+        archived = await rdb.exists(CHAT_ARCHIVE_PREFIX + chat_id)
+        async with rdb.pipeline(transaction=True) as pipe:
+            # The legacy messages are older than any message added since the deploy: they go before
+            # the chat's message list, or before its archive once newer messages were trimmed
+            if legacy and archived:
+                pipe.lpush(CHAT_ARCHIVE_PREFIX + chat_id, zlib.compress(('[' + ','.join(legacy) + ']').encode()))
+            elif legacy:
+                pipe.lpush(CHAT_MESSAGES_PREFIX + chat_id, *reversed(legacy))
+            pipe.llen(CHAT_MESSAGES_PREFIX + chat_id)
+            pipe.json().delete(key, '$.messages')
+            length, _ = (await pipe.execute())[-2:]
+        migrated += 1
+        if Config.CHAT_MAX_MESSAGES and length > Config.CHAT_MAX_MESSAGES:
+            await archive_chat_messages(rdb, chat_id, length - Config.CHAT_MAX_MESSAGES)
+    print(f'Migrated the messages of {migrated} chats')
+    return migrated
+
+async def delete_keys(rdb, pattern, page_size=Config.REDIS_PAGE_SIZE):
+    keys = []
+    async for key in rdb.scan_iter(match=pattern, count=page_size):
+        keys.append(key)
+        if len(keys) >= page_size:
+            await rdb.delete(*keys)
+            keys = []
+    if keys:
+        await rdb.delete(*keys)
 
 
 # GENERAL
-async def setup_db(rdb):
-    # Create the vector index (deleting the existing one if present)
-    try:
-        await rdb.ft(VECTOR_IDX_NAME).dropindex(delete_documents=True)
-        print(f"Deleted vector index '{VECTOR_IDX_NAME}' and all associated documents")
-    except Exception as e:
-        pass
-    finally:
-        await create_vector_index(rdb)
+async def setup_db(rdb, rebuild=False):
+    # Drop the vector index, its documents and the manifest only when a full rebuild is requested
+    # (or when the index predates the incremental loader), otherwise the loader updates it
+    # incrementally. The layout marker, not the manifest, tells: an interrupted first run has
+    # stored batches but no manifest yet, and an emptied corpus has an empty manifest
+    legacy = not await rdb.exists(KB_LAYOUT_KEY, MANIFEST_KEY)
+    if rebuild or legacy:
+        if use_local_vector_store():
+            await asyncio.to_thread(local_vector_store.clear)
+        else:
+            try:
+                index_name = await resolve_vector_index(rdb)
+                await rdb.ft(index_name).dropindex(delete_documents=True)
+                print(f"Deleted vector index '{index_name}' and all associated documents")
+            except Exception as e:
+                pass
+        await rdb.delete(MANIFEST_KEY)
+        await bump_kb_version(rdb)
+    await rdb.set(KB_LAYOUT_KEY, KB_LAYOUT_VERSION)
+
+    # Make sure that the vector index exists, and create it if it doesn't
+    if not use_local_vector_store():
+        try:
+            await rdb.ft(VECTOR_IDX_NAME).info()
+        except Exception:
+            await create_vector_index(rdb)
 
     # Make sure that the chat index exists, and create it if it doesn't
     try:
@@ -132,7 +603,13 @@ async def setup_db(rdb):
 async def clear_db(rdb):
     for index_name in [VECTOR_IDX_NAME, CHAT_IDX_NAME]:
         try:
+            if index_name == VECTOR_IDX_NAME:
+                index_name = await resolve_vector_index(rdb)
             await rdb.ft(index_name).dropindex(delete_documents=True)
             print(f"Deleted index '{index_name}' and all associated documents")
         except Exception as e:
             print(f"Index '{index_name}': {e}")
+    for prefix in [CHAT_MESSAGES_PREFIX, CHAT_ARCHIVE_PREFIX]:
+        await delete_keys(rdb, f'{prefix}*')
+    await rdb.delete(MANIFEST_KEY, KB_LAYOUT_KEY)
+    await bump_kb_version(rdb)
@@ -0,0 +1,175 @@
+import asyncio
+import random
+import logging
+from contextlib import asynccontextmanager
+from time import monotonic
+from openai import APIConnectionError, APIStatusError, RateLimitError
+from app.openaiutils import client, get_embeddings
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+class BatchPacker:
+    """Packs items into batches of at most `max_tokens` tokens and `max_items` items.
+    An item larger than `max_tokens` on its own gets a batch to itself."""
+    def __init__(self, max_tokens=Config.EMBEDDING_BATCH_TOKENS, max_items=Config.EMBEDDING_BATCH_SIZE):
+        self.max_tokens = max_tokens
+        self.max_items = max_items
+        self.items = []
+        self.tokens = 0
+
+    def is_full(self, tokens):
+        """Whether an item of `tokens` tokens doesn't fit in the current batch"""
+        return bool(self.items) and (self.tokens + tokens > self.max_tokens or len(self.items) >= self.max_items)
+
+    def add(self, item, tokens):
+        self.items.append(item)
+        self.tokens += tokens
+
+    def take(self):
+        items = self.items
+        self.items = []
+        self.tokens = 0
+        return items
+
+def pack_batches(items, sizes, max_tokens=Config.EMBEDDING_BATCH_TOKENS, max_items=Config.EMBEDDING_BATCH_SIZE):
+    packer = BatchPacker(max_tokens, max_items)
+    for item, size in zip(items, sizes):
+        if packer.is_full(size):
+            yield packer.take()
+        packer.add(item, size)
+    if packer.items:
+        yield packer.take()
+
+class AdaptiveLimiter:
+    """Concurrency limit that adapts to rate limiting (additive increase, multiplicative decrease).
+
+    The limit halves on every rate-limited request and grows back by one after a full window of
+    successful requests, up to `max_concurrency`. A Retry-After delay pauses every new request
+    until it has passed, not only the one that was rate limited.
+    """
+    def __init__(self, max_concurrency=Config.EMBEDDING_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.resume_at = 0.0
+        self._successes = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            while True:
+                pause = self.resume_at - monotonic()
+                if pause > 0:
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), pause)
+                    except asyncio.TimeoutError:
+                        pass
+                elif self.in_flight < self.limit:
+                    break
+                else:
+                    await self._condition.wait()
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            await self.release()
+
+    def on_success(self):
+        self._successes += 1
+        if self._successes >= self.limit and self.limit < self.max_concurrency:
+            self.limit += 1
+            self._successes = 0
+
+    def on_rate_limit(self, retry_after=None):
+        self.limit = max(1, self.limit // 2)
+        self._successes = 0
+        if retry_after:
+            self.resume_at = max(self.resume_at, monotonic() + retry_after)
+
+def retry_after(error):
+    """The delay in seconds requested by a rate limited response, if any"""
+    headers = error.response.headers
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000
+        if 'retry-after' in headers:
+            return float(headers['retry-after'])
+    except ValueError:
+        # Retry-After can also be an HTTP date, we fall back to our own backoff then
+        pass
+    return None
+
+def is_retryable(error):
+    if isinstance(error, (RateLimitError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and (error.status_code >= 500 or error.status_code == 408)
+
+class EmbeddingBatcher:
+    """Calls the embeddings endpoint for the loader: retries failed requests with jittered
+    exponential backoff and keeps as many requests in flight as the rate limits allow.
+
+    The OpenAI client's own retries are disabled, so every rate limited response reaches the
+    limiter. A request that still fails after `max_retries` retries raises.
+    """
+    def __init__(self, client=client, concurrency=Config.EMBEDDING_CONCURRENCY,
+                 max_retries=Config.EMBEDDING_MAX_RETRIES, base_delay=Config.EMBEDDING_RETRY_BASE_DELAY,
+                 max_delay=Config.EMBEDDING_RETRY_MAX_DELAY):
+        self.client = client.with_options(max_retries=0)
+        self.limiter = AdaptiveLimiter(concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'rate_limited': self.rate_limited,
+            'concurrency': self.limiter.limit,
+        }
+
+    def backoff(self, attempt):
+        # Full jitter, so clients that failed together don't retry together
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def create_embeddings(self, input, model=Config.EMBEDDING_MODEL, dimensions=Config.EMBEDDING_DIMENSIONS):
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.limiter.slot():
+                    self.requests += 1
+                    res = await self.client.embeddings.create(input=input, model=model, dimensions=dimensions)
+                self.limiter.on_success()
+                return [d.embedding for d in res.data]
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    raise
+                delay = self.backoff(attempt)
+                if isinstance(e, RateLimitError):
+                    self.rate_limited += 1
+                    requested = retry_after(e)
+                    if requested is not None:
+                        delay = requested + random.uniform(0, self.base_delay)
+                    self.limiter.on_rate_limit(delay)
+                self.retries += 1
+                logger.warning(f'Embedding request failed ({e.__class__.__name__}), '
+                               f'retry {attempt + 1}/{self.max_retries} in {delay:.1f}s')
+                await asyncio.sleep(delay)
+
+    async def embed(self, texts, model=Config.EMBEDDING_MODEL, dimensions=Config.EMBEDDING_DIMENSIONS):
+        """Embeddings of `texts` through the embedding cache, creating the missing ones with retries.
+        Document chunks are stored with their vectors, so the created embeddings aren't kept in Redis."""
+        return await get_embeddings(texts, model=model, dimensions=dimensions,
+                                    create_embeddings=self.create_embeddings, persist=False)
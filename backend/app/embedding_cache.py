@@ -0,0 +1,114 @@
+import hashlib
+import logging
+import numpy as np
+from app.db import get_redis
+from app.utils.lru import LRUCache
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_PREFIX = 'embcache:'
+
+def normalize_text(text):
+    return ' '.join(text.split())
+
+def text_key(text):
+    return hashlib.sha256(normalize_text(text).encode()).hexdigest()
+
+class EmbeddingCache:
+    """Two-tier embedding cache: an in-process LRU in front of Redis.
+
+    Each embedding is stored in Redis under its own key, made of the model, the dimensions and
+    the sha256 of the normalized text, as the raw float32 bytes of the vector. Keys expire `ttl`
+    seconds after they were last used, so the Redis tier only holds embeddings still in demand.
+    Redis errors are logged and treated as misses, so the cache never breaks embedding calls.
+    """
+    def __init__(self, maxsize=Config.EMBEDDING_CACHE_SIZE, use_redis=Config.EMBEDDING_CACHE_REDIS,
+                 ttl=Config.EMBEDDING_CACHE_TTL):
+        self.memory = LRUCache(maxsize)
+        self.use_redis = use_redis
+        self.ttl = ttl
+        self.memory_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @property
+    def rdb(self):
+        return get_redis()
+
+    def stats(self):
+        lookups = self.memory_hits + self.redis_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'redis_hits': self.redis_hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'hit_rate': (self.memory_hits + self.redis_hits) / lookups if lookups else 0.0,
+            'memory_size': len(self.memory),
+        }
+
+    async def _redis_get(self, redis_keys):
+        try:
+            values = await self.rdb.mget(redis_keys)
+            # Hits are kept for another `ttl` seconds
+            hits = [key for key, value in zip(redis_keys, values) if value is not None]
+            if hits:
+                async with self.rdb.pipeline(transaction=False) as pipe:
+                    for key in hits:
+                        pipe.expire(key, self.ttl)
+                    await pipe.execute()
+            return values
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f'Embedding cache read failed: {e}')
+            return [None] * len(redis_keys)
+
+    async def _redis_set(self, mapping):
+        try:
+            async with self.rdb.pipeline(transaction=False) as pipe:
+                for key, value in mapping.items():
+                    pipe.set(key, value, ex=self.ttl)
+                await pipe.execute()
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f'Embedding cache write failed: {e}')
+
+    async def get_embeddings(self, texts, model, dimensions, create_embeddings, persist=True):
+        """Return the embeddings of `texts`, calling `create_embeddings(texts, model, dimensions)`
+        only for the texts found in neither tier (each distinct text is sent once). Created
+        embeddings are only written to Redis with `persist`."""
+        prefix = f'{EMBEDDING_CACHE_PREFIX}{model}:{dimensions}:'
+        keys = [text_key(text) for text in texts]
+        vectors = {}
+        for key in keys:
+            vector = self.memory.get((model, dimensions, key))
+            if vector is not None:
+                vectors[key] = vector
+        self.memory_hits += sum(1 for key in keys if key in vectors)
+
+        missing = list(dict.fromkeys(key for key in keys if key not in vectors))
+        if missing and self.use_redis:
+            for key, value in zip(missing, await self._redis_get([prefix + key for key in missing])):
+                if value is not None:
+                    vectors[key] = np.frombuffer(value, dtype=np.float32)
+                    self.memory.set((model, dimensions, key), vectors[key])
+            found = {key for key in missing if key in vectors}
+            self.redis_hits += sum(1 for key in keys if key in found)
+            missing = [key for key in missing if key not in found]
+
+        if missing:
+            missing_set = set(missing)
+            self.misses += sum(1 for key in keys if key in missing_set)
+            texts_by_key = dict(zip(keys, texts))
+            created = await create_embeddings([texts_by_key[key] for key in missing], model, dimensions)
+            for key, embedding in zip(missing, created):
+                vectors[key] = np.array(embedding, dtype=np.float32)
+                self.memory.set((model, dimensions, key), vectors[key])
+            if self.use_redis and persist:
+                await self._redis_set({prefix + key: vectors[key].tobytes() for key in missing})
+
+        return [vectors[key].tolist() for key in keys]
+
+
+embedding_cache = EmbeddingCache()
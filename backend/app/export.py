@@ -1,27 +1,31 @@
 import os
-import json
 import asyncio
 from datetime import datetime, UTC
-from app.db import get_redis, get_all_chats
+from app.db import get_redis, close_redis_pool, iter_all_chats
+from app.utils.json_writer import JSONArrayWriter
 from app.config import Config
 
 async def export_chats(export_dir=Config.EXPORT_DIR, iso_format=True):
     print('Exporting chats to JSON')
     file_path = os.path.join(export_dir, 'chats.json')
+    # Chats are streamed from Redis page by page and written as they arrive, into a temporary
+    # file that replaces the previous export only once it is complete
+    tmp_path = file_path + '.tmp'
     async with get_redis() as rdb:
-        chats = await get_all_chats(rdb)
-        if iso_format:
-            for chat in chats:
-                chat['created'] = datetime.fromtimestamp(chat['created'], tz=UTC).isoformat()
-                for message in chat['messages']:
-                    message['created'] = datetime.fromtimestamp(message['created'], tz=UTC).isoformat()
-        with open(file_path, 'w') as file:
-            json.dump(chats, file, indent=2)
-    print(f'{len(chats)} chats exported')
+        with open(tmp_path, 'w') as file, JSONArrayWriter(file) as writer:
+            async for chat in iter_all_chats(rdb):
+                if iso_format:
+                    chat['created'] = datetime.fromtimestamp(chat['created'], tz=UTC).isoformat()
+                    for message in chat['messages']:
+                        message['created'] = datetime.fromtimestamp(message['created'], tz=UTC).isoformat()
+                writer.write(chat)
+    await close_redis_pool()
+    os.replace(tmp_path, file_path)
+    print(f'{writer.count} chats exported')
 
 def main():
     asyncio.run(export_chats())
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,145 @@
+import signal
+import logging
+from bisect import bisect_right
+from contextlib import contextmanager
+from time import monotonic
+from pdfminer.high_level import extract_pages
+from pdfminer.layout import LTTextContainer
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+# Bump when the extracted text or chunk metadata changes, so the loader re-indexes every document
+EXTRACTOR_VERSION = 2
+
+class ExtractionTimeout(Exception):
+    pass
+
+@contextmanager
+def time_limit(seconds):
+    """Raise ExtractionTimeout after `seconds`, even in the middle of parsing a page. Needs SIGALRM
+    and the main thread (pool workers run their tasks there), otherwise it is a no-op."""
+    if not seconds:
+        yield
+        return
+    try:
+        previous = signal.signal(signal.SIGALRM, _raise_timeout)
+    except (AttributeError, ValueError):
+        yield
+        return
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+def _raise_timeout(signum, frame):
+    raise ExtractionTimeout()
+
+def page_text(page):
+    # Text boxes end with a newline, so the newline added at the end of each page
+    # makes page breaks paragraph breaks for the splitter
+    return ''.join(element.get_text() for element in page if isinstance(element, LTTextContainer)) + '\n'
+
+class PageExtractor:
+    """Iterates over the pages of a PDF lazily, within a page and time budget.
+
+    `max_pages` and `time_budget` (seconds) of 0 mean no limit. When the budget runs out the
+    iteration stops early, and `truncated` tells the caller that the document is incomplete.
+    """
+    def __init__(self, file_path, max_pages=Config.EXTRACT_MAX_PAGES, time_budget=Config.EXTRACT_TIME_BUDGET):
+        self.file_path = file_path
+        self.max_pages = max_pages
+        self.time_budget = time_budget
+        self.truncated = False
+        self.pages = 0
+
+    def __iter__(self):
+        """Yield (page number, page text), page numbers starting at 1"""
+        deadline = monotonic() + self.time_budget if self.time_budget else None
+        # One page over the limit tells us whether the document was cut short
+        pages = iter(extract_pages(self.file_path, maxpages=self.max_pages + 1 if self.max_pages else 0))
+        while True:
+            remaining = deadline - monotonic() if deadline else None
+            if remaining is not None and remaining <= 0:
+                self.truncated = True
+                break
+            try:
+                # Only the parsing is timed, not the caller's work between pages
+                with time_limit(remaining):
+                    page = next(pages, None)
+            except ExtractionTimeout:
+                self.truncated = True
+                break
+            if page is None:
+                break
+            if self.max_pages and self.pages == self.max_pages:
+                self.truncated = True
+                break
+            self.pages += 1
+            yield page.pageid, page_text(page)
+        if self.truncated:
+            logger.warning(f'{self.file_path}: extraction budget exceeded, stopped after {self.pages} pages')
+
+class ChunkExtractor:
+    """Extracts and splits a PDF page by page, holding at most about `window_chars` of its text.
+
+    Iterating yields the chunks in parts, as they are produced: dicts with the chunk `text`, the
+    `page` it starts on, and its `start` and `end` character offsets in the document text (the
+    concatenated pages). Whenever the window fills up it is split, every chunk but the last is
+    yielded, and the text from the last chunk on is carried over to the next window. Once the
+    iteration is over, `truncated` tells whether the extraction budget cut the document short.
+    """
+    def __init__(self, file_path, text_splitter, window_chars=Config.EXTRACT_WINDOW_CHARS, **budget):
+        self.pages = PageExtractor(file_path, **budget)
+        self.text_splitter = text_splitter
+        self.window_chars = window_chars
+
+    @property
+    def truncated(self):
+        return self.pages.truncated
+
+    def __iter__(self):
+        page_starts = []
+        page_numbers = []
+        window = []
+        window_start = 0
+        window_size = 0
+
+        for page_number, text in self.pages:
+            page_starts.append(window_start + window_size)
+            page_numbers.append(page_number)
+            window.append(text)
+            window_size += len(text)
+            if window_size < self.window_chars:
+                continue
+            text = ''.join(window)
+            spans = self.text_splitter.split_spans(text)
+            # The last chunk may continue in the next pages
+            carry = spans[-1][0] if spans else len(text)
+            yield self._chunks(text, spans[:-1], window_start, page_starts, page_numbers)
+            window = [text[carry:]]
+            window_start += carry
+            window_size = len(text) - carry
+            # Pages that start before the window are only needed for the page of its first chunk
+            first = bisect_right(page_starts, window_start) - 1
+            del page_starts[:first], page_numbers[:first]
+
+        text = ''.join(window)
+        yield self._chunks(text, self.text_splitter.split_spans(text), window_start, page_starts, page_numbers)
+
+    @staticmethod
+    def _chunks(text, spans, window_start, page_starts, page_numbers):
+        return [{
+            'text': text[start:end],
+            'page': page_numbers[bisect_right(page_starts, window_start + start) - 1],
+            'start': window_start + start,
+            'end': window_start + end
+        } for start, end in spans]
+
+def extract_chunks(file_path, text_splitter, window_chars=Config.EXTRACT_WINDOW_CHARS, **budget):
+    """Every chunk of a PDF at once, and whether it was truncated (see ChunkExtractor)"""
+    extractor = ChunkExtractor(file_path, text_splitter, window_chars, **budget)
+    chunks = [chunk for part in extractor for chunk in part]
+    return chunks, extractor.truncated
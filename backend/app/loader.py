@@ -1,76 +1,297 @@
 import os
+import json
 import asyncio
-from uuid import uuid4
+import hashlib
+import tempfile
+from argparse import ArgumentParser
+from itertools import islice
 from tqdm import tqdm
-from pdfminer.high_level import extract_text
-from app.utils.splitter import TextSplitter
-from openaiutils import get_embeddings, token_size
-from app.db import get_redis, setup_db, add_chunks_to_vector_db
+from app.extractor import ChunkExtractor, EXTRACTOR_VERSION
+from app.utils.splitter import TextSplitter, get_worker_splitter
+from app.utils.token_utils import token_size
+from app.embedding_batcher import EmbeddingBatcher, BatchPacker
+from app.db import (
+    get_redis, close_redis_pool, setup_db, add_chunks_to_vector_db, delete_chunks_from_vector_db,
+    existing_chunk_ids, update_chunk_positions, get_manifest, set_manifest_entry, delete_manifest_entry,
+    bump_kb_version
+)
 from app.config import Config
 
-def batchify(iterable, batch_size):
-    for i in range(0, len(iterable), batch_size):
-        yield iterable[i:i+batch_size]
-
-async def process_docs(docs_dir=Config.DOCS_DIR):
-    docs = []
-    print('\nLoading documents')
-    pdf_files = [f for f in os.listdir(docs_dir) if f.endswith('.pdf')]
-    for filename in tqdm(pdf_files):
-        file_path = os.path.join(docs_dir, filename)
-        text = extract_text(file_path)
-        doc_name = os.path.splitext(filename)[0]
-        docs.append((doc_name, text))
-    print(f'Loaded {len(docs)} PDF documents')
-
-    chunks = []
-    text_splitter = TextSplitter(chunk_size=512, chunk_overlap=150)
-    print('\nSplitting documents into chunks')
-    for doc_name, doc_text in docs:
-        doc_id = str(uuid4())[:8]
-        doc_chunks = text_splitter.split(doc_text)
-        for chunk_idx, chunk_text in enumerate(doc_chunks):
-            chunk = {
-                'chunk_id': f'{doc_id}:{chunk_idx+1:04}',
-                'text': chunk_text,
-                'doc_name': doc_name,
-                'vector': None
-            }
-            chunks.append(chunk)
-        print(f'{doc_name}: {len(doc_chunks)} chunks')
-    chunk_sizes = [token_size(c['text']) for c in chunks]
-    print(f'\nTotal chunks: {len(chunks)}')
-    print(f'Min chunk size: {min(chunk_sizes)} tokens')
-    print(f'Max chunk size: {max(chunk_sizes)} tokens')
-    print(f'Average chunk size: {round(sum(chunk_sizes)/len(chunks))} tokens')
-
-    vectors = []
-    print('\nEmbedding chunks')
-    with tqdm(total=len(chunks)) as pbar:
-        for batch in batchify(chunks, batch_size=64):
-            batch_vectors = await get_embeddings([chunk['text'] for chunk in batch])
-            vectors.extend(batch_vectors)
-            pbar.update(len(batch))
-
-    for chunk, vector in zip(chunks, vectors):
+class ChunkStats:
+    """Running chunk size statistics, so we don't have to keep every chunk around to report them"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, size):
+        self.count += 1
+        self.total += size
+        self.min = size if self.min is None else min(self.min, size)
+        self.max = size if self.max is None else max(self.max, size)
+
+    def report(self):
+        print(f'\nTotal chunks: {self.count}')
+        if self.count:
+            print(f'Min chunk size: {self.min} tokens')
+            print(f'Max chunk size: {self.max} tokens')
+            print(f'Average chunk size: {round(self.total/self.count)} tokens')
+
+def extract_doc(file_path, spool_dir):
+    # Runs in a worker process of the splitter's pool. The chunks are written to a spool file as
+    # each extraction window is split, so neither process ever holds a whole document's chunks:
+    # only the spool file path is sent back to the main process
+    doc_name = os.path.splitext(os.path.basename(file_path))[0]
+    extractor = ChunkExtractor(file_path, get_worker_splitter())
+    fd, spool_path = tempfile.mkstemp(suffix='.jsonl', dir=spool_dir)
+    try:
+        with os.fdopen(fd, 'w') as spool:
+            for part in extractor:
+                spool.write(json.dumps(part) + '\n')
+    except BaseException:
+        os.unlink(spool_path)
+        raise
+    return doc_name, spool_path, extractor.truncated
+
+def read_spool(spool_path):
+    """The chunk lists written by extract_doc, one extraction window at a time; the spool file
+    is deleted once read"""
+    try:
+        with open(spool_path) as spool:
+            for line in spool:
+                yield json.loads(line)
+    finally:
+        os.unlink(spool_path)
+
+async def extract_docs(file_paths, text_splitter, spool_dir, workers=Config.LOADER_WORKERS,
+                       max_pending=Config.LOADER_MAX_PENDING_DOCS):
+    """Extract and split PDFs in a process pool and yield (doc_name, spool_path, truncated) in
+    completion order, the chunks being spooled in `spool_dir` (see read_spool). At most
+    `max_pending` documents are being processed or waiting to be consumed at any time."""
+    loop = asyncio.get_running_loop()
+    paths = iter(file_paths)
+    pending = {}
+    with text_splitter.executor(workers) as executor:
+        def submit(path):
+            pending[loop.run_in_executor(executor, extract_doc, path, spool_dir)] = path
+
+        for path in islice(paths, max_pending):
+            submit(path)
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    yield future.result()
+                except Exception as e:
+                    print(f'Error extracting {path}: {e}')
+                for next_path in islice(paths, 1):
+                    submit(next_path)
+
+def file_hash(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def text_hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def index_settings():
+    # Changing any of these invalidates the chunks/vectors of every document
+    return text_hash(json.dumps([
+        Config.CHUNK_SIZE, Config.CHUNK_OVERLAP, Config.EMBEDDING_MODEL, Config.EMBEDDING_DIMENSIONS,
+        EXTRACTOR_VERSION
+    ]))
+
+def make_chunks(doc_name, doc_chunks):
+    # Chunk IDs are derived from the document name and the chunk content, so an unchanged
+    # chunk keeps its ID (and its stored vector) across runs, wherever it moved in the document
+    doc_id = text_hash(doc_name)[:8]
+    chunks = {}
+    for chunk in doc_chunks:
+        chunk_hash = text_hash(chunk['text'])
+        chunk_id = f'{doc_id}:{chunk_hash[:16]}'
+        chunks.setdefault(chunk_id, {
+            'chunk_id': chunk_id,
+            'chunk_hash': chunk_hash,
+            'text': chunk['text'],
+            'doc_name': doc_name,
+            'page': chunk['page'],
+            'start': chunk['start'],
+            'end': chunk['end'],
+            'vector': None
+        })
+    return list(chunks.values())
+
+async def embed_and_store(rdb, batcher, batch):
+    vectors = await batcher.embed([chunk['text'] for chunk in batch])
+    for chunk, vector in zip(batch, vectors):
         chunk['vector'] = vector
-    return chunks
+        del chunk['chunk_hash']
+    await add_chunks_to_vector_db(rdb, batch)
+
+class PendingDoc:
+    """A document whose new chunks are being embedded. Its manifest entry is only written
+    (and its stale chunks only deleted) once it is sealed, with every chunk read, and every batch
+    holding one of its chunks is stored, so an interrupted run never records a document as
+    indexed when it isn't."""
+    def __init__(self, doc_name):
+        self.doc_name = doc_name
+        self.entry = None
+        self.stale_chunk_ids = []
+        self.pending_batches = 0
+        self.sealed = False
 
-async def load_knowledge_base():
+    def seal(self, entry, stale_chunk_ids):
+        self.entry = entry
+        self.stale_chunk_ids = stale_chunk_ids
+        self.sealed = True
+
+    async def finalize(self, rdb):
+        await delete_chunks_from_vector_db(rdb, self.stale_chunk_ids)
+        await set_manifest_entry(rdb, self.doc_name, self.entry)
+
+async def remove_deleted_docs(rdb, manifest, doc_names):
+    deleted = [doc_name for doc_name in manifest if doc_name not in doc_names]
+    for doc_name in deleted:
+        await delete_chunks_from_vector_db(rdb, list(manifest[doc_name]['chunks']))
+        await delete_manifest_entry(rdb, doc_name)
+        print(f'{doc_name}: removed')
+    return deleted
+
+async def process_docs(rdb, docs_dir=Config.DOCS_DIR, batcher=None, batch_tokens=Config.EMBEDDING_BATCH_TOKENS,
+                       batch_size=Config.EMBEDDING_BATCH_SIZE, concurrency=Config.EMBEDDING_CONCURRENCY):
+    """Incrementally index all PDFs in `docs_dir` as a streaming pipeline.
+
+    Documents whose content hash matches the manifest are skipped, and documents that no longer
+    exist have their chunks removed. Changed documents are extracted and split in a process pool;
+    only chunks that are not already stored are embedded, in batches of up to `batch_tokens`
+    tokens and `batch_size` chunks. At most `concurrency` batches are in flight, and the batcher
+    retries and slows down on rate limits. Batches are written to Redis as soon as their vectors
+    arrive, which checkpoints the run: chunks stored by an interrupted run are not embedded again.
+    Chunks are streamed from the workers one extraction window at a time, through a spool file
+    per document, so memory stays bounded by the extraction window and the in-flight batches, not
+    by the size of a document or of the corpus.
+    """
+    pdf_files = sorted(f for f in os.listdir(docs_dir) if f.endswith('.pdf'))
+    doc_paths = {os.path.splitext(f)[0]: os.path.join(docs_dir, f) for f in pdf_files}
+    manifest = await get_manifest(rdb)
+    settings = index_settings()
+
+    file_hashes = {}
+    for doc_name, path in doc_paths.items():
+        entry = manifest.get(doc_name)
+        digest = file_hash(path)
+        if not entry or entry['file_hash'] != digest or entry.get('settings') != settings:
+            file_hashes[path] = digest
+    changed = bool(file_hashes) or any(doc_name not in doc_paths for doc_name in manifest)
+    if changed:
+        # Before and after the changes, so answers cached while they are made are not reused either
+        # (every deletion bumps it as well, right away)
+        await bump_kb_version(rdb)
+    deleted = await remove_deleted_docs(rdb, manifest, doc_paths)
+    print(f'\n{len(pdf_files)} PDF documents: {len(file_hashes)} new or changed, '
+          f'{len(pdf_files) - len(file_hashes)} unchanged, {len(deleted)} removed')
+
+    text_splitter = TextSplitter(chunk_size=Config.CHUNK_SIZE, chunk_overlap=Config.CHUNK_OVERLAP)
+    stats = ChunkStats()
+    batcher = batcher or EmbeddingBatcher(concurrency=concurrency)
+    packer = BatchPacker(batch_tokens, batch_size)
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+
+    async def run_batch(batch, docs):
+        try:
+            await embed_and_store(rdb, batcher, batch)
+        finally:
+            semaphore.release()
+        for doc in docs:
+            doc.pending_batches -= 1
+            if doc.sealed and doc.pending_batches == 0:
+                await doc.finalize(rdb)
+
+    async def flush(batch, docs):
+        # Waits here while `concurrency` batches are in flight, which backpressures the extraction
+        await semaphore.acquire()
+        for task in [t for t in tasks if t.done()]:
+            tasks.discard(task)
+            task.result()
+        tasks.add(asyncio.create_task(run_batch(batch, docs)))
+
+    batch_docs = []
+    with tqdm(total=len(file_hashes)) as pbar, tempfile.TemporaryDirectory(prefix='loader-') as spool_dir:
+        async for doc_name, spool_path, truncated in extract_docs(list(file_hashes), text_splitter, spool_dir):
+            old_chunks = manifest.get(doc_name, {}).get('chunks', {})
+            doc = PendingDoc(doc_name)
+            # Only the IDs and hashes of the document's chunks are kept, for its manifest entry
+            doc_chunks = {}
+            new_count = stored_count = 0
+            for part in read_spool(spool_path):
+                part_chunks = [c for c in make_chunks(doc_name, part) if c['chunk_id'] not in doc_chunks]
+                stored = await existing_chunk_ids(rdb, [c['chunk_id'] for c in part_chunks])
+                new_chunks = [c for c in part_chunks if c['chunk_id'] not in stored]
+                # Chunks that are kept may have moved, e.g. when text was inserted before them:
+                # their page and offsets are rewritten, they aren't embedded again
+                await update_chunk_positions(rdb, [c for c in part_chunks if c['chunk_id'] in stored])
+                new_count += len(new_chunks)
+                stored_count += len(stored - old_chunks.keys())
+                sizes = {}
+                for chunk in part_chunks:
+                    doc_chunks[chunk['chunk_id']] = chunk['chunk_hash']
+                    sizes[chunk['chunk_id']] = token_size(chunk['text'])
+                    stats.add(sizes[chunk['chunk_id']])
+                for chunk in new_chunks:
+                    if packer.is_full(sizes[chunk['chunk_id']]):
+                        await flush(packer.take(), batch_docs)
+                        batch_docs = []
+                    if doc not in batch_docs:
+                        batch_docs.append(doc)
+                        doc.pending_batches += 1
+                    packer.add(chunk, sizes[chunk['chunk_id']])
+            doc.seal(
+                entry={
+                    'file_hash': file_hashes[doc_paths[doc_name]],
+                    'settings': settings,
+                    'chunks': doc_chunks
+                },
+                stale_chunk_ids=list(old_chunks.keys() - doc_chunks.keys())
+            )
+            if doc.pending_batches == 0:
+                await doc.finalize(rdb)
+            pbar.write(f'{doc_name}: {len(doc_chunks)} chunks, {new_count} new, '
+                       f'{stored_count} already stored, {len(doc.stale_chunk_ids)} removed'
+                       + (' (truncated by the extraction budget)' if truncated else ''))
+            pbar.update(1)
+        if packer.items:
+            await flush(packer.take(), batch_docs)
+        await asyncio.gather(*tasks)
+
+    if changed:
+        await bump_kb_version(rdb)
+    stats.report()
+    print(f'Embedding requests: {batcher.stats()}')
+    return stats
+
+async def load_knowledge_base(rebuild=False):
     print('Loading knowledge base')
     async with get_redis() as rdb:
         print('Setting up Redis database')
-        await setup_db(rdb)
-        chunks = await process_docs()
-        print('\nAdding chunks to vector db')
-        await add_chunks_to_vector_db(rdb, chunks)
+        await setup_db(rdb, rebuild=rebuild)
+        await process_docs(rdb)
         print('\nKnowledge base loaded')
+    await close_redis_pool()
 
 def main():
+    parser = ArgumentParser(description='Load the source documents into the knowledge base')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='drop the vector index and re-index every document from scratch')
+    args = parser.parse_args()
     print('Starting loader')
-    asyncio.run(load_knowledge_base())
+    asyncio.run(load_knowledge_base(rebuild=args.rebuild))
 
 
 if __name__ == '__main__':
-    print('Starting loader')
-    main()
\ No newline at end of file
+    main()
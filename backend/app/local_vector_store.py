@@ -0,0 +1,165 @@
+import os
+import json
+import tempfile
+import threading
+import numpy as np
+from app.config import Config
+
+VECTORS_FILE = 'vectors.npy'
+CHUNKS_FILE = 'chunks.json'
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+class LocalVectorStore:
+    """In-process vector store for single-node deployments and tests.
+
+    Chunk embeddings are kept pre-normalized in one contiguous float32 matrix, saved as a `.npy`
+    file and memory-mapped, with the chunk metadata in a JSON file in the same row order. Cosine
+    similarity is then a single matmul, and the top-k rows are selected with `argpartition`.
+    Writes rewrite both files (atomically, each), so they cost O(number of chunks) and loading N
+    chunks in batches costs O(N²) I/O: the store is meant for small knowledge bases. Writes are
+    serialized with a lock, since the loader stores several batches at once from worker threads,
+    and reads work on a consistent snapshot of the chunks and vectors. The files are re-mapped
+    whenever another process (e.g. the loader) has replaced them.
+    """
+    def __init__(self, path=Config.LOCAL_VECTOR_STORE_DIR, dimensions=Config.EMBEDDING_DIMENSIONS):
+        self.path = path
+        self.dimensions = dimensions
+        self.vectors = np.empty((0, dimensions), dtype=np.float32)
+        self.chunks = []
+        self._mtime = None
+        self._lock = threading.RLock()
+
+    @property
+    def vectors_path(self):
+        return os.path.join(self.path, VECTORS_FILE)
+
+    @property
+    def chunks_path(self):
+        return os.path.join(self.path, CHUNKS_FILE)
+
+    def _refresh(self):
+        """The current (chunks, vectors), re-read if the files changed"""
+        with self._lock:
+            try:
+                mtime = os.stat(self.vectors_path).st_mtime_ns
+            except FileNotFoundError:
+                return self.chunks, self.vectors
+            if mtime != self._mtime:
+                with open(self.chunks_path) as file:
+                    chunks = json.load(file)
+                vectors = np.load(self.vectors_path, mmap_mode='r')
+                if len(chunks) != len(vectors):
+                    raise ValueError(f'Local vector store {self.path} is inconsistent: '
+                                     f'{len(chunks)} chunks but {len(vectors)} vectors')
+                self.chunks, self.vectors, self._mtime = chunks, vectors, mtime
+            return self.chunks, self.vectors
+
+    def _replace(self, path, write):
+        # Written to a temporary file of its own, then moved into place atomically
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix=os.path.basename(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                write(file)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _save(self, vectors, chunks):
+        # Called with the lock held
+        os.makedirs(self.path, exist_ok=True)
+        # Metadata first: vectors.npy is what readers watch for changes
+        self._replace(self.chunks_path, lambda file: file.write(json.dumps(chunks).encode()))
+        self._replace(self.vectors_path, lambda file: np.save(file, np.ascontiguousarray(vectors, dtype=np.float32)))
+        self._mtime = None
+        self._refresh()
+
+    def __len__(self):
+        chunks, _ = self._refresh()
+        return len(chunks)
+
+    def add_chunks(self, chunks):
+        """Insert or replace chunks (dicts with chunk_id, text, doc_name, vector and optionally
+        page, start and end)"""
+        with self._lock:
+            stored, stored_vectors = self._refresh()
+            new_ids = {chunk['chunk_id'] for chunk in chunks}
+            keep = [i for i, chunk in enumerate(stored) if chunk['chunk_id'] not in new_ids]
+            metadata = [{k: v for k, v in chunk.items() if k != 'vector'} for chunk in chunks]
+            vectors = np.concatenate([stored_vectors[keep], normalize([chunk['vector'] for chunk in chunks])])
+            self._save(vectors, [stored[i] for i in keep] + metadata)
+
+    def delete_chunks(self, chunk_ids):
+        with self._lock:
+            stored, stored_vectors = self._refresh()
+            chunk_ids = set(chunk_ids)
+            keep = [i for i, chunk in enumerate(stored) if chunk['chunk_id'] not in chunk_ids]
+            if len(keep) < len(stored):
+                self._save(stored_vectors[keep], [stored[i] for i in keep])
+
+    def update_positions(self, chunks):
+        """Set the page, start and end of stored chunks (dicts with chunk_id and those fields),
+        leaving their vectors as they are"""
+        with self._lock:
+            stored, vectors = self._refresh()
+            positions = {
+                chunk['chunk_id']: {field: chunk[field] for field in ('page', 'start', 'end') if field in chunk}
+                for chunk in chunks
+            }
+            updated = [{**chunk, **positions.get(chunk['chunk_id'], {})} for chunk in stored]
+            if updated != stored:
+                self._save(vectors, updated)
+
+    def existing_ids(self, chunk_ids):
+        chunks, _ = self._refresh()
+        stored = {chunk['chunk_id'] for chunk in chunks}
+        return {chunk_id for chunk_id in chunk_ids if chunk_id in stored}
+
+    def clear(self):
+        with self._lock:
+            self._save(np.empty((0, self.dimensions), dtype=np.float32), [])
+
+    def iter_all(self):
+        chunks, vectors = self._refresh()
+        for chunk, vector in zip(chunks, vectors):
+            yield {**chunk, 'vector': vector.tolist()}
+
+    def get_all(self):
+        return list(self.iter_all())
+
+    def _top_k(self, chunks, scores, top_k, rows):
+        # `rows` are the indexes in `chunks` of the score columns
+        k = min(top_k, scores.shape[-1])
+        if k == 0:
+            return [[] for _ in scores]
+        top = np.argpartition(-scores, k - 1, axis=-1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=-1)
+        order = np.argsort(-top_scores, axis=-1, kind='stable')
+        return [
+            [{'page': None, 'start': None, 'end': None, **chunks[rows[i]], 'score': float(s)}
+             for i, s in zip(row[o], row_scores[o])]
+            for row, row_scores, o in zip(top, top_scores, order)
+        ]
+
+    def search_many(self, query_vectors, top_k=Config.VECTOR_SEARCH_TOP_K, doc_names=None):
+        """Top-k cosine search for a batch of query vectors, one result list per query, only among
+        the chunks of `doc_names` if given"""
+        chunks, vectors = self._refresh()
+        queries = normalize(np.atleast_2d(query_vectors))
+        if doc_names:
+            doc_names = set(doc_names)
+            rows = np.array([i for i, chunk in enumerate(chunks) if chunk['doc_name'] in doc_names], dtype=np.intp)
+            return self._top_k(chunks, queries @ vectors[rows].T, top_k, rows)
+        return self._top_k(chunks, queries @ vectors.T, top_k, range(len(chunks)))
+
+    def search(self, query_vector, top_k=Config.VECTOR_SEARCH_TOP_K, doc_names=None):
+        """Same result shape as db.search_vector_db: dicts with score, chunk_id, text, doc_name,
+        page, start and end, plus the chunk's other metadata"""
+        return self.search_many([query_vector], top_k, doc_names)[0]
+
+
+local_vector_store = LocalVectorStore()
@@ -1,10 +1,18 @@
 import logging
 import traceback
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from app.api import router
-from app.templates_service import templates_router
+from app.templates_service import templates_router, Template, close_mongo_client
+from app.db import init_redis_pool, close_redis_pool, get_redis_pool_stats
+from app.embedding_cache import embedding_cache
+from app.openaiutils import coalescer
+from app.assistants.tools import tool_stats
+from app.semantic_cache import semantic_cache
+from app.retrieval_cache import retrieval_cache
+from app.turns import turn_registry
 from app.config import Config
 
 # Configure logging with more detailed format
@@ -15,7 +23,25 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Log all registered routes
+    for route in app.routes:
+        logger.info(f"Registered route: {getattr(route, 'path', route)} [{getattr(route, 'methods', None)}]")
+
+    # One Redis connection pool shared by the API, the assistants and the tools
+    init_redis_pool()
+    # One MongoDB client for the templates, with its indexes in place
+    Template.connect()
+    await Template.ensure_indexes()
+    await Template.check_indexes()
+    yield
+    # Let the conversation turns in progress finish before closing the connections they use
+    await turn_registry.drain()
+    await close_redis_pool()
+    close_mongo_client()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -67,9 +93,14 @@ app.include_router(templates_router)
 def health_check():
     return 'ok'
 
-# Add startup event to verify all routes
-@app.on_event("startup")
-async def startup_event():
-    # Log all registered routes
-    for route in app.routes:
-        logger.info(f"Registered route: {route.path} [{route.methods}]")
\ No newline at end of file
+@app.get('/metrics')
+def metrics():
+    return {
+        'redis_pool': get_redis_pool_stats(),
+        'turns': turn_registry.stats(),
+        'embedding_cache': embedding_cache.stats(),
+        'embedding_coalescer': coalescer.stats(),
+        'tools': tool_stats.stats(),
+        'semantic_cache': semantic_cache.stats(),
+        'retrieval_cache': retrieval_cache.stats(),
+    }
\ No newline at end of file
@@ -0,0 +1,50 @@
+import asyncio
+from argparse import ArgumentParser
+from app.db import get_redis, close_redis_pool, migrate_vector_index, migrate_vector_storage, migrate_chat_messages
+from app.config import Config
+
+async def migrate_index(algorithm):
+    async with get_redis() as rdb:
+        await migrate_vector_index(rdb, algorithm=algorithm)
+    await close_redis_pool()
+
+async def migrate_storage(storage):
+    async with get_redis() as rdb:
+        await migrate_vector_storage(rdb, storage)
+    await close_redis_pool()
+
+async def migrate_chats():
+    async with get_redis() as rdb:
+        await migrate_chat_messages(rdb)
+    await close_redis_pool()
+
+def main():
+    parser = ArgumentParser(description='Redis data and index migrations')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    index_parser = commands.add_parser(
+        'index', help='rebuild the vector index with the current settings and swap it in without downtime'
+    )
+    index_parser.add_argument('--algorithm', choices=['FLAT', 'HNSW'], type=str.upper,
+                              default=Config.VECTOR_INDEX_ALGORITHM)
+
+    storage_parser = commands.add_parser(
+        'storage', help='convert the stored chunks between RedisJSON documents and HASH keys with FLOAT32 vectors'
+    )
+    storage_parser.add_argument('storage', choices=['json', 'hash'], type=str.lower)
+
+    commands.add_parser(
+        'chats', help='move the messages of chats stored in their JSON document to per-chat message lists'
+    )
+
+    args = parser.parse_args()
+    if args.command == 'index':
+        asyncio.run(migrate_index(args.algorithm))
+    elif args.command == 'storage':
+        asyncio.run(migrate_storage(args.storage))
+    elif args.command == 'chats':
+        asyncio.run(migrate_chats())
+
+
+if __name__ == '__main__':
+    main()
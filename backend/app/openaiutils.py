@@ -1,35 +1,104 @@
-from openai import AsyncOpenAI
 import asyncio
+from openai import AsyncOpenAI
+from app.embedding_cache import embedding_cache
 from app.config import Config
 
 # Initialize the async client
-client = AsyncOpenAI(api_key=Config.OPENAI_API_KEY)
-
-async def get_embeddings(input, model="text-embedding-ada-002", dimensions=None):
-    try:
-        kwargs = {"input": input, "model": model}
-        if dimensions is not None:
-            kwargs["dimensions"] = dimensions
-            
-        response = await client.embeddings.create(**kwargs)
-        return [data.embedding for data in response.data]
-    except Exception as e:
-        print(f"Error getting embeddings: {str(e)}")
-        raise
-
-def token_size(text):
-    # Use tiktoken or another tokenizer to count tokens
-    # For now, returning a rough estimate based on words
-    return len(text.split())
-
-async def get_embedding(input, model=Config.EMBEDDING_MODEL, dimensions=Config.EMBEDDING_DIMENSIONS):
-    res = await client.embeddings.create(input=input, model=model, dimensions=dimensions)
-    return res.data[0].embedding
+client = AsyncOpenAI(api_key=Config.OPENAI_API_KEY, base_url=Config.OPENAI_BASE_URL)
 
-async def get_embeddings(input, model=Config.EMBEDDING_MODEL, dimensions=Config.EMBEDDING_DIMENSIONS):
+async def create_embeddings(input, model=Config.EMBEDDING_MODEL, dimensions=Config.EMBEDDING_DIMENSIONS):
+    # Always calls the embeddings endpoint, bypassing the cache
     res = await client.embeddings.create(input=input, model=model, dimensions=dimensions)
     return [d.embedding for d in res.data]
 
+async def get_embedding(input, model=Config.EMBEDDING_MODEL, dimensions=Config.EMBEDDING_DIMENSIONS):
+    # Concurrent calls (e.g. knowledge base queries of different chats) share batched requests
+    if coalescer.window > 0:
+        return await coalescer.get_embedding(input, model, dimensions)
+    embeddings = await get_embeddings([input], model=model, dimensions=dimensions)
+    return embeddings[0]
+
+async def get_embeddings(input, model=Config.EMBEDDING_MODEL, dimensions=Config.EMBEDDING_DIMENSIONS,
+                         create_embeddings=create_embeddings, persist=True):
+    # `create_embeddings` is called for the embeddings that aren't cached (e.g. the loader's batcher),
+    # and the embeddings it creates are only kept in Redis with `persist`
+    if not Config.EMBEDDING_CACHE_ENABLED:
+        return await create_embeddings(input, model, dimensions)
+    return await embedding_cache.get_embeddings(input, model, dimensions, create_embeddings, persist=persist)
+
+class EmbeddingCoalescer:
+    """Micro-batches concurrent get_embedding calls.
+
+    The first call opens a batch that is sent `window` seconds later, or as soon as it holds
+    `max_batch_size` distinct texts, as a single get_embeddings call. Callers asking for a text
+    that is already waiting or in flight share its result instead of adding it again.
+    """
+    def __init__(self, window=Config.EMBEDDING_COALESCE_WINDOW_MS / 1000,
+                 max_batch_size=Config.EMBEDDING_COALESCE_MAX_BATCH, get_embeddings=get_embeddings):
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.get_embeddings = get_embeddings
+        # (model, dimensions) -> {text: future} of the batch being collected
+        self.batches = {}
+        self.timers = {}
+        # (model, dimensions, text) -> future, for texts waiting or in flight
+        self.futures = {}
+        self.tasks = set()
+        self.calls = 0
+        self.requests = 0
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'requests': self.requests,
+            'texts_per_request': self.calls / self.requests if self.requests else 0.0,
+            'in_flight': len(self.futures),
+        }
+
+    async def get_embedding(self, text, model=Config.EMBEDDING_MODEL, dimensions=Config.EMBEDDING_DIMENSIONS):
+        self.calls += 1
+        future = self.futures.get((model, dimensions, text))
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self.futures[(model, dimensions, text)] = future
+            batch = self.batches.setdefault((model, dimensions), {})
+            batch[text] = future
+            if len(batch) >= self.max_batch_size:
+                self._flush(model, dimensions)
+            elif len(batch) == 1:
+                self.timers[(model, dimensions)] = loop.call_later(self.window, self._flush, model, dimensions)
+        # A cancelled caller must not cancel the result the other callers are waiting for
+        return await asyncio.shield(future)
+
+    def _flush(self, model, dimensions):
+        batch = self.batches.pop((model, dimensions), None)
+        timer = self.timers.pop((model, dimensions), None)
+        if timer:
+            timer.cancel()
+        if batch:
+            task = asyncio.create_task(self._send(model, dimensions, batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, model, dimensions, batch):
+        self.requests += 1
+        try:
+            embeddings = await self.get_embeddings(list(batch), model=model, dimensions=dimensions)
+            for future, embedding in zip(batch.values(), embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            for text in batch:
+                self.futures.pop((model, dimensions, text), None)
+
+
+coalescer = EmbeddingCoalescer()
+
 def chat_stream(messages, model=Config.MODEL, temperature=0.1, **kwargs):
     return client.beta.chat.completions.stream(
         model=model,
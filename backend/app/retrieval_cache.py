@@ -0,0 +1,103 @@
+import json
+import hashlib
+import logging
+from app.db import get_redis, get_kb_version
+from app.embedding_cache import normalize_text
+from app.utils.lru import LRUCache
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_CACHE_PREFIX = 'retcache:'
+
+def search_mode():
+    # Settings that change which chunks a search returns, besides the knowledge base itself
+    mode = f'{Config.VECTOR_SEARCH_BACKEND}:{Config.VECTOR_INDEX_ALGORITHM}:{Config.HNSW_EF_RUNTIME}:{Config.SEARCH_MODE}'
+    if Config.SEARCH_MODE == 'hybrid':
+        mode += f':{Config.HYBRID_FUSION}:{Config.HYBRID_RRF_K}:{Config.HYBRID_VECTOR_WEIGHT}:{Config.HYBRID_CANDIDATES}'
+    return mode
+
+class RetrievalCache:
+    """Two-tier cache of knowledge base search results: an in-process LRU in front of Redis.
+
+    Results are keyed by the normalized query text, top_k, the documents searched, the search mode
+    and the knowledge base version, which the loader bumps before and after it changes any vector. The current version
+    is read on every lookup, so a re-ingestion invalidates every cached result at once, and
+    results searched while the version changed are not stored. Redis entries expire after `ttl`
+    seconds; Redis errors are logged and treated as misses.
+    """
+    def __init__(self, enabled=Config.RETRIEVAL_CACHE_ENABLED, maxsize=Config.RETRIEVAL_CACHE_SIZE,
+                 ttl=Config.RETRIEVAL_CACHE_TTL):
+        self.enabled = enabled
+        self.memory = LRUCache(maxsize)
+        self.ttl = ttl
+        self.memory_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @property
+    def rdb(self):
+        return get_redis()
+
+    def stats(self):
+        lookups = self.memory_hits + self.redis_hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'memory_hits': self.memory_hits,
+            'redis_hits': self.redis_hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'hit_rate': (self.memory_hits + self.redis_hits) / lookups if lookups else 0.0,
+            'memory_size': len(self.memory),
+        }
+
+    def cache_key(self, query, top_k, kb_version, mode, doc_names=None):
+        doc_names = sorted(set(doc_names)) if doc_names else None
+        digest = hashlib.sha256(json.dumps([normalize_text(query), top_k, mode, doc_names]).encode()).hexdigest()
+        return f'{RETRIEVAL_CACHE_PREFIX}{kb_version}:{digest}'
+
+    async def search(self, query, top_k, search, doc_names=None):
+        """Results of `search()` (the uncached search for `query` in `doc_names`, or in every
+        document), from the cache when possible"""
+        if not self.enabled:
+            return await search()
+        try:
+            kb_version = await get_kb_version(self.rdb)
+        except Exception as e:
+            # Without the version we can't tell whether cached results are current
+            self.errors += 1
+            logger.warning(f'Retrieval cache unavailable: {e}')
+            return await search()
+
+        key = self.cache_key(query, top_k, kb_version, search_mode(), doc_names)
+        results = self.memory.get(key)
+        if results is not None:
+            self.memory_hits += 1
+            return results
+        try:
+            cached = await self.rdb.get(key)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f'Retrieval cache read failed: {e}')
+            cached = None
+        if cached is not None:
+            self.redis_hits += 1
+            results = json.loads(cached)
+            self.memory.set(key, results)
+            return results
+
+        self.misses += 1
+        results = await search()
+        try:
+            # Skip storing if the knowledge base changed during the search
+            if await get_kb_version(self.rdb) == kb_version:
+                await self.rdb.set(key, json.dumps(results), ex=self.ttl)
+                self.memory.set(key, results)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f'Retrieval cache write failed: {e}')
+        return results
+
+
+retrieval_cache = RetrievalCache()
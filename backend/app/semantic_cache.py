@@ -0,0 +1,149 @@
+import json
+import hashlib
+import logging
+import numpy as np
+from time import time
+from redis.commands.search.field import TagField, VectorField, NumericField
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+from app.db import get_redis
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_CACHE_IDX_NAME = 'idx:semcache'
+SEMANTIC_CACHE_PREFIX = 'semcache:'
+# Sorted set of cache entry keys by last use, for evicting the least recently used entries
+SEMANTIC_CACHE_LRU_KEY = 'semcache-lru'
+
+def prompt_hash(*parts):
+    """Hash of everything besides the question that shapes an answer (prompts, model, tools)"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+class SemanticCache:
+    """Answers to standalone questions, looked up by embedding similarity.
+
+    Entries are HASH keys with their own vector index. A lookup is a KNN 1 query restricted to
+    entries of the same knowledge base version and prompt hash, and is a hit when the cosine
+    similarity reaches `threshold`. Entries expire `ttl` seconds after their last use, and the
+    least recently used ones are evicted beyond `max_entries`. Redis errors are logged and
+    treated as misses, so the cache never breaks a conversation.
+    """
+    def __init__(self, enabled=Config.SEMANTIC_CACHE_ENABLED, threshold=Config.SEMANTIC_CACHE_THRESHOLD,
+                 ttl=Config.SEMANTIC_CACHE_TTL, max_entries=Config.SEMANTIC_CACHE_MAX_ENTRIES):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.index_ready = False
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.errors = 0
+
+    @property
+    def rdb(self):
+        return get_redis()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'errors': self.errors,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    async def ensure_index(self):
+        if self.index_ready:
+            return
+        try:
+            await self.rdb.ft(SEMANTIC_CACHE_IDX_NAME).info()
+        except Exception:
+            schema = (
+                VectorField('vector', 'FLAT', {
+                    'TYPE': 'FLOAT32',
+                    'DIM': Config.EMBEDDING_DIMENSIONS,
+                    'DISTANCE_METRIC': 'COSINE',
+                }),
+                TagField('kb_version'),
+                TagField('prompt_hash'),
+                NumericField('created'),
+            )
+            await self.rdb.ft(SEMANTIC_CACHE_IDX_NAME).create_index(
+                fields=schema,
+                definition=IndexDefinition(prefix=[SEMANTIC_CACHE_PREFIX], index_type=IndexType.HASH)
+            )
+            print(f"Semantic cache index '{SEMANTIC_CACHE_IDX_NAME}' created successfully")
+        self.index_ready = True
+
+    async def lookup(self, query_vector, kb_version, prompt_hash):
+        """The cached {'query', 'answer', 'tool_calls', 'score'} closest to `query_vector`, or None"""
+        try:
+            await self.ensure_index()
+            query = (
+                Query(f'(@kb_version:{{{kb_version}}} @prompt_hash:{{{prompt_hash}}})'
+                      f'=>[KNN 1 @vector $query_vector AS score]')
+                .return_fields('score', 'query', 'answer', 'tool_calls')
+                .dialect(2)
+            )
+            res = await self.rdb.ft(SEMANTIC_CACHE_IDX_NAME).search(query, {
+                'query_vector': np.array(query_vector, dtype=np.float32).tobytes()
+            })
+            hit = res.docs[0] if res.docs and 1 - float(res.docs[0].score) >= self.threshold else None
+            if hit is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            async with self.rdb.pipeline(transaction=False) as pipe:
+                pipe.expire(hit.id, self.ttl)
+                pipe.zadd(SEMANTIC_CACHE_LRU_KEY, {hit.id: time()})
+                await pipe.execute()
+            return {
+                'query': hit.query,
+                'answer': hit.answer,
+                'tool_calls': json.loads(hit.tool_calls),
+                'score': 1 - float(hit.score),
+            }
+        except Exception as e:
+            self.errors += 1
+            self.misses += 1
+            logger.warning(f'Semantic cache lookup failed: {e}')
+            return None
+
+    async def store(self, query, query_vector, answer, tool_calls, kb_version, prompt_hash):
+        try:
+            await self.ensure_index()
+            now = time()
+            key = SEMANTIC_CACHE_PREFIX + hashlib.sha256(f'{kb_version}:{prompt_hash}:{query}'.encode()).hexdigest()[:32]
+            async with self.rdb.pipeline(transaction=True) as pipe:
+                pipe.hset(key, mapping={
+                    'query': query,
+                    'answer': answer,
+                    'tool_calls': json.dumps(tool_calls),
+                    'kb_version': kb_version,
+                    'prompt_hash': prompt_hash,
+                    'created': int(now),
+                    'vector': np.array(query_vector, dtype=np.float32).tobytes(),
+                })
+                pipe.expire(key, self.ttl)
+                pipe.zadd(SEMANTIC_CACHE_LRU_KEY, {key: now})
+                # Entries that expired on their own
+                pipe.zremrangebyscore(SEMANTIC_CACHE_LRU_KEY, '-inf', now - self.ttl)
+                pipe.zcard(SEMANTIC_CACHE_LRU_KEY)
+                *_, size = await pipe.execute()
+            self.stores += 1
+            if size > self.max_entries:
+                evicted = [k for k, _ in await self.rdb.zpopmin(SEMANTIC_CACHE_LRU_KEY, size - self.max_entries)]
+                await self.rdb.delete(*evicted)
+                self.evictions += len(evicted)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f'Semantic cache store failed: {e}')
+
+
+semantic_cache = SemanticCache()
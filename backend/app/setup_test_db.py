@@ -44,6 +44,9 @@ sample_template_chunks = [
 
 async def insert_template_test_data():
     """Insert sample template data into templates collection"""
+    Template.connect()
+    await Template.ensure_indexes()
+
     # Clear existing templates
     await Template.collection.delete_many({})
     
@@ -11,7 +11,8 @@ from app.config import Config
 from pydantic import BaseModel, Field
 from datetime import datetime
 from uuid import uuid4
-from pymongo import UpdateOne
+from collections import defaultdict, deque
+from pymongo import UpdateOne, InsertOne, DeleteMany, IndexModel, ASCENDING
 
 templates_router = APIRouter()
 
@@ -31,17 +32,82 @@ class TemplateModel(BaseModel):
 class TemplateContentUpdate(BaseModel):
     content: str
 
+# Indexes backing the queries below: chunks of a template in order, chunk lookups by ID,
+# and the main templates (chunk order 0) for listing and searching
+TEMPLATE_INDEXES = [
+    IndexModel([("template_id", ASCENDING), ("template_chunk_order", ASCENDING)], name="template_id_chunk_order"),
+    IndexModel([("template_chunk_id", ASCENDING)], name="template_chunk_id_unique", unique=True),
+    IndexModel(
+        [("template_chunk_order", ASCENDING)],
+        name="main_templates",
+        partialFilterExpression={"template_chunk_order": 0}
+    ),
+]
+
+_mongo_client: Optional[AsyncIOMotorClient] = None
+
+def get_mongo_client() -> AsyncIOMotorClient:
+    """Return the process-wide MongoDB client, creating it on first use"""
+    global _mongo_client
+    if _mongo_client is None:
+        _mongo_client = AsyncIOMotorClient(
+            Config.MONGODB_URI,
+            maxPoolSize=Config.MONGODB_MAX_POOL_SIZE,
+            minPoolSize=Config.MONGODB_MIN_POOL_SIZE,
+            serverSelectionTimeoutMS=Config.MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+            connectTimeoutMS=Config.MONGODB_CONNECT_TIMEOUT_MS,
+            socketTimeoutMS=Config.MONGODB_SOCKET_TIMEOUT_MS,
+        )
+    return _mongo_client
+
+def close_mongo_client():
+    global _mongo_client
+    if _mongo_client is not None:
+        _mongo_client.close()
+        _mongo_client = None
+
 class Template:
-    # Initialize MongoDB connection
-    client = AsyncIOMotorClient(Config.MONGODB_URI)
-    db = client[Config.MONGODB_DB_NAME]
-    collection = db.templates
+    # MongoDB connection, set by Template.connect() (in the app lifespan, or by scripts and tests)
+    client: Optional[AsyncIOMotorClient] = None
+    db = None
+    collection = None
+    # Whether the server supports multi-document transactions (replica sets and sharded clusters)
+    supports_transactions: Optional[bool] = None
+
+    @classmethod
+    def connect(cls, db_name: str = Config.MONGODB_DB_NAME):
+        """Point the Template collection at the given database of the shared client"""
+        cls.client = get_mongo_client()
+        cls.db = cls.client[db_name]
+        cls.collection = cls.db.templates
+        cls.supports_transactions = None
+
+    @classmethod
+    async def ensure_indexes(cls):
+        """Create the template indexes (a no-op for the ones that already exist)"""
+        try:
+            await cls.collection.create_indexes(TEMPLATE_INDEXES)
+        except Exception as e:
+            logger.error(f"Error creating template indexes: {str(e)}")
+
+    @classmethod
+    async def check_indexes(cls) -> List[str]:
+        """Log and return the names of the template indexes that are missing"""
+        try:
+            existing = await cls.collection.index_information()
+        except Exception as e:
+            logger.error(f"Error checking template indexes: {str(e)}")
+            return []
+        missing = [index.document["name"] for index in TEMPLATE_INDEXES if index.document["name"] not in existing]
+        if missing:
+            logger.warning(f"Missing template indexes: {', '.join(missing)}")
+        return missing
 
     @classmethod
     async def create(cls, template_data: TemplateModel) -> str:
         """Create a new template"""
         try:
-            logger.info(f"Creating template: {template_data}")
+            logger.info(f"Creating template {template_data.template_id} chunk {template_data.template_chunk_id}")
             # Ensure template_id and chunk_id are set
             if not template_data.template_id:
                 template_data.template_id = str(uuid4())
@@ -186,46 +252,79 @@ class Template:
         except Exception as e:
             raise Exception(f"Error searching templates: {str(e)}")
 
+    @classmethod
+    async def _bulk_write(cls, operations: list):
+        """Apply the operations in one round trip, inside a transaction when the server supports them"""
+        if cls.supports_transactions is None:
+            hello = await cls.client.admin.command("hello")
+            cls.supports_transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+        if not cls.supports_transactions:
+            return await cls.collection.bulk_write(operations, ordered=True)
+        async with await cls.client.start_session() as session:
+            async with session.start_transaction():
+                return await cls.collection.bulk_write(operations, ordered=True, session=session)
+
+    @staticmethod
+    def _diff_chunks(template_id: str, existing_chunks: List[TemplateModel], sections: List[str]) -> list:
+        """Bulk write operations turning the existing chunks into one chunk per section.
+
+        Existing chunks are matched to sections by content first, so unchanged sections keep their
+        chunk ID even if they moved, then by position for the sections whose content changed.
+        Only chunks whose order or content changed are written, and unmatched chunks are deleted.
+        """
+        main = next((c for c in existing_chunks if c.template_chunk_order == 0), existing_chunks[0])
+        now = datetime.now()
+
+        by_content = defaultdict(deque)
+        for chunk in existing_chunks:
+            by_content[chunk.template_content].append(chunk)
+        matched = [by_content[section].popleft() if by_content[section] else None for section in sections]
+        matched_ids = {chunk.template_chunk_id for chunk in matched if chunk}
+        leftover = deque(c for c in existing_chunks if c.template_chunk_id not in matched_ids)
+        matched = [chunk or (leftover.popleft() if leftover else None) for chunk in matched]
+
+        updates, inserts = [], []
+        for order, (section, chunk) in enumerate(zip(sections, matched)):
+            if chunk is None:
+                inserts.append(InsertOne(TemplateModel(
+                    template_id=template_id,
+                    template_chunk_order=order,
+                    template_name=main.template_name,
+                    template_content=section,
+                    template_created=main.template_created,
+                    template_updated=now,
+                    linked_prompt_id=main.linked_prompt_id
+                ).model_dump()))
+                continue
+            changes = {}
+            if chunk.template_chunk_order != order:
+                changes["template_chunk_order"] = order
+            if chunk.template_content != section:
+                changes["template_content"] = section
+            if order == 0 and chunk is not main:
+                # The main chunk carries the template metadata
+                changes.update(template_name=main.template_name, linked_prompt_id=main.linked_prompt_id)
+            if changes:
+                changes["template_updated"] = now
+                updates.append(UpdateOne({"template_chunk_id": chunk.template_chunk_id}, {"$set": changes}))
+
+        # Deletes go last, so that without a transaction readers never see the template empty
+        operations = updates + inserts
+        if leftover:
+            operations.append(DeleteMany({"template_chunk_id": {"$in": [c.template_chunk_id for c in leftover]}}))
+        return operations
+
     @classmethod
     async def update_content(cls, template_id: str, update_data: TemplateContentUpdate):
-        """Update template content and manage chunks"""
-        # Get existing template to preserve metadata
-        existing = await cls.get(template_id)
-        if not existing:
+        """Update template content and manage chunks, with a single bulk write"""
+        existing_chunks = await cls.get_chunks(template_id)
+        if not existing_chunks:
             raise ValueError(f"Template with ID {template_id} not found")
-            
-        chunks = update_data.content.split('\n\n---\n\n')
-        
-        # Delete existing chunks
-        await cls.delete(template_id)
-        
-        # Create new main template with first chunk
-        main_template = TemplateModel(
-            template_id=template_id,
-            template_chunk_id=str(uuid4()),
-            template_chunk_order=0,
-            template_name=existing.template_name,
-            template_content=chunks[0],
-            template_created=existing.template_created,
-            template_updated=datetime.now(),
-            linked_prompt_id=existing.linked_prompt_id
-        )
-        await cls.create(main_template)
-        
-        # Add additional chunks if any
-        for i, chunk_content in enumerate(chunks[1:], 1):
-            chunk = TemplateModel(
-                template_id=template_id,
-                template_chunk_id=str(uuid4()),
-                template_chunk_order=i,
-                template_name=existing.template_name,
-                template_content=chunk_content,
-                template_created=existing.template_created,
-                template_updated=datetime.now(),
-                linked_prompt_id=existing.linked_prompt_id
-            )
-            await cls.create(chunk)
-            
+
+        sections = update_data.content.split('\n\n---\n\n')
+        operations = cls._diff_chunks(template_id, existing_chunks, sections)
+        if operations:
+            await cls._bulk_write(operations)
         return True
 
 @templates_router.post("/api/templates")
@@ -342,35 +441,9 @@ async def update_template_content(
 ):
     """Update the content of a template and its chunks"""
     try:
-        # Use update_data.content instead of raw content
-        chunks = update_data.content.split('\n\n---\n\n')
-        
-        # Delete existing chunks
-        await Template.delete(template_id)
-        
-        # Create new main template with first chunk
-        main_template = TemplateModel(
-            template_id=template_id,
-            template_chunk_id=str(uuid4()),
-            template_chunk_order=0,
-            template_name="", # Maintain existing name
-            template_content=chunks[0],
-            template_updated=datetime.now()
-        )
-        await Template.create(main_template)
-        
-        # Add additional chunks if any
-        for i, chunk_content in enumerate(chunks[1:], 1):
-            chunk = TemplateModel(
-                template_id=template_id,
-                template_chunk_id=str(uuid4()),
-                template_chunk_order=i,
-                template_name="",
-                template_content=chunk_content,
-                template_updated=datetime.now()
-            )
-            await Template.create(chunk)
-            
+        await Template.update_content(template_id, update_data)
         return {"success": True}
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e)) 
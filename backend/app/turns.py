@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+class TurnLimitExceeded(Exception):
+    """Every turn slot and queue position is taken"""
+
+class ShuttingDown(Exception):
+    """The process is draining its turns and doesn't accept new ones"""
+
+class TurnRegistry:
+    """Keeps track of the conversation turns running in the background of this process.
+
+    At most `max_active` turns run at once, up to `max_queued` more wait for a slot, and new
+    turns are refused beyond that. Each turn is tied to its SSE stream: when the client
+    disconnects the turn is cancelled, along with its chat completion and tool calls. The
+    registry holds a reference to every task until it is done, and `drain` lets the running
+    turns finish (and cancels them after a timeout) when the application shuts down.
+    """
+    def __init__(self, max_active=Config.MAX_ACTIVE_TURNS, max_queued=Config.MAX_QUEUED_TURNS):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.tasks = set()
+        self.active = 0
+        self.draining = False
+        self.completed = 0
+        self.cancelled = 0
+        self.rejected = 0
+        self._slots = None
+
+    @property
+    def slots(self):
+        # Created on first use, inside the event loop
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_active)
+        return self._slots
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'queued': len(self.tasks) - self.active,
+            'completed': self.completed,
+            'cancelled': self.cancelled,
+            'rejected': self.rejected,
+            'draining': self.draining,
+        }
+
+    def start(self, turn, sse_stream, name=None):
+        """Run the coroutine returned by `turn()` as a background task tied to `sse_stream`.
+        Raises TurnLimitExceeded or ShuttingDown when the turn can't be accepted."""
+        if self.draining:
+            raise ShuttingDown()
+        if len(self.tasks) >= self.max_active + self.max_queued:
+            self.rejected += 1
+            raise TurnLimitExceeded()
+        task = asyncio.create_task(self._run(turn), name=name)
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+        sse_stream.on_disconnect(task.cancel)
+        return task
+
+    async def _run(self, turn):
+        async with self.slots:
+            self.active += 1
+            try:
+                await turn()
+            finally:
+                self.active -= 1
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        if task.cancelled():
+            self.cancelled += 1
+            logger.info(f'Turn {task.get_name()} cancelled')
+        else:
+            self.completed += 1
+
+    async def drain(self, timeout=Config.SHUTDOWN_DRAIN_TIMEOUT):
+        """Stop accepting turns, wait up to `timeout` seconds for the running ones and cancel the rest"""
+        self.draining = True
+        if not self.tasks:
+            return
+        logger.info(f'Draining {len(self.tasks)} turns')
+        _, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f'Cancelled {len(pending)} turns still running after {timeout}s')
+            await asyncio.wait(pending)
+
+
+turn_registry = TurnRegistry()
@@ -0,0 +1,53 @@
+from app.config import Config
+
+def reciprocal_rank_fusion(result_lists, weights=None, k=Config.HYBRID_RRF_K, key='chunk_id'):
+    """Fuse ranked result lists by reciprocal rank: a result scores sum(weight / (k + rank)) over
+    the lists it appears in, ranks starting at 1. Only ranks matter, so lists scored on different
+    scales (BM25, cosine similarity) can be fused as they are."""
+    weights = weights or [1.0] * len(result_lists)
+    scores = {}
+    results = {}
+    for result_list, weight in zip(result_lists, weights):
+        for rank, result in enumerate(result_list, start=1):
+            scores[result[key]] = scores.get(result[key], 0.0) + weight / (k + rank)
+            results.setdefault(result[key], result)
+    return ranked_results(results, scores)
+
+def normalized_scores(result_list, key):
+    # Min-max normalized to [0, 1], the best result of a list always scores 1
+    if not result_list:
+        return {}
+    scores = [result['score'] for result in result_list]
+    low, high = min(scores), max(scores)
+    return {
+        result[key]: (result['score'] - low) / (high - low) if high > low else 1.0
+        for result in result_list
+    }
+
+def weighted_score_fusion(result_lists, weights=None, key='chunk_id'):
+    """Fuse result lists by the weighted sum of their min-max normalized scores; a result missing
+    from a list scores 0 in it"""
+    weights = weights or [1.0] * len(result_lists)
+    scores = {}
+    results = {}
+    for result_list, weight in zip(result_lists, weights):
+        for result_key, score in normalized_scores(result_list, key).items():
+            scores[result_key] = scores.get(result_key, 0.0) + weight * score
+        for result in result_list:
+            results.setdefault(result[key], result)
+    return ranked_results(results, scores)
+
+def ranked_results(results, scores):
+    # Copies of the results with their fused score, best first (ties keep the first list's order)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [{**results[result_key], 'score': scores[result_key]} for result_key in ranked]
+
+FUSION_METHODS = {
+    'rrf': reciprocal_rank_fusion,
+    'weighted': weighted_score_fusion,
+}
+
+def fuse(result_lists, top_k, method=Config.HYBRID_FUSION, weights=None):
+    if method not in FUSION_METHODS:
+        raise ValueError(f"Unsupported fusion method '{method}', expected one of {', '.join(FUSION_METHODS)}")
+    return FUSION_METHODS[method](result_lists, weights=weights)[:top_k]
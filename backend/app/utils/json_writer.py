@@ -0,0 +1,22 @@
+import json
+from textwrap import indent as indent_text
+
+class JSONArrayWriter:
+    """Write a JSON array to a file one item at a time, so the whole array never has to be in memory.
+    The output is the same as `json.dump(items, file, indent=indent)`."""
+    def __init__(self, file, indent=2):
+        self.file = file
+        self.indent = indent
+        self.count = 0
+
+    def __enter__(self):
+        self.file.write('[')
+        return self
+
+    def write(self, item):
+        self.file.write(',\n' if self.count else '\n')
+        self.file.write(indent_text(json.dumps(item, indent=self.indent), ' ' * self.indent))
+        self.count += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.write('\n]' if self.count else ']')
@@ -1,80 +1,177 @@
 # Inspired by LlamaIndex's Sentence Splitter
 # https://github.com/run-llama/llama_index/blob/main/llama-index-core/llama_index/core/node_parser/text/sentence.py
+import os
 import nltk
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
-from app.utils.token_utils import token_size
+from itertools import accumulate, chain, islice
+from app.utils.token_utils import token_size, token_sizes, get_tokenizer, set_tokenizer
 
-sentence_tokenizer = nltk.tokenize.PunktSentenceTokenizer()
+# Below this much text in total, split_many splits in-process instead of starting a pool
+PARALLEL_MIN_CHARS = 200_000
+
+_sentence_tokenizer = None
+
+def get_sentence_tokenizer():
+    # Built on first use, so each process (e.g. each pool worker) loads the Punkt model once
+    global _sentence_tokenizer
+    if _sentence_tokenizer is None:
+        _sentence_tokenizer = nltk.tokenize.PunktSentenceTokenizer()
+    return _sentence_tokenizer
+
+# Splitters work on offsets: they return the (start, end) spans of the pieces of text[start:end]
+
+def separator_spans(text, start, end, sep):
+    # Same pieces as text.split(sep), each keeping its separator
+    spans = []
+    while (i := text.find(sep, start, end)) != -1:
+        spans.append((start, i + len(sep)))
+        start = i + len(sep)
+    if start < end:
+        spans.append((start, end))
+    return spans
+
+def sentence_spans(text, start, end):
+    # Each sentence runs up to the start of the next one, so it keeps its trailing whitespace
+    starts = [start + s for s, _ in get_sentence_tokenizer().span_tokenize(text[start:end])] + [end]
+    return [(starts[i], starts[i+1]) for i in range(len(starts) - 1)]
 
 def split_by_separator(text, sep):
-    splits = text.split(sep)
-    res = [s + sep for s in splits[:-1]]
-    if splits[-1]:
-        res.append(splits[-1])
-    return res
+    return [text[s:e] for s, e in separator_spans(text, 0, len(text), sep)]
 
 def split_sentences(text):
-    spans = [s[0] for s in sentence_tokenizer.span_tokenize(text)] + [len(text)]
-    return [text[spans[i]:spans[i+1]] for i in range(len(spans) - 1)]
+    return [text[s:e] for s, e in sentence_spans(text, 0, len(text))]
 
 
 class TextSplitter:
+    """Splits text into chunks of at most `chunk_size` tokens, overlapping by up to `chunk_overlap`.
+
+    Text is split recursively (paragraphs, lines, sentences, words) until every split fits, and
+    the splits are merged back into chunks. The whole pipeline works on offsets into the original
+    text and on an array of split token sizes: the merge is a single pass using prefix sums (the
+    overlap window is a binary search), and chunk text is only sliced when it is emitted.
+
+    A chunk's size is the sum of the token sizes of its splits. That is the token count of the
+    chunk text, except where splits meet without whitespace between them (e.g. a sentence break
+    inside "a.b.?"), where the sum can be larger. There, chunks can close a split earlier than
+    with the previous string-based splitter, which re-counted the joined text.
+    """
     def __init__(self, chunk_size, chunk_overlap=0):
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
         self.splitters = [
-            partial(split_by_separator, sep='\n\n'),
-            partial(split_by_separator, sep='\n'),
-            split_sentences,
-            partial(split_by_separator, sep=' ')
+            partial(separator_spans, sep='\n\n'),
+            partial(separator_spans, sep='\n'),
+            sentence_spans,
+            partial(separator_spans, sep=' ')
         ]
-    
-    def _split_recursive(self, text, level=0):
-        if token_size(text) <= self.chunk_size or level == len(self.splitters):
-            return [text]
-        
+
+    def _split_recursive(self, text, start, end, size, level, splits):
+        # Appends (start, end, token size) of the splits of text[start:end] to `splits`
+        if size <= self.chunk_size or level == len(self.splitters):
+            splits.append((start, end, size))
+            return
+        spans = self.splitters[level](text, start, end)
+        sizes = token_sizes([text[s:e] for s, e in spans])
+        for (s, e), s_size in zip(spans, sizes):
+            if s_size <= self.chunk_size:
+                splits.append((s, e, s_size))
+            else:
+                self._split_recursive(text, s, e, s_size, level + 1, splits)
+
+    def _merge_splits(self, sizes):
+        """Group consecutive splits into chunks, returned as (first, last) split index ranges"""
+        # prefix[i] is the total size of the splits before split i
+        prefix = [0, *accumulate(sizes)]
+        ranges = []
+        first = 0
+        for i, size in enumerate(sizes):
+            if i > first and prefix[i] - prefix[first] + size > self.chunk_size:
+                ranges.append((first, i))
+                # The overlap is the longest run of splits before i that fits in chunk_overlap
+                # and still leaves room for split i
+                budget = min(self.chunk_overlap, self.chunk_size - size)
+                first = bisect_left(prefix, prefix[i] - budget, first, i) if budget >= 0 else i
+        if first < len(sizes):
+            ranges.append((first, len(sizes)))
+        return ranges
+
+    def _chunks(self, text):
+        # Yields (start, end, chunk text) with surrounding whitespace excluded
         splits = []
-        for s in self.splitters[level](text):
-            if token_size(s) <= self.chunk_size:
-                splits.append(s)
+        self._split_recursive(text, 0, len(text), token_size(text), 0, splits)
+        # Splits are contiguous, except that whitespace-only text has no sentences and is dropped;
+        # a chunk spanning such a gap is joined from its splits instead of sliced
+        covered = [0, *accumulate(e - s for s, e, _ in splits)]
+        for first, last in self._merge_splits([size for _, _, size in splits]):
+            start, end = splits[first][0], splits[last - 1][1]
+            if end - start == covered[last] - covered[first]:
+                chunk = text[start:end]
             else:
-                splits.extend(self._split_recursive(s, level + 1))
-        return splits
-
-    def _merge_splits(self, splits):
-        chunks = []
-        current_chunk = ''
-        current_splits = []
-
-        for split in splits:
-            if current_chunk and (token_size(current_chunk + split) > self.chunk_size):
-                trimmed_chunk = current_chunk.strip()
-                if trimmed_chunk:
-                    chunks.append(trimmed_chunk)
-                # Add overlap to next chunk
-                last_splits = current_splits
-                current_splits = []
-                current_chunk = ''
-                for s in reversed(last_splits):
-                    if (token_size(s + current_chunk) > self.chunk_overlap or
-                        token_size(s + current_chunk + split) > self.chunk_size
-                    ):
-                        break
-                    current_chunk = s + current_chunk
-                    current_splits.insert(0, s)
-
-            current_chunk += split
-            current_splits.append(split)
-        
-        trimmed_chunk = current_chunk.strip()
-        if trimmed_chunk:
-            chunks.append(trimmed_chunk)
-        return chunks
-    
+                chunk = ''.join(text[s:e] for s, e, _ in splits[first:last])
+            stripped = chunk.strip()
+            if stripped:
+                start += len(chunk) - len(chunk.lstrip())
+                end -= len(chunk) - len(chunk.rstrip())
+                yield start, end, stripped
+
+    def split_spans(self, text):
+        """Chunks as (start, end) offsets into `text`, with surrounding whitespace excluded"""
+        return [(start, end) for start, end, _ in self._chunks(text)]
+
     def split(self, text):
-        splits = self._split_recursive(text)
-        chunks = self._merge_splits(splits)
-        return chunks
-    
+        return [chunk for _, _, chunk in self._chunks(text)]
+
+    def executor(self, workers):
+        """A process pool whose workers each hold a copy of this splitter (see get_worker_splitter)
+        and the tokenizer of this process, loaded once when the worker starts"""
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(self.chunk_size, self.chunk_overlap, get_tokenizer())
+        )
+
+    def split_many(self, texts, workers=None):
+        """Split many texts over a pool of `workers` processes, yielding their chunk lists in
+        input order as they complete. At most 2 texts per worker are in flight, and small inputs
+        (fewer texts than that, with under PARALLEL_MIN_CHARS in total) are split in-process."""
+        workers = workers or os.cpu_count() or 1
+        texts = iter(texts)
+        head = list(islice(texts, 2 * workers))
+        if workers == 1 or (len(head) < 2 * workers and sum(map(len, head)) < PARALLEL_MIN_CHARS):
+            for text in chain(head, texts):
+                yield self.split(text)
+            return
+
+        with self.executor(workers) as executor:
+            pending = deque(executor.submit(_split_in_worker, text) for text in head)
+            try:
+                for text in texts:
+                    pending.append(executor.submit(_split_in_worker, text))
+                    yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
     def __call__(self, text):
         return self.split(text)
+
+
+_worker_splitter = None
+
+def _init_worker(chunk_size, chunk_overlap, tokenizer):
+    global _worker_splitter
+    set_tokenizer(tokenizer)
+    get_sentence_tokenizer()
+    _worker_splitter = TextSplitter(chunk_size, chunk_overlap)
+
+def get_worker_splitter():
+    """The splitter of the current TextSplitter.executor worker process"""
+    return _worker_splitter
+
+def _split_in_worker(text):
+    return _worker_splitter.split(text)
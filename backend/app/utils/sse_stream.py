@@ -1,22 +1,119 @@
 import asyncio
 from sse_starlette import ServerSentEvent
+from app.config import Config
+
+class StreamClosed(Exception):
+    """The client of the stream went away, there is no point in producing more data"""
 
 class SSEStream:
-    def __init__(self) -> None:
-        self._queue = asyncio.Queue()
-        self._stream_end = object()
+    """A bounded stream of server-sent events, fed by `send` and consumed with `async for`.
+
+    Sent data is coalesced: it is buffered and sent as one event once `flush_interval` seconds
+    have passed since the oldest buffered data, or as soon as `flush_bytes` are buffered (with a
+    `flush_interval` of 0 every send becomes its own event). `send` waits while
+    `max_buffer_bytes` are buffered, which backpressures the producer when the client reads
+    slowly. When the consumer stops, e.g. because the client disconnected and the response task
+    was cancelled, `send` raises StreamClosed so the producer can cancel its work.
+    Sizes are counted in characters.
+    """
+    def __init__(self, flush_interval=Config.SSE_FLUSH_INTERVAL_MS / 1000, flush_bytes=Config.SSE_FLUSH_BYTES,
+                 max_buffer_bytes=Config.SSE_MAX_BUFFER_BYTES):
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.max_buffer_bytes = max_buffer_bytes
+        self._buffer = []
+        self._size = 0
+        self._first_pending = None
+        self._closed = False
+        self._disconnected = False
+        # Set when there is data (or the end of the stream) to read, when enough data to flush
+        # right away is buffered, and when the buffer has room
+        self._readable = asyncio.Event()
+        self._flushable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._disconnect_callbacks = []
+        self.events = 0
+
+    @property
+    def disconnected(self):
+        return self._disconnected
+
+    def on_disconnect(self, callback):
+        """Call `callback()` when the consumer goes away (right away if it already has)"""
+        if self._disconnected:
+            callback()
+        else:
+            self._disconnect_callbacks.append(callback)
 
     def __aiter__(self):
-        return self
+        return self._events()
+
+    async def _events(self):
+        loop = asyncio.get_running_loop()
+        finished = False
+        try:
+            while True:
+                await self._readable.wait()
+                if not self._buffer:
+                    # Closed, and everything was sent
+                    finished = True
+                    return
+                remaining = self._first_pending + self.flush_interval - loop.time()
+                if remaining > 0 and not self._flushable.is_set():
+                    try:
+                        await asyncio.wait_for(self._flushable.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                self.events += 1
+                yield ServerSentEvent(data=self._flush())
+        finally:
+            # Cancelled while waiting or sending, or the response stopped iterating
+            if not finished:
+                self._disconnect()
+
+    def _flush(self):
+        data = ''.join(self._buffer)
+        self._buffer.clear()
+        self._size = 0
+        self._first_pending = None
+        self._flushable.clear()
+        if not self._closed:
+            self._readable.clear()
+        self._writable.set()
+        return data
 
-    async def __anext__(self):
-        data = await self._queue.get()
-        if data is self._stream_end:
-            raise StopAsyncIteration
-        return ServerSentEvent(data=data)
+    def _disconnect(self):
+        self._disconnected = True
+        self._buffer.clear()
+        self._size = 0
+        self._writable.set()
+        for callback in self._disconnect_callbacks:
+            callback()
+        self._disconnect_callbacks.clear()
 
     async def send(self, data):
-        await self._queue.put(data)
+        if not data:
+            return
+        while True:
+            if self._disconnected:
+                raise StreamClosed()
+            if self._size < self.max_buffer_bytes:
+                break
+            self._writable.clear()
+            await self._writable.wait()
+        if self._closed:
+            raise RuntimeError('send on a closed SSEStream')
+        if not self._buffer:
+            self._first_pending = asyncio.get_running_loop().time()
+        self._buffer.append(data)
+        self._size += len(data)
+        self._readable.set()
+        if self._size >= self.flush_bytes:
+            self._flushable.set()
 
     async def close(self):
-        await self._queue.put(self._stream_end)
+        """End the stream once the buffered data is sent"""
+        self._closed = True
+        self._readable.set()
+        self._flushable.set()
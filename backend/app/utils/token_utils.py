@@ -1,4 +1,96 @@
+import logging
+from app.utils.lru import LRUCache
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+# Pre-tokenization patterns of the BPE encodings we load from local vocab files
+# (copied from tiktoken_ext.openai_public, where they are only available by downloading the vocab)
+ENCODING_PATTERNS = {
+    'cl100k_base': r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+| ?[^\s\p{L}\p{N}]++[\r\n]*+|\s++$|\s*[\r\n]|\s+(?!\S)|\s""",
+    'o200k_base': '|'.join([
+        r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]*[\p{Ll}\p{Lm}\p{Lo}\p{M}]+(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+        r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]+[\p{Ll}\p{Lm}\p{Lo}\p{M}]*(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+        r"""\p{N}{1,3}""",
+        r""" ?[^\s\p{L}\p{N}]+[\r\n/]*""",
+        r"""\s*[\r\n]+""",
+        r"""\s+(?!\S)""",
+        r"""\s+""",
+    ]),
+}
+
+class WhitespaceTokenizer:
+    """Rough estimate counting whitespace-separated words, needs no vocab"""
+    name = 'whitespace'
+
+    def encode_batch(self, texts):
+        return [text.split() for text in texts]
+
+class TiktokenTokenizer:
+    """BPE tokenizer backed by tiktoken.
+
+    With a `vocab_file` (a `.tiktoken` BPE ranks file) the encoding is built from the local file and
+    works offline, otherwise tiktoken loads the named encoding (downloading and caching its vocab).
+    """
+    def __init__(self, encoding_name=Config.TOKENIZER_ENCODING, vocab_file=Config.TOKENIZER_VOCAB_FILE):
+        import tiktoken
+        from tiktoken.load import load_tiktoken_bpe
+
+        self.name = encoding_name
+        if vocab_file:
+            self.encoding = tiktoken.Encoding(
+                name=encoding_name,
+                pat_str=ENCODING_PATTERNS[encoding_name],
+                mergeable_ranks=load_tiktoken_bpe(vocab_file),
+                special_tokens={}
+            )
+        else:
+            self.encoding = tiktoken.get_encoding(encoding_name)
+
+    def encode_batch(self, texts):
+        # encode_ordinary treats special tokens like <|endoftext|> in documents as plain text
+        return self.encoding.encode_ordinary_batch(texts)
+
+def load_tokenizer(name=Config.TOKENIZER):
+    if name == 'whitespace':
+        return WhitespaceTokenizer()
+    try:
+        return TiktokenTokenizer()
+    except Exception as e:
+        logger.warning(f'Could not load the {Config.TOKENIZER_ENCODING} tokenizer ({e}), '
+                       f'falling back to whitespace token counts. Set TOKENIZER_VOCAB_FILE to work offline.')
+        return WhitespaceTokenizer()
+
+_tokenizer = None
+# Token counts of short texts (splits, chunks, messages); long texts like whole documents aren't
+# worth keeping in memory, they are counted once
+_token_counts = LRUCache(Config.TOKEN_CACHE_SIZE)
+TOKEN_CACHE_MAX_TEXT_LENGTH = 8192
+
+def get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = load_tokenizer()
+    return _tokenizer
+
+def set_tokenizer(tokenizer):
+    global _tokenizer
+    _tokenizer = tokenizer
+    _token_counts.clear()
+
+def encode_batch(texts):
+    return get_tokenizer().encode_batch(texts)
+
+def token_sizes(texts):
+    """Token counts of many texts, tokenizing the ones that aren't cached in one batch"""
+    sizes = [_token_counts.get(text) for text in texts]
+    missing = [i for i, size in enumerate(sizes) if size is None]
+    if missing:
+        for i, tokens in zip(missing, encode_batch([texts[i] for i in missing])):
+            sizes[i] = len(tokens)
+            if len(texts[i]) <= TOKEN_CACHE_MAX_TEXT_LENGTH:
+                _token_counts.set(texts[i], sizes[i])
+    return sizes
+
 def token_size(text):
-    # Use tiktoken or another tokenizer to count tokens
-    # For now, returning a rough estimate based on words
-    return len(text.split()) 
\ No newline at end of file
+    return token_sizes([text])[0]
@@ -0,0 +1,60 @@
+"""Measure the cost of creating an assistant per request.
+
+Compares rebuilding the system messages, tool schema and prompt hash for every assistant with
+getting them from the PromptRegistry, as RAGAssistant does, and reports the time per assistant.
+No server or network is involved.
+
+    python -m benchmarks.assistant_init_benchmark --assistants 10000
+"""
+import os
+from argparse import ArgumentParser
+from time import perf_counter
+
+# The OpenAI client is created at import, but never used here
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+from openai import pydantic_function_tool
+from app.semantic_cache import prompt_hash
+from app.assistants.assistant import RAGAssistant
+from app.assistants.tools import QueryKnowledgeBaseTool, QueryByTemplateIdTool, SaveTemplateTool
+from app.assistants.prompts import MAIN_SYSTEM_PROMPT, RAG_SYSTEM_PROMPT
+from app.assistants.registry import prompt_registry
+from app.config import Config
+
+LOCAL_TOOLS = (QueryKnowledgeBaseTool, QueryByTemplateIdTool, SaveTemplateTool)
+
+def rebuilt_assistant():
+    # What every assistant used to build for itself
+    main_system_message = {'role': 'system', 'content': MAIN_SYSTEM_PROMPT}
+    rag_system_message = {'role': 'system', 'content': RAG_SYSTEM_PROMPT}
+    tools_schema = [pydantic_function_tool(QueryKnowledgeBaseTool)]
+    return main_system_message, rag_system_message, prompt_hash(MAIN_SYSTEM_PROMPT, RAG_SYSTEM_PROMPT, Config.MODEL, tools_schema)
+
+def rebuilt_local_tools():
+    return [pydantic_function_tool(tool) for tool in LOCAL_TOOLS]
+
+def time_per_call(fn, n):
+    start = perf_counter()
+    for _ in range(n):
+        fn()
+    return (perf_counter() - start) / n
+
+def main():
+    parser = ArgumentParser(description='Benchmark per-request assistant construction')
+    parser.add_argument('--assistants', type=int, default=10000)
+    args = parser.parse_args()
+
+    cases = {
+        'RAG assistant, rebuilt': rebuilt_assistant,
+        'RAG assistant, registry': lambda: RAGAssistant(chat_id='benchmark', rdb=None),
+        'local tools, rebuilt': rebuilt_local_tools,
+        'local tools, registry': lambda: prompt_registry.tool_schemas(*LOCAL_TOOLS),
+    }
+    for name, fn in cases.items():
+        fn()
+        seconds = time_per_call(fn, args.assistants)
+        print(f'{name:>24}: {seconds * 1e6:9.1f} µs per call')
+
+
+if __name__ == '__main__':
+    main()
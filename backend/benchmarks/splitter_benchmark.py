@@ -0,0 +1,60 @@
+"""Time the TextSplitter on large synthetic documents.
+
+Generates documents of increasing size from the same paragraph mix and reports split time and
+throughput for each, so the scaling is visible: time per MB should stay flat as documents grow.
+Uses the configured tokenizer, or whitespace counts with `--tokenizer whitespace`.
+
+    python -m benchmarks.splitter_benchmark --mb 1 2 4 8
+"""
+import random
+from argparse import ArgumentParser
+from time import perf_counter
+from app.utils import token_utils
+from app.utils.token_utils import WhitespaceTokenizer
+from app.utils.splitter import TextSplitter
+from app.config import Config
+
+WORDS = ('policy coverage insured insurer the of and claim limit section damage premium '
+         'liability occurrence property bodily injury endorsement exclusion').split()
+
+def make_document(size, rng):
+    parts = []
+    length = 0
+    while length < size:
+        sentences = [
+            ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 30))).capitalize() + '.'
+            for _ in range(rng.randint(1, 10))
+        ]
+        # Mostly short paragraphs, with some long single-line ones that need sentence splitting
+        paragraph = (' ' if rng.random() < 0.2 else '\n').join(sentences)
+        parts.append(paragraph)
+        length += len(paragraph) + 2
+    return '\n\n'.join(parts)
+
+def main():
+    parser = ArgumentParser(description='Benchmark the text splitter on large synthetic documents')
+    parser.add_argument('--mb', type=float, nargs='+', default=[1, 2, 4, 8], help='document sizes in MB')
+    parser.add_argument('--chunk-size', type=int, default=Config.CHUNK_SIZE)
+    parser.add_argument('--chunk-overlap', type=int, default=Config.CHUNK_OVERLAP)
+    parser.add_argument('--tokenizer', choices=['configured', 'whitespace'], default='configured')
+    args = parser.parse_args()
+
+    if args.tokenizer == 'whitespace':
+        token_utils.set_tokenizer(WhitespaceTokenizer())
+    splitter = TextSplitter(args.chunk_size, args.chunk_overlap)
+    rng = random.Random(0)
+    print(f'Tokenizer: {token_utils.get_tokenizer().name}, '
+          f'chunk size {args.chunk_size}, overlap {args.chunk_overlap}')
+    for mb in args.mb:
+        text = make_document(int(mb * 1024 * 1024), rng)
+        # Token counts are memoized, clear them so each size is measured cold
+        token_utils.set_tokenizer(token_utils.get_tokenizer())
+        start = perf_counter()
+        chunks = splitter.split(text)
+        elapsed = perf_counter() - start
+        print(f'{mb:6.1f} MB: {len(chunks):6} chunks in {elapsed:7.2f}s '
+              f'({len(text) / 1024 / 1024 / elapsed:5.2f} MB/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Measure SSEStream throughput and memory with many concurrent streams.
+
+Each stream has a producer sending small deltas, like a chat completion, and a consumer
+encoding every event into its wire format, like the SSE response. It reports the events
+written per second and the traced memory per stream, with and without coalescing.
+No server or network is involved.
+
+    python -m benchmarks.sse_stream_benchmark --streams 1000 --deltas 200
+"""
+import asyncio
+import tracemalloc
+from argparse import ArgumentParser
+from time import perf_counter
+from app.utils.sse_stream import SSEStream
+
+async def produce(stream, deltas, delta):
+    for _ in range(deltas):
+        await stream.send(delta)
+        # Deltas arrive from the network one by one
+        await asyncio.sleep(0)
+    await stream.close()
+
+async def consume(stream):
+    size = 0
+    async for event in stream:
+        size += len(event.encode())
+    return size
+
+async def run(streams, deltas, delta, **stream_options):
+    tracemalloc.start()
+    sse_streams = [SSEStream(**stream_options) for _ in range(streams)]
+    start = perf_counter()
+    producers = [asyncio.create_task(produce(s, deltas, delta)) for s in sse_streams]
+    sizes = await asyncio.gather(*[consume(s) for s in sse_streams])
+    await asyncio.gather(*producers)
+    elapsed = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    events = sum(s.events for s in sse_streams)
+    return {
+        'seconds': elapsed,
+        'events': events,
+        'events_per_second': events / elapsed,
+        'deltas_per_second': streams * deltas / elapsed,
+        'bytes_written': sum(sizes),
+        'peak_kb_per_stream': peak / streams / 1024,
+    }
+
+def main():
+    parser = ArgumentParser(description='Benchmark SSEStream coalescing with concurrent streams')
+    parser.add_argument('--streams', type=int, default=1000)
+    parser.add_argument('--deltas', type=int, default=200, help='deltas sent per stream')
+    parser.add_argument('--delta', default='word ', help='the text of each delta')
+    args = parser.parse_args()
+
+    configs = {
+        'one event per delta': {'flush_interval': 0, 'flush_bytes': 1},
+        'coalesced (defaults)': {},
+    }
+    for name, options in configs.items():
+        res = asyncio.run(run(args.streams, args.deltas, args.delta, **options))
+        print(f"{name:>22}: {res['events']:8} events in {res['seconds']:6.2f}s, "
+              f"{res['events_per_second']:9.0f} events/s, {res['deltas_per_second']:9.0f} deltas/s, "
+              f"{res['bytes_written'] / 1024 / 1024:6.1f} MB written, "
+              f"{res['peak_kb_per_stream']:5.1f} KB peak memory per stream")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Compare the RedisJSON and HASH vector storage backends.
+
+Loads the same random chunks with each backend under a throwaway prefix and index, and reports
+memory per chunk, write throughput, full-read time and KNN search latency. Requires a running
+Redis Stack server; everything it creates is deleted at the end.
+
+    python -m benchmarks.vector_storage_benchmark --chunks 10000
+"""
+import json
+import asyncio
+import numpy as np
+from argparse import ArgumentParser
+from time import perf_counter
+from app.db import (
+    get_redis, create_vector_index, add_chunks_to_vector_db, search_vector_db,
+    wait_for_indexing, chunk_from_hash
+)
+from app.config import Config
+
+def make_chunks(n, rng):
+    vectors = rng.standard_normal((n, Config.EMBEDDING_DIMENSIONS), dtype=np.float32)
+    return [{
+        'chunk_id': f'bench:{i:06}',
+        'text': ' '.join(['policy coverage clause'] * 120),
+        'doc_name': f'doc-{i // 50}',
+        'vector': vectors[i].tolist()
+    } for i in range(n)]
+
+def percentile(values, p):
+    return float(np.percentile(values, p)) * 1000
+
+async def read_all(rdb, keys, storage):
+    async with rdb.pipeline(transaction=False) as pipe:
+        for key in keys:
+            if storage == 'hash':
+                pipe.hgetall(key)
+            else:
+                pipe.json().get(key)
+        res = await pipe.execute()
+    return [chunk_from_hash(fields) for fields in res] if storage == 'hash' else res
+
+async def run(storage, chunks, queries, batch_size):
+    index_name = f'idx:bench:{storage}'
+    prefix = f'bench:{storage}:'
+    keys = [prefix + chunk['chunk_id'] for chunk in chunks]
+    async with get_redis() as rdb:
+        await create_vector_index(rdb, index_name=index_name, storage=storage, prefix=prefix)
+        try:
+            start = perf_counter()
+            for i in range(0, len(chunks), batch_size):
+                await add_chunks_to_vector_db(rdb, chunks[i:i+batch_size], storage=storage, prefix=prefix)
+            write_time = perf_counter() - start
+            await wait_for_indexing(rdb, index_name)
+
+            sample = keys[::max(1, len(keys) // 200)]
+            key_memory = [await rdb.memory_usage(key) for key in sample]
+
+            start = perf_counter()
+            await read_all(rdb, keys, storage)
+            read_time = perf_counter() - start
+
+            latencies = []
+            for query_vector in queries:
+                start = perf_counter()
+                await search_vector_db(rdb, query_vector, index_name=index_name)
+                latencies.append(perf_counter() - start)
+        finally:
+            await rdb.ft(index_name).dropindex(delete_documents=False)
+            for i in range(0, len(keys), batch_size):
+                await rdb.delete(*keys[i:i+batch_size])
+
+    return {
+        'storage': storage,
+        'bytes_per_chunk': int(np.mean(key_memory)),
+        'writes_per_s': int(len(chunks) / write_time),
+        'read_all_s': round(read_time, 3),
+        'search_p50_ms': round(percentile(latencies, 50), 2),
+        'search_p95_ms': round(percentile(latencies, 95), 2),
+    }
+
+async def main(n_chunks, n_queries, batch_size):
+    rng = np.random.default_rng(0)
+    chunks = make_chunks(n_chunks, rng)
+    queries = rng.standard_normal((n_queries, Config.EMBEDDING_DIMENSIONS), dtype=np.float32)
+    for storage in ['json', 'hash']:
+        print(json.dumps(await run(storage, chunks, queries, batch_size)))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chunks', type=int, default=5000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.chunks, args.queries, args.batch_size))
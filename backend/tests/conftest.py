@@ -7,4 +7,6 @@ backend_dir = Path(__file__).parent.parent
 sys.path.insert(0, str(backend_dir))
 
 # Set test environment variable
-os.environ["TESTING"] = "True" 
\ No newline at end of file
+os.environ["TESTING"] = "True"
+# The OpenAI client needs a key to be created, tests never call the real API
+os.environ.setdefault("OPENAI_API_KEY", "test")
\ No newline at end of file
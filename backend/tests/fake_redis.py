@@ -0,0 +1,151 @@
+from fnmatch import fnmatchcase
+
+def decode(key):
+    return key.decode() if isinstance(key, bytes) else key
+
+class FakePipeline:
+    def __init__(self, rdb):
+        self.rdb = rdb
+        self.calls = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def queue(self, target, name):
+        def queue(*args, **kwargs):
+            self.calls.append((target, name, args, kwargs))
+            return self
+        return queue
+
+    def __getattr__(self, name):
+        return self.queue(self.rdb, name)
+
+    def json(self):
+        pipe = self
+
+        class Commands:
+            def __getattr__(self, name):
+                return pipe.queue(pipe.rdb.json(), name)
+        return Commands()
+
+    async def execute(self):
+        calls, self.calls = self.calls, []
+        return [await getattr(target, name)(*args, **kwargs) for target, name, args, kwargs in calls]
+
+class FakeJSON:
+    """JSON.GET and JSON.DEL of top-level fields ('$.field'), on dicts stored as they are"""
+    def __init__(self, rdb):
+        self.rdb = rdb
+
+    async def set(self, key, path, value):
+        assert path == '$'
+        self.rdb.data[decode(key)] = value
+        return True
+
+    async def get(self, key, path='$'):
+        document = self.rdb.data.get(decode(key))
+        if path == '$' or document is None:
+            return document
+        field = path[len('$.'):]
+        return [document[field]] if field in document else []
+
+    async def delete(self, key, path='$'):
+        if path == '$':
+            return await self.rdb.delete(decode(key))
+        return int(self.rdb.data.get(decode(key), {}).pop(path[len('$.'):], None) is not None)
+
+class FakeRedis:
+    """The few string and hash commands the loader and the caches use, in memory, with values
+    returned as bytes like redis-py does, plus lists and the JSON commands of FakeJSON. Expiry
+    times are recorded in `ttls`, but keys never expire."""
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+
+    @staticmethod
+    def encode(value):
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def json(self):
+        return FakeJSON(self)
+
+    async def scan_iter(self, match='*', count=None):
+        for key in list(self.data):
+            if fnmatchcase(key, match):
+                yield key.encode()
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    async def set(self, key, value, ex=None):
+        self.data[key] = self.encode(value)
+        self.ttls.pop(key, None)
+        if ex is not None:
+            self.ttls[key] = ex
+        return True
+
+    async def expire(self, key, seconds):
+        if key not in self.data:
+            return False
+        self.ttls[key] = seconds
+        return True
+
+    async def incr(self, key):
+        value = int(self.data.get(key, 0)) + 1
+        self.data[key] = self.encode(value)
+        return value
+
+    async def exists(self, *keys):
+        return sum(key in self.data for key in keys)
+
+    async def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    async def rpush(self, key, *values):
+        self.data.setdefault(key, []).extend(map(self.encode, values))
+        return len(self.data[key])
+
+    async def lpush(self, key, *values):
+        for value in values:
+            self.data.setdefault(key, []).insert(0, self.encode(value))
+        return len(self.data[key])
+
+    async def lpop(self, key, count=None):
+        items = self.data.get(key, [])
+        popped, self.data[key] = items[:count or 1], items[count or 1:]
+        if not self.data[key]:
+            del self.data[key]
+        return popped if count else (popped[0] if popped else None)
+
+    async def llen(self, key):
+        return len(self.data.get(key, []))
+
+    async def lrange(self, key, start, end):
+        items = self.data.get(key, [])
+        return items[start:None if end == -1 else end + 1]
+
+    async def hset(self, key, field, value):
+        self.data.setdefault(key, {})[self.encode(field)] = self.encode(value)
+        return 1
+
+    async def hget(self, key, field):
+        return self.data.get(key, {}).get(self.encode(field))
+
+    async def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    async def hkeys(self, key):
+        return list(self.data.get(key, {}))
+
+    async def hdel(self, key, *fields):
+        hash_ = self.data.get(key, {})
+        return sum(hash_.pop(self.encode(field), None) is not None for field in fields)
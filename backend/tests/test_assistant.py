@@ -0,0 +1,74 @@
+import pytest
+from types import SimpleNamespace
+from app.assistants import assistant as assistant_module
+from app.assistants.assistant import RAGAssistant
+from app.assistants.tools import ToolMessages
+from app.utils.sse_stream import SSEStream
+
+class FakeSemanticCache:
+    enabled = True
+
+    def __init__(self):
+        self.stored = []
+
+    async def lookup(self, query_vector, kb_version, prompt_hash):
+        return None
+
+    async def store(self, query, *args):
+        self.stored.append(query)
+
+def tool_call(call_id):
+    return SimpleNamespace(id=call_id, function=SimpleNamespace(name='QueryKnowledgeBaseTool', arguments='{}'))
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = FakeSemanticCache()
+
+    async def no_history(rdb, chat_id, last_n=None):
+        return []
+
+    async def store_messages(rdb, chat_id, messages):
+        pass
+
+    async def embedding(text):
+        return [0.0]
+
+    async def kb_version(rdb):
+        return 1
+
+    monkeypatch.setattr(assistant_module, 'semantic_cache', cache)
+    monkeypatch.setattr(assistant_module, 'get_chat_messages', no_history)
+    monkeypatch.setattr(assistant_module, 'add_chat_messages', store_messages)
+    monkeypatch.setattr(assistant_module, 'get_embedding', embedding)
+    monkeypatch.setattr(assistant_module, 'get_kb_version', kb_version)
+    return cache
+
+async def run_turn(monkeypatch, status):
+    async def run_tool_calls(tool_calls, rdb):
+        content = 'SOURCE: policy' if status == 'ok' else 'The QueryKnowledgeBaseTool call timed out, no results.'
+        return ToolMessages([({'role': 'tool', 'tool_call_id': tc.id, 'content': content}, status) for tc in tool_calls])
+
+    responses = iter([
+        SimpleNamespace(content=None, tool_calls=[tool_call('call_0')]),
+        SimpleNamespace(content='The answer', tool_calls=None),
+    ])
+
+    async def generate(self, system_message, chat_messages, **kwargs):
+        return next(responses)
+
+    monkeypatch.setattr(assistant_module, 'run_tool_calls', run_tool_calls)
+    monkeypatch.setattr(RAGAssistant, '_generate_chat_response', generate)
+    assistant = RAGAssistant(chat_id='chat', rdb=None)
+    assistant.sse_stream = SSEStream()
+    await assistant._run_conversation_step('What is covered?')
+
+@pytest.mark.asyncio
+async def test_answer_is_cached_when_every_tool_call_succeeded(monkeypatch, cache):
+    await run_turn(monkeypatch, 'ok')
+    assert cache.stored == ['What is covered?']
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('status', ['timeout', 'error'])
+async def test_answer_is_not_cached_after_a_failed_tool_call(monkeypatch, cache, status):
+    await run_turn(monkeypatch, status)
+    assert cache.stored == []
@@ -0,0 +1,80 @@
+import pytest
+from app.utils import token_utils
+from app.utils.token_utils import WhitespaceTokenizer
+from app.assistants.context_packer import ContextPacker, dedupe_chunks, TRUNCATION_MARKER
+
+@pytest.fixture(autouse=True)
+def whitespace_tokenizer():
+    previous = token_utils._tokenizer
+    token_utils.set_tokenizer(WhitespaceTokenizer())
+    yield
+    token_utils.set_tokenizer(previous)
+
+DOC = ' '.join(f'w{i}' for i in range(1000))
+
+def chunk(chunk_id, start, end, doc_name='policy.pdf'):
+    return {'chunk_id': chunk_id, 'doc_name': doc_name, 'page': 1, 'text': DOC[start:end], 'start': start, 'end': end}
+
+def words(n, prefix='h'):
+    return ' '.join(f'{prefix}{i}' for i in range(n))
+
+SYSTEM = {'role': 'system', 'content': words(10, 's')}
+
+def tool_message(call_id, chunks):
+    return {'role': 'tool', 'tool_call_id': call_id, 'content': '', 'chunks': chunks}
+
+def test_overlapping_chunks_of_a_document_are_merged():
+    first = chunk('a', 100, 300)
+    overlapping = chunk('b', 250, 400)
+    other_doc = chunk('c', 250, 400, doc_name='other.pdf')
+    contained = chunk('d', 120, 200)
+    deduped, merged = dedupe_chunks([[first, overlapping, other_doc], [contained, chunk('a', 100, 300)]])
+    assert merged == 3
+    assert [[c['chunk_id'] for c in chunks] for chunks in deduped] == [['a', 'c'], []]
+    assert deduped[0][0]['text'] == DOC[100:400]
+    assert (deduped[0][0]['start'], deduped[0][0]['end']) == (100, 400)
+    # Search results may be cached, they are left as they are
+    assert first['text'] == DOC[100:300]
+
+def test_chunks_without_spans_are_kept_unless_identical():
+    legacy = {'chunk_id': 'x', 'doc_name': 'policy.pdf', 'page': None, 'text': 'some text'}
+    deduped, merged = dedupe_chunks([[legacy, {**legacy, 'chunk_id': 'y'}, legacy]])
+    assert [c['chunk_id'] for c in deduped[0]] == ['x', 'y']
+    assert merged == 1
+
+def test_oldest_history_is_dropped_then_truncated_before_results():
+    history = [{'role': 'user', 'content': words(100, f'm{i}_')} for i in range(4)]
+    turn = [{'role': 'user', 'content': 'question'}, tool_message('call_1', [chunk('a', 0, 500)])]
+    packer = ContextPacker(budget=300, min_truncated_tokens=10)
+    messages, report = packer.pack(SYSTEM, history, turn)
+
+    assert report['chunks'] == 1 and report['chunks_dropped'] == 0
+    assert report['total'] <= 300
+    # The newest message fits whole, the one before it is truncated, older ones are dropped
+    assert messages[-3] == history[-1]
+    assert messages[-4]['content'].startswith('m2_0 ') and messages[-4]['content'].endswith(TRUNCATION_MARKER)
+    assert len(messages) == 4
+    assert report['history_dropped'] == 2 and report['history_truncated']
+    assert messages[-1] == {'role': 'tool', 'tool_call_id': 'call_1', 'content': messages[-1]['content']}
+    assert DOC[:500] in messages[-1]['content']
+
+def test_lowest_ranked_chunks_are_dropped_when_results_dont_fit():
+    first = [chunk('a', 0, 400), chunk('b', 1000, 1400)]
+    second = [chunk('c', 2000, 2400), chunk('d', 3000, 3400)]
+    turn = [{'role': 'user', 'content': 'question'}, tool_message('call_1', first), tool_message('call_2', second)]
+    history = [{'role': 'user', 'content': 'earlier question'}]
+    messages, report = ContextPacker(budget=250).pack(SYSTEM, history, turn)
+
+    assert report['chunks_dropped'] == 2 and report['chunks'] == 2
+    # The room left by the dropped chunks is still used for the history
+    assert messages[0] == history[0] and report['history_dropped'] == 0
+    assert DOC[0:400] in messages[2]['content'] and DOC[1000:1400] not in messages[2]['content']
+    assert DOC[2000:2400] in messages[3]['content'] and DOC[3000:3400] not in messages[3]['content']
+    assert all('chunks' not in m for m in messages)
+
+def test_everything_fits_within_a_large_budget():
+    history = [{'role': 'user', 'content': 'hello'}, {'role': 'assistant', 'content': 'hi'}]
+    turn = [{'role': 'user', 'content': 'question'}]
+    messages, report = ContextPacker(budget=10000).pack(SYSTEM, history, turn, tools=[{'type': 'function'}])
+    assert messages == [*history, *turn]
+    assert report['history_dropped'] == 0 and not report['history_truncated']
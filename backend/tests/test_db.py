@@ -0,0 +1,59 @@
+import pytest
+from redis.exceptions import ConnectionError
+from app.db import (
+    MonitoredConnectionPool, CHAT_IDX_PREFIX, migrate_chat_messages, add_chat_messages, get_chat_messages,
+    get_archived_chat_messages
+)
+from app.config import Config
+from tests.fake_redis import FakeRedis
+
+def pool():
+    # Nothing listens on port 1, so connecting fails right away
+    return MonitoredConnectionPool(host='127.0.0.1', port=1, max_connections=1, timeout=0.01)
+
+@pytest.mark.asyncio
+async def test_pool_counts_timeouts():
+    connection_pool = pool()
+    connection_pool._in_use_connections.add(object())
+    with pytest.raises(ConnectionError):
+        await connection_pool.get_connection()
+    assert connection_pool.stats()['timeouts'] == 1
+    assert connection_pool.stats()['waiting'] == 0
+
+@pytest.mark.asyncio
+async def test_pool_does_not_count_connection_failures_as_timeouts():
+    connection_pool = pool()
+    with pytest.raises(ConnectionError):
+        await connection_pool.get_connection()
+    assert connection_pool.stats()['timeouts'] == 0
+    await connection_pool.disconnect()
+
+def message(n):
+    return {'role': 'user' if n % 2 else 'assistant', 'content': f'message {n}'}
+
+async def legacy_chat(rdb, chat_id, messages):
+    await rdb.json().set(CHAT_IDX_PREFIX + chat_id, '$', {'id': chat_id, 'created': 0, 'messages': messages})
+
+@pytest.mark.asyncio
+async def test_migrated_messages_come_before_messages_added_since(monkeypatch):
+    monkeypatch.setattr(Config, 'CHAT_MAX_MESSAGES', 4)
+    rdb = FakeRedis()
+    await legacy_chat(rdb, 'chat', [message(n) for n in range(1, 4)])
+    # Messages added to the new list by the deployed app, before the migration ran
+    await add_chat_messages(rdb, 'chat', [message(4), message(5)], max_messages=4)
+    assert await migrate_chat_messages(rdb) == 1
+    assert await get_chat_messages(rdb, 'chat') == [message(n) for n in range(2, 6)]
+    assert await get_archived_chat_messages(rdb, 'chat') == [message(1)]
+    assert await rdb.json().get(CHAT_IDX_PREFIX + 'chat', '$.messages') == []
+    # Running it again changes nothing
+    assert await migrate_chat_messages(rdb) == 0
+
+@pytest.mark.asyncio
+async def test_migrated_messages_go_before_archived_messages(monkeypatch):
+    monkeypatch.setattr(Config, 'CHAT_MAX_MESSAGES', 2)
+    rdb = FakeRedis()
+    await legacy_chat(rdb, 'chat', [message(1), message(2)])
+    await add_chat_messages(rdb, 'chat', [message(n) for n in range(3, 6)], max_messages=2)
+    await migrate_chat_messages(rdb)
+    assert await get_chat_messages(rdb, 'chat') == [message(4), message(5)]
+    assert await get_archived_chat_messages(rdb, 'chat') == [message(1), message(2), message(3)]
@@ -0,0 +1,97 @@
+import asyncio
+import httpx
+import openai
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from openai import AsyncOpenAI
+from app.embedding_batcher import AdaptiveLimiter, EmbeddingBatcher, pack_batches
+
+def fake_embeddings_server(failures=(), delay=0.0):
+    """A local stand-in for the embeddings endpoint. `failures` are (status, headers) responses
+    returned by the first requests, in order; every embedding is [len(text), index]."""
+    app = FastAPI()
+    app.state.requests = 0
+    app.state.in_flight = 0
+    app.state.max_in_flight = 0
+    failures = list(failures)
+
+    @app.post('/v1/embeddings')
+    async def embeddings(request: Request):
+        body = await request.json()
+        app.state.requests += 1
+        if failures:
+            status, headers = failures.pop(0)
+            return JSONResponse({'error': {'message': 'fake failure', 'type': 'error'}},
+                                status_code=status, headers=headers)
+        app.state.in_flight += 1
+        app.state.max_in_flight = max(app.state.max_in_flight, app.state.in_flight)
+        await asyncio.sleep(delay)
+        app.state.in_flight -= 1
+        return {
+            'object': 'list',
+            'model': body['model'],
+            'data': [{'object': 'embedding', 'index': i, 'embedding': [float(len(text)), float(i)]}
+                     for i, text in enumerate(body['input'])],
+            'usage': {'prompt_tokens': 0, 'total_tokens': 0}
+        }
+
+    return app
+
+def make_batcher(app, **kwargs):
+    client = AsyncOpenAI(api_key='test', base_url='http://fake/v1',
+                         http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=app)))
+    return EmbeddingBatcher(client=client, base_delay=0.001, max_delay=0.01, **kwargs)
+
+def test_pack_batches_by_tokens_and_items():
+    sizes = [3, 3, 3, 10, 1, 1, 1, 1, 1]
+    batches = list(pack_batches(list(range(len(sizes))), sizes, max_tokens=6, max_items=3))
+    assert batches == [[0, 1], [2], [3], [4, 5, 6], [7, 8]]
+
+@pytest.mark.asyncio
+async def test_retries_rate_limits_and_server_errors():
+    app = fake_embeddings_server(failures=[
+        (429, {'retry-after-ms': '20'}), (503, {}), (429, {'retry-after': '0'})
+    ])
+    batcher = make_batcher(app, concurrency=4)
+    embeddings = await batcher.create_embeddings(['a', 'bb', 'ccc'])
+    assert embeddings == [[1.0, 0.0], [2.0, 1.0], [3.0, 2.0]]
+    assert app.state.requests == 4
+    assert batcher.stats()['retries'] == 3 and batcher.stats()['rate_limited'] == 2
+    # Halved on each rate limit, then grew back by one after a success
+    assert batcher.limiter.limit == 2
+
+@pytest.mark.asyncio
+async def test_client_errors_are_not_retried():
+    app = fake_embeddings_server(failures=[(400, {})])
+    batcher = make_batcher(app)
+    with pytest.raises(openai.BadRequestError):
+        await batcher.create_embeddings(['a'])
+    assert app.state.requests == 1
+
+@pytest.mark.asyncio
+async def test_gives_up_after_max_retries():
+    app = fake_embeddings_server(failures=[(500, {})] * 3)
+    batcher = make_batcher(app, max_retries=2)
+    with pytest.raises(openai.InternalServerError):
+        await batcher.create_embeddings(['a'])
+    assert app.state.requests == 3
+
+@pytest.mark.asyncio
+async def test_concurrency_is_limited():
+    app = fake_embeddings_server(delay=0.01)
+    batcher = make_batcher(app, concurrency=2)
+    results = await asyncio.gather(*[batcher.create_embeddings(['x' * i]) for i in range(8)])
+    assert [r[0][0] for r in results] == [float(i) for i in range(8)]
+    assert app.state.max_in_flight == 2
+
+@pytest.mark.asyncio
+async def test_limiter_pauses_for_retry_after():
+    limiter = AdaptiveLimiter(max_concurrency=4)
+    limiter.on_rate_limit(retry_after=0.05)
+    assert limiter.limit == 2
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    async with limiter.slot():
+        pass
+    assert loop.time() - start >= 0.04
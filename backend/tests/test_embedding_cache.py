@@ -0,0 +1,75 @@
+import pytest
+from app.embedding_cache import EmbeddingCache, EMBEDDING_CACHE_PREFIX, text_key
+from tests.fake_redis import FakeRedis
+
+class Embedder:
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, texts, model, dimensions):
+        self.calls.append(list(texts))
+        return [[float(len(text)), 1.0] for text in texts]
+
+@pytest.fixture
+def rdb(monkeypatch):
+    rdb = FakeRedis()
+    monkeypatch.setattr(EmbeddingCache, 'rdb', property(lambda self: rdb))
+    return rdb
+
+@pytest.mark.asyncio
+async def test_redis_entries_expire(rdb):
+    cache = EmbeddingCache(maxsize=10, use_redis=True, ttl=60)
+    embedder = Embedder()
+    assert await cache.get_embeddings(['a b', 'c'], 'model', 2, embedder) == [[3.0, 1.0], [1.0, 1.0]]
+    keys = [f'{EMBEDDING_CACHE_PREFIX}model:2:{text_key(text)}' for text in ['a b', 'c']]
+    assert {key: rdb.ttls[key] for key in keys} == {key: 60 for key in keys}
+
+    # Another process finds them in Redis, which keeps them for another `ttl` seconds
+    rdb.ttls.clear()
+    other = EmbeddingCache(maxsize=10, use_redis=True, ttl=60)
+    assert await other.get_embeddings(['c'], 'model', 2, embedder) == [[1.0, 1.0]]
+    assert other.redis_hits == 1 and len(embedder.calls) == 1
+    assert rdb.ttls == {keys[1]: 60}
+
+@pytest.mark.asyncio
+async def test_embeddings_are_not_persisted_without_persist(rdb):
+    cache = EmbeddingCache(maxsize=10, use_redis=True, ttl=60)
+    embedder = Embedder()
+    await cache.get_embeddings(['a', 'b'], 'model', 2, embedder, persist=False)
+    assert rdb.data == {}
+    # They are still cached in memory
+    await cache.get_embeddings(['a'], 'model', 2, embedder)
+    assert cache.memory_hits == 1 and len(embedder.calls) == 1
+
+@pytest.mark.asyncio
+async def test_memory_tier_sends_each_distinct_text_once():
+    cache = EmbeddingCache(maxsize=10, use_redis=False)
+    embedder = Embedder()
+    # Texts that only differ in whitespace share an embedding
+    vectors = await cache.get_embeddings(['a  b', 'c', 'a b'], 'model', 2, embedder)
+    assert vectors == [[3.0, 1.0], [1.0, 1.0], [3.0, 1.0]]
+    assert len(embedder.calls) == 1 and len(embedder.calls[0]) == 2
+    assert await cache.get_embeddings(['c', 'd'], 'model', 2, embedder) == [[1.0, 1.0], [1.0, 1.0]]
+    assert embedder.calls[-1] == ['d']
+    assert cache.stats() | {'hit_rate': None} == {
+        'memory_hits': 1, 'redis_hits': 0, 'misses': 4, 'errors': 0, 'hit_rate': None, 'memory_size': 3
+    }
+
+@pytest.mark.asyncio
+async def test_memory_tier_is_keyed_by_model_and_dimensions():
+    cache = EmbeddingCache(maxsize=10, use_redis=False)
+    embedder = Embedder()
+    await cache.get_embeddings(['a'], 'model', 2, embedder)
+    await cache.get_embeddings(['a'], 'other', 2, embedder)
+    await cache.get_embeddings(['a'], 'model', 3, embedder)
+    assert len(embedder.calls) == 3 and cache.memory_hits == 0
+
+@pytest.mark.asyncio
+async def test_memory_tier_evicts_least_recently_used():
+    cache = EmbeddingCache(maxsize=2, use_redis=False)
+    embedder = Embedder()
+    await cache.get_embeddings(['a', 'b'], 'model', 2, embedder)
+    await cache.get_embeddings(['a'], 'model', 2, embedder)
+    await cache.get_embeddings(['c'], 'model', 2, embedder)
+    await cache.get_embeddings(['a', 'b'], 'model', 2, embedder)
+    assert embedder.calls[-1] == ['b']
@@ -0,0 +1,46 @@
+import asyncio
+import pytest
+from app.openaiutils import EmbeddingCoalescer
+
+class FakeEmbeddings:
+    def __init__(self, delay=0.0, fail=False):
+        self.calls = []
+        self.delay = delay
+        self.fail = fail
+
+    async def __call__(self, texts, model, dimensions):
+        self.calls.append(texts)
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError('upstream error')
+        return [[float(len(text)), float(dimensions)] for text in texts]
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_share_batched_requests():
+    fake = FakeEmbeddings()
+    coalescer = EmbeddingCoalescer(window=0.01, max_batch_size=4, get_embeddings=fake)
+    texts = ['a', 'bb', 'a', 'ccc', 'dddd', 'bb', 'eeeee', 'ffffff']
+    embeddings = await asyncio.gather(*[coalescer.get_embedding(t, 'model', 2) for t in texts])
+    assert embeddings == [[float(len(t)), 2.0] for t in texts]
+    # 6 distinct texts: one full batch of 4 sent right away, the rest when the window closes
+    assert fake.calls == [['a', 'bb', 'ccc', 'dddd'], ['eeeee', 'ffffff']]
+    assert coalescer.stats()['requests'] == 2 and not coalescer.futures
+
+@pytest.mark.asyncio
+async def test_in_flight_texts_are_deduplicated():
+    fake = FakeEmbeddings(delay=0.02)
+    coalescer = EmbeddingCoalescer(window=0.001, max_batch_size=8, get_embeddings=fake)
+    first = asyncio.create_task(coalescer.get_embedding('same', 'model', 2))
+    await asyncio.sleep(0.01)
+    # The first request is in flight by now, the second call waits for it
+    second = await coalescer.get_embedding('same', 'model', 2)
+    assert second == await first
+    assert fake.calls == [['same']]
+
+@pytest.mark.asyncio
+async def test_errors_reach_every_caller():
+    coalescer = EmbeddingCoalescer(window=0.001, get_embeddings=FakeEmbeddings(fail=True))
+    results = await asyncio.gather(*[coalescer.get_embedding(t, 'model', 2) for t in 'ab'],
+                                   return_exceptions=True)
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert not coalescer.futures
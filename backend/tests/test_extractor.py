@@ -0,0 +1,42 @@
+import os
+import pytest
+from app.utils import token_utils
+from app.utils.token_utils import WhitespaceTokenizer
+from app.utils.splitter import TextSplitter
+from app.extractor import PageExtractor, ChunkExtractor, extract_chunks
+
+SAMPLE_PDF = os.path.join(os.path.dirname(__file__), '..', 'data', 'docs', 'SampleISO-CGL.pdf')
+
+@pytest.fixture(autouse=True)
+def whitespace_tokenizer():
+    previous = token_utils._tokenizer
+    token_utils.set_tokenizer(WhitespaceTokenizer())
+    yield
+    token_utils.set_tokenizer(previous)
+
+@pytest.mark.parametrize('window_chars', [10 ** 9, 2000])
+def test_chunks_have_pages_and_offsets(window_chars):
+    pages = list(PageExtractor(SAMPLE_PDF))
+    text = ''.join(page_text for _, page_text in pages)
+    chunks, truncated = extract_chunks(SAMPLE_PDF, TextSplitter(128, 30), window_chars=window_chars)
+    assert not truncated and chunks
+    for chunk in chunks:
+        assert text[chunk['start']:chunk['end']] == chunk['text']
+    starts = [chunk['start'] for chunk in chunks]
+    assert starts == sorted(starts)
+    assert [chunk['page'] for chunk in chunks] == sorted(chunk['page'] for chunk in chunks)
+    assert chunks[-1]['page'] == pages[-1][0]
+
+def test_chunks_are_yielded_one_window_at_a_time():
+    splitter = TextSplitter(128, 30)
+    parts = list(ChunkExtractor(SAMPLE_PDF, splitter, window_chars=2000))
+    assert len(parts) > 1
+    chunks, _ = extract_chunks(SAMPLE_PDF, splitter, window_chars=2000)
+    assert [chunk for part in parts for chunk in part] == chunks
+
+def test_page_budget_truncates():
+    pages = PageExtractor(SAMPLE_PDF, max_pages=2)
+    assert [number for number, _ in pages] == [1, 2]
+    assert pages.truncated
+    chunks, truncated = extract_chunks(SAMPLE_PDF, TextSplitter(128, 30), max_pages=2)
+    assert truncated and max(chunk['page'] for chunk in chunks) <= 2
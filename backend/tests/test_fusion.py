@@ -0,0 +1,59 @@
+import pytest
+from app.utils.fusion import fuse, reciprocal_rank_fusion, weighted_score_fusion
+from app.assistants import tools
+from app.assistants.tools import QueryKnowledgeBaseTool
+from app.config import Config
+
+def results(*chunk_ids, scores=None):
+    scores = scores or [1.0 / (i + 1) for i in range(len(chunk_ids))]
+    return [{'chunk_id': chunk_id, 'text': chunk_id, 'score': score} for chunk_id, score in zip(chunk_ids, scores)]
+
+def test_reciprocal_rank_fusion_favours_results_in_both_lists():
+    fused = reciprocal_rank_fusion([results('a', 'b', 'c'), results('c', 'd', 'b')], k=60)
+    assert [r['chunk_id'] for r in fused] == ['c', 'b', 'a', 'd']
+    assert fused[0]['score'] == pytest.approx(1 / 63 + 1 / 61)
+
+def test_weights_shift_the_fused_ranking():
+    vector, text = results('a', 'b'), results('b', 'a')
+    assert [r['chunk_id'] for r in reciprocal_rank_fusion([vector, text], weights=[0.8, 0.2])] == ['a', 'b']
+    assert [r['chunk_id'] for r in reciprocal_rank_fusion([vector, text], weights=[0.2, 0.8])] == ['b', 'a']
+
+def test_weighted_score_fusion_normalizes_each_list():
+    vector = results('a', 'b', 'c', scores=[0.9, 0.8, 0.7])
+    text = results('c', 'a', scores=[25.0, 5.0])
+    fused = weighted_score_fusion([vector, text], weights=[0.5, 0.5])
+    assert {r['chunk_id']: r['score'] for r in fused} == pytest.approx({'a': 0.5, 'b': 0.25, 'c': 0.5})
+    # The input results keep their own scores
+    assert vector[0]['score'] == 0.9
+
+def test_fuse_keeps_top_k():
+    assert [r['chunk_id'] for r in fuse([results('a', 'b', 'c'), []], 2, method='rrf')] == ['a', 'b']
+    with pytest.raises(ValueError):
+        fuse([results('a')], 1, method='max')
+
+@pytest.mark.asyncio
+async def test_hybrid_search_fuses_vector_and_full_text_results(monkeypatch):
+    calls = {}
+
+    async def get_embedding(text):
+        return [0.0]
+
+    async def search_vector_db(rdb, query_vector, top_k, doc_names=None):
+        calls['vector'] = (top_k, doc_names)
+        return results('a', 'b', 'c')
+
+    async def search_text_db(rdb, query_text, top_k, doc_names=None):
+        calls['text'] = (query_text, top_k, doc_names)
+        return results('d', 'c', scores=[12.0, 3.0])
+
+    monkeypatch.setattr(tools, 'get_embedding', get_embedding)
+    monkeypatch.setattr(tools, 'search_vector_db', search_vector_db)
+    monkeypatch.setattr(tools, 'search_text_db', search_text_db)
+    monkeypatch.setattr(tools, 'use_local_vector_store', lambda: False)
+    monkeypatch.setattr(Config, 'SEARCH_MODE', 'hybrid')
+    monkeypatch.setattr(Config, 'HYBRID_CANDIDATES', 20)
+
+    tool = QueryKnowledgeBaseTool(query_input='CG 00 01 coverage')
+    chunks = await tool.search(rdb=None, top_k=3, doc_names=['policy'])
+    assert [c['chunk_id'] for c in chunks] == ['c', 'a', 'd']
+    assert calls == {'vector': (20, ['policy']), 'text': ('CG 00 01 coverage', 20, ['policy'])}
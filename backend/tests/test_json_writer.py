@@ -0,0 +1,31 @@
+import io
+import json
+import pytest
+from app.utils.json_writer import JSONArrayWriter
+
+ITEMS = [
+    {'chat_id': '1', 'messages': [{'role': 'user', 'content': 'Hi\nthere'}, {'role': 'assistant', 'content': ''}]},
+    {'chat_id': '2', 'messages': [], 'tags': {}},
+    'text',
+    3.5,
+    None,
+    [[1, 2], []],
+]
+
+def written(items, **kwargs):
+    file = io.StringIO()
+    with JSONArrayWriter(file, **kwargs) as writer:
+        for item in items:
+            writer.write(item)
+    return file.getvalue(), writer.count
+
+@pytest.mark.parametrize('items', [ITEMS, ITEMS[:1], [ITEMS[2]], []])
+def test_output_matches_json_dump(items):
+    expected = io.StringIO()
+    json.dump(items, expected, indent=2)
+    assert written(items) == (expected.getvalue(), len(items))
+
+def test_indent():
+    expected = io.StringIO()
+    json.dump(ITEMS, expected, indent=4)
+    assert written(ITEMS, indent=4)[0] == expected.getvalue()
@@ -0,0 +1,171 @@
+import os
+import json
+import tempfile
+import pytest
+from app import db, loader
+from app.db import get_manifest, get_kb_version, setup_db
+from app.local_vector_store import LocalVectorStore
+from app.loader import process_docs
+from app.config import Config
+from tests.fake_redis import FakeRedis
+
+DIMENSIONS = 4
+
+async def extract_paragraphs(file_paths, text_splitter, spool_dir):
+    # Stands in for the PDF extraction pool: each paragraph of a text file is a page holding one
+    # chunk, spooled one page per line like extract_doc does
+    for path in file_paths:
+        with open(path) as file:
+            paragraphs = file.read().split('\n\n')
+        fd, spool_path = tempfile.mkstemp(suffix='.jsonl', dir=spool_dir)
+        with os.fdopen(fd, 'w') as spool:
+            start = 0
+            for page, paragraph in enumerate(paragraphs, start=1):
+                chunk = {'text': paragraph, 'page': page, 'start': start, 'end': start + len(paragraph)}
+                spool.write(json.dumps([chunk]) + '\n')
+                start += len(paragraph) + 2
+        yield os.path.splitext(os.path.basename(path))[0], spool_path, False
+
+class FakeBatcher:
+    def __init__(self):
+        self.texts = []
+
+    async def embed(self, texts):
+        self.texts.extend(texts)
+        return [[float(len(text)), 1.0, 0.0, 0.0] for text in texts]
+
+    def stats(self):
+        return {'texts': len(self.texts)}
+
+class FailingBatcher(FakeBatcher):
+    def __init__(self, fail_after):
+        super().__init__()
+        self.fail_after = fail_after
+
+    async def embed(self, texts):
+        if len(self.texts) >= self.fail_after:
+            raise RuntimeError('Embeddings API unavailable')
+        return await super().embed(texts)
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = LocalVectorStore(path=str(tmp_path / 'vectors'), dimensions=DIMENSIONS)
+    monkeypatch.setattr(db, 'local_vector_store', store)
+    monkeypatch.setattr(Config, 'VECTOR_SEARCH_BACKEND', 'local')
+    monkeypatch.setattr(loader, 'extract_docs', extract_paragraphs)
+    return store
+
+@pytest.fixture
+def docs_dir(tmp_path):
+    docs_dir = tmp_path / 'docs'
+    docs_dir.mkdir()
+    (docs_dir / 'policy.pdf').write_text('Coverage A\n\nCoverage B\n\nExclusions')
+    (docs_dir / 'endorsement.pdf').write_text('Additional insured\n\nWaiver')
+    return docs_dir
+
+async def load(rdb, docs_dir):
+    batcher = FakeBatcher()
+    await process_docs(rdb, str(docs_dir), batcher=batcher, batch_tokens=1000, batch_size=2, concurrency=2)
+    return batcher
+
+def stored_texts(store, doc_name):
+    return sorted(chunk['text'] for chunk in store.iter_all() if chunk['doc_name'] == doc_name)
+
+@pytest.mark.asyncio
+async def test_first_run_embeds_every_chunk(store, docs_dir):
+    rdb = FakeRedis()
+    batcher = await load(rdb, docs_dir)
+    assert sorted(batcher.texts) == sorted(['Coverage A', 'Coverage B', 'Exclusions', 'Additional insured', 'Waiver'])
+    assert len(store) == 5
+    manifest = await get_manifest(rdb)
+    assert sorted(manifest) == ['endorsement', 'policy']
+    assert len(manifest['policy']['chunks']) == 3
+
+@pytest.mark.asyncio
+async def test_unchanged_docs_are_skipped(store, docs_dir):
+    rdb = FakeRedis()
+    await load(rdb, docs_dir)
+    version = await get_kb_version(rdb)
+    batcher = await load(rdb, docs_dir)
+    assert batcher.texts == []
+    assert len(store) == 5
+    # Nothing changed, so cached answers stay valid
+    assert await get_kb_version(rdb) == version
+
+@pytest.mark.asyncio
+async def test_changed_doc_only_embeds_its_new_chunks(store, docs_dir):
+    rdb = FakeRedis()
+    await load(rdb, docs_dir)
+    version = await get_kb_version(rdb)
+    (docs_dir / 'policy.pdf').write_text('Coverage A\n\nCoverage C\n\nExclusions')
+    batcher = await load(rdb, docs_dir)
+    assert batcher.texts == ['Coverage C']
+    assert stored_texts(store, 'policy') == ['Coverage A', 'Coverage C', 'Exclusions']
+    assert stored_texts(store, 'endorsement') == ['Additional insured', 'Waiver']
+    manifest = await get_manifest(rdb)
+    assert sorted(chunk_id for chunk_id in manifest['policy']['chunks']) == sorted(
+        chunk['chunk_id'] for chunk in store.iter_all() if chunk['doc_name'] == 'policy'
+    )
+    assert await get_kb_version(rdb) > version
+
+@pytest.mark.asyncio
+async def test_removed_doc_chunks_are_deleted(store, docs_dir):
+    rdb = FakeRedis()
+    await load(rdb, docs_dir)
+    (docs_dir / 'endorsement.pdf').unlink()
+    batcher = await load(rdb, docs_dir)
+    assert batcher.texts == []
+    assert stored_texts(store, 'endorsement') == []
+    assert stored_texts(store, 'policy') == ['Coverage A', 'Coverage B', 'Exclusions']
+    assert sorted(await get_manifest(rdb)) == ['policy']
+
+@pytest.mark.asyncio
+async def test_chunks_repeated_in_a_doc_are_embedded_once(store, docs_dir):
+    rdb = FakeRedis()
+    (docs_dir / 'policy.pdf').write_text('Coverage A\n\nCoverage A\n\nExclusions')
+    batcher = await load(rdb, docs_dir)
+    assert batcher.texts.count('Coverage A') == 1
+    assert len((await get_manifest(rdb))['policy']['chunks']) == 2
+
+@pytest.mark.asyncio
+async def test_kept_chunks_get_their_new_positions(store, docs_dir):
+    rdb = FakeRedis()
+    await load(rdb, docs_dir)
+    text = 'A first paragraph, inserted now\n\nCoverage A\n\nCoverage B\n\nExclusions'
+    (docs_dir / 'policy.pdf').write_text(text)
+    batcher = await load(rdb, docs_dir)
+    assert batcher.texts == ['A first paragraph, inserted now']
+    chunks = sorted((c for c in store.iter_all() if c['doc_name'] == 'policy'), key=lambda c: c['start'])
+    assert [(c['page'], text[c['start']:c['end']]) for c in chunks] == [
+        (1, 'A first paragraph, inserted now'), (2, 'Coverage A'), (3, 'Coverage B'), (4, 'Exclusions')
+    ]
+
+@pytest.mark.asyncio
+async def test_interrupted_first_run_resumes_where_it_stopped(store, docs_dir):
+    rdb = FakeRedis()
+    (docs_dir / 'endorsement.pdf').unlink()
+    await setup_db(rdb)
+    with pytest.raises(RuntimeError):
+        await process_docs(rdb, str(docs_dir), batcher=FailingBatcher(fail_after=2), batch_size=1, concurrency=1)
+    # The document never finished, so there is no manifest yet, but its first batches are stored
+    assert await get_manifest(rdb) == {}
+    assert stored_texts(store, 'policy') == ['Coverage A', 'Coverage B']
+    await setup_db(rdb)
+    batcher = await load(rdb, docs_dir)
+    assert batcher.texts == ['Exclusions']
+    assert stored_texts(store, 'policy') == ['Coverage A', 'Coverage B', 'Exclusions']
+
+@pytest.mark.asyncio
+async def test_setup_db_rebuilds_stores_that_predate_the_loader(store, docs_dir):
+    rdb = FakeRedis()
+    store.add_chunks([{'chunk_id': 'legacy', 'text': 'Legacy', 'doc_name': 'policy', 'vector': [1, 0, 0, 0]}])
+    await setup_db(rdb)
+    assert len(store) == 0
+    await load(rdb, docs_dir)
+    # Once set up, an emptied corpus is not a reason to rebuild either
+    for path in docs_dir.iterdir():
+        path.unlink()
+    await load(rdb, docs_dir)
+    store.add_chunks([{'chunk_id': 'kept', 'text': 'Kept', 'doc_name': 'other', 'vector': [1, 0, 0, 0]}])
+    await setup_db(rdb)
+    assert len(store) == 1
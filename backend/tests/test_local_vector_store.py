@@ -0,0 +1,78 @@
+import os
+import numpy as np
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from app.local_vector_store import LocalVectorStore
+
+DIMENSIONS = 8
+
+def make_chunk(chunk_id, vector, doc_name='doc'):
+    return {'chunk_id': chunk_id, 'text': f'text {chunk_id}', 'doc_name': doc_name, 'vector': list(vector)}
+
+@pytest.fixture
+def store(tmp_path):
+    rng = np.random.default_rng(0)
+    store = LocalVectorStore(path=str(tmp_path), dimensions=DIMENSIONS)
+    store.add_chunks([make_chunk(f'c{i}', rng.standard_normal(DIMENSIONS)) for i in range(50)])
+    return store
+
+def brute_force(store, query, top_k):
+    vectors = np.array([c['vector'] for c in store.get_all()])
+    scores = vectors @ query / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query))
+    return [store.chunks[i]['chunk_id'] for i in np.argsort(-scores)[:top_k]]
+
+def test_search_matches_brute_force(store):
+    query = np.random.default_rng(1).standard_normal(DIMENSIONS)
+    results = store.search(query, top_k=5)
+    assert [r['chunk_id'] for r in results] == brute_force(store, query, 5)
+    assert set(results[0]) == {'score', 'chunk_id', 'text', 'doc_name', 'page', 'start', 'end'}
+    assert results[0]['score'] >= results[-1]['score']
+
+def test_search_many_matches_single_queries(store):
+    queries = np.random.default_rng(2).standard_normal((4, DIMENSIONS))
+    batched = store.search_many(queries, top_k=3)
+    for results, query in zip(batched, queries):
+        single = store.search(query, top_k=3)
+        assert [r['chunk_id'] for r in results] == [r['chunk_id'] for r in single]
+        assert [r['score'] for r in results] == pytest.approx([r['score'] for r in single], abs=1e-6)
+
+def test_top_k_larger_than_store(tmp_path):
+    store = LocalVectorStore(path=str(tmp_path), dimensions=DIMENSIONS)
+    assert store.search(np.ones(DIMENSIONS), top_k=3) == []
+    store.add_chunks([make_chunk('a', np.ones(DIMENSIONS))])
+    assert [r['chunk_id'] for r in store.search(np.ones(DIMENSIONS), top_k=3)] == ['a']
+
+def test_add_replaces_and_delete_removes(store, tmp_path):
+    store.add_chunks([make_chunk('c0', np.ones(DIMENSIONS), doc_name='updated')])
+    store.delete_chunks(['c1', 'c2'])
+    assert len(store) == 48
+    results = store.search(np.ones(DIMENSIONS), top_k=1)
+    assert results[0]['chunk_id'] == 'c0' and results[0]['doc_name'] == 'updated'
+    assert results[0]['score'] == pytest.approx(1.0)
+
+    # Another process sees the changes through the files
+    reader = LocalVectorStore(path=str(tmp_path), dimensions=DIMENSIONS)
+    assert len(reader) == 48
+
+def test_search_restricted_to_documents(tmp_path):
+    rng = np.random.default_rng(3)
+    store = LocalVectorStore(path=str(tmp_path), dimensions=DIMENSIONS)
+    store.add_chunks([make_chunk(f'c{i}', rng.standard_normal(DIMENSIONS), doc_name=f'doc{i % 3}') for i in range(30)])
+    query = rng.standard_normal(DIMENSIONS)
+    results = store.search(query, top_k=4, doc_names=['doc1', 'doc2'])
+    expected = [r for r in store.search(query, top_k=30) if r['doc_name'] in ('doc1', 'doc2')][:4]
+    assert [r['chunk_id'] for r in results] == [r['chunk_id'] for r in expected]
+    assert store.search(query, top_k=4, doc_names=['missing']) == []
+
+def test_concurrent_writes_are_not_lost(tmp_path):
+    rng = np.random.default_rng(4)
+    store = LocalVectorStore(path=str(tmp_path), dimensions=DIMENSIONS)
+    batches = [[make_chunk(f'b{b}:c{i}', rng.standard_normal(DIMENSIONS)) for i in range(200)] for b in range(8)]
+    # Like the loader storing several batches at once with asyncio.to_thread
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(store.add_chunks, batches))
+        list(executor.map(store.delete_chunks, [[f'b{b}:c0'] for b in range(8)]))
+    assert len(store) == 8 * 199
+    assert sorted(os.listdir(tmp_path)) == ['chunks.json', 'vectors.npy']
+    reader = LocalVectorStore(path=str(tmp_path), dimensions=DIMENSIONS)
+    assert {c['chunk_id'] for c in reader.get_all()} == {f'b{b}:c{i}' for b in range(8) for i in range(1, 200)}
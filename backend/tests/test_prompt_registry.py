@@ -0,0 +1,25 @@
+from openai import pydantic_function_tool
+from app.semantic_cache import prompt_hash
+from app.assistants.tools import QueryKnowledgeBaseTool, SaveTemplateTool
+from app.assistants.prompts import MAIN_SYSTEM_PROMPT, RAG_SYSTEM_PROMPT, PROMPT_PREFIX
+from app.assistants.registry import PromptRegistry
+from app.config import Config
+
+def test_schemas_and_messages_are_built_once():
+    registry = PromptRegistry()
+    schemas = registry.tool_schemas(QueryKnowledgeBaseTool, SaveTemplateTool)
+    assert schemas == [pydantic_function_tool(QueryKnowledgeBaseTool), pydantic_function_tool(SaveTemplateTool)]
+    assert registry.tool_schemas(QueryKnowledgeBaseTool, SaveTemplateTool) is schemas
+    assert registry.system_message('main') is registry.system_message('main')
+    assert registry.system_message('rag') == {'role': 'system', 'content': RAG_SYSTEM_PROMPT}
+
+def test_prompt_hash_matches_the_semantic_cache_hash():
+    # Answers cached before the registry existed stay valid
+    registry = PromptRegistry()
+    tools_schema = [pydantic_function_tool(QueryKnowledgeBaseTool)]
+    assert registry.prompt_hash(QueryKnowledgeBaseTool) == prompt_hash(
+        MAIN_SYSTEM_PROMPT, RAG_SYSTEM_PROMPT, Config.MODEL, tools_schema
+    )
+
+def test_system_prompts_share_their_prefix():
+    assert MAIN_SYSTEM_PROMPT.startswith(PROMPT_PREFIX) and RAG_SYSTEM_PROMPT.startswith(PROMPT_PREFIX)
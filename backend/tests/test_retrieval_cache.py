@@ -0,0 +1,60 @@
+import pytest
+from app import db
+from app.db import delete_chunks_from_vector_db
+from app.local_vector_store import LocalVectorStore
+from app.retrieval_cache import RetrievalCache
+from app.config import Config
+from tests.fake_redis import FakeRedis
+
+DIMENSIONS = 4
+
+@pytest.fixture
+def rdb(tmp_path, monkeypatch):
+    rdb = FakeRedis()
+    store = LocalVectorStore(path=str(tmp_path), dimensions=DIMENSIONS)
+    store.add_chunks([
+        {'chunk_id': chunk_id, 'text': chunk_id, 'doc_name': 'doc', 'vector': vector}
+        for chunk_id, vector in [('a', [1, 0, 0, 0]), ('b', [1, 1, 0, 0])]
+    ])
+    monkeypatch.setattr(db, 'local_vector_store', store)
+    monkeypatch.setattr(Config, 'VECTOR_SEARCH_BACKEND', 'local')
+    monkeypatch.setattr(RetrievalCache, 'rdb', property(lambda self: rdb))
+    return rdb
+
+class CountingSearch:
+    def __init__(self, rdb, during=None):
+        self.rdb = rdb
+        self.calls = 0
+        self.during = during
+
+    async def __call__(self):
+        self.calls += 1
+        results = await db.search_vector_db(self.rdb, [1, 0, 0, 0], top_k=2)
+        if self.during is not None:
+            await self.during()
+        return results
+
+@pytest.mark.asyncio
+async def test_cached_results_are_not_served_after_a_delete(rdb):
+    cache = RetrievalCache(enabled=True, maxsize=10, ttl=60)
+    search = CountingSearch(rdb)
+    first = await cache.search('coverage', 2, search)
+    assert [r['chunk_id'] for r in first] == ['a', 'b']
+    assert await cache.search('coverage', 2, search) == first
+    assert search.calls == 1
+
+    await delete_chunks_from_vector_db(rdb, ['a'])
+    after = await cache.search('coverage', 2, search)
+    assert search.calls == 2
+    assert [r['chunk_id'] for r in after] == ['b']
+
+@pytest.mark.asyncio
+async def test_results_searched_during_a_delete_are_not_cached(rdb):
+    cache = RetrievalCache(enabled=True, maxsize=10, ttl=60)
+    search = CountingSearch(rdb, during=lambda: delete_chunks_from_vector_db(rdb, ['a']))
+    stale = await cache.search('coverage', 2, search)
+    assert 'a' in [r['chunk_id'] for r in stale]
+
+    search.during = None
+    assert [r['chunk_id'] for r in await cache.search('coverage', 2, search)] == ['b']
+    assert search.calls == 2
@@ -0,0 +1,168 @@
+import random
+import pytest
+from functools import partial
+from app.utils import token_utils
+from app.utils.token_utils import WhitespaceTokenizer, token_size
+from app.utils import splitter as splitter_module
+from app.utils.splitter import TextSplitter, split_by_separator, split_sentences
+
+@pytest.fixture(autouse=True)
+def whitespace_tokenizer():
+    # Deterministic token counts that don't need a BPE vocab
+    previous = token_utils._tokenizer
+    token_utils.set_tokenizer(WhitespaceTokenizer())
+    yield
+    token_utils.set_tokenizer(previous)
+
+class BaselineSplitter:
+    """The string-based splitter the offsets engine replaced, verbatim: it counts the tokens of
+    each candidate chunk's joined text"""
+    def __init__(self, chunk_size, chunk_overlap=0):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.splitters = [
+            partial(split_by_separator, sep='\n\n'),
+            partial(split_by_separator, sep='\n'),
+            split_sentences,
+            partial(split_by_separator, sep=' ')
+        ]
+
+    def _split_recursive(self, text, level=0):
+        if token_size(text) <= self.chunk_size or level == len(self.splitters):
+            return [text]
+
+        splits = []
+        for s in self.splitters[level](text):
+            if token_size(s) <= self.chunk_size:
+                splits.append(s)
+            else:
+                splits.extend(self._split_recursive(s, level + 1))
+        return splits
+
+    def _merge_splits(self, splits):
+        chunks = []
+        current_chunk = ''
+        current_splits = []
+
+        for split in splits:
+            if current_chunk and (token_size(current_chunk + split) > self.chunk_size):
+                trimmed_chunk = current_chunk.strip()
+                if trimmed_chunk:
+                    chunks.append(trimmed_chunk)
+                # Add overlap to next chunk
+                last_splits = current_splits
+                current_splits = []
+                current_chunk = ''
+                for s in reversed(last_splits):
+                    if (token_size(s + current_chunk) > self.chunk_overlap or
+                        token_size(s + current_chunk + split) > self.chunk_size
+                    ):
+                        break
+                    current_chunk = s + current_chunk
+                    current_splits.insert(0, s)
+
+            current_chunk += split
+            current_splits.append(split)
+
+        trimmed_chunk = current_chunk.strip()
+        if trimmed_chunk:
+            chunks.append(trimmed_chunk)
+        return chunks
+
+    def split(self, text):
+        splits = self._split_recursive(text)
+        chunks = self._merge_splits(splits)
+        return chunks
+
+class SummedSizesSplitter(BaselineSplitter):
+    """The baseline with chunk sizes summed from split sizes, the way TextSplitter counts them"""
+    def _merge_splits(self, splits):
+        chunks, current_splits, current_size = [], [], 0
+        for split in splits:
+            size = token_size(split)
+            if current_splits and current_size + size > self.chunk_size:
+                chunks.append(''.join(s for s, _ in current_splits).strip())
+                last_splits, current_splits, current_size = current_splits, [], 0
+                for s, s_size in reversed(last_splits):
+                    if (current_size + s_size > self.chunk_overlap or
+                        current_size + s_size + size > self.chunk_size
+                    ):
+                        break
+                    current_splits.insert(0, (s, s_size))
+                    current_size += s_size
+            current_splits.append((split, size))
+            current_size += size
+        chunks.append(''.join(s for s, _ in current_splits).strip())
+        return [chunk for chunk in chunks if chunk]
+
+WORDS = ['policy', 'coverage', 'insured', 'the', 'of', 'claim', 'limit', 'Section', 'damage', 'A.B.']
+# Without abbreviations, sentences only break on whitespace, so token sizes add up
+PLAIN_WORDS = WORDS[:-1]
+
+def synthetic_text(rng, paragraphs, words=WORDS):
+    parts = []
+    for _ in range(paragraphs):
+        sentences = []
+        for _ in range(rng.randint(1, 12)):
+            sentence = [rng.choice(words) for _ in range(rng.randint(1, 40))]
+            sentences.append(' '.join(sentence).capitalize() + rng.choice(['.', '?', '', '.  ']))
+        parts.append(rng.choice([' ', '\n', ' \n']).join(sentences))
+        # Occasional very long "words" and whitespace-only runs exercise the deepest levels
+        if rng.random() < 0.1:
+            parts.append('x' * rng.randint(1, 50) + ' ' * rng.randint(0, 5))
+    return ''.join(part + rng.choice(['\n\n', '\n', '\n\n\n', ' ']) for part in parts)
+
+PARAMETERS = [(512, 150), (64, 20), (16, 8), (5, 0), (3, 5)]
+
+@pytest.mark.parametrize('chunk_size,chunk_overlap', PARAMETERS)
+def test_matches_baseline_splitter_when_token_sizes_add_up(chunk_size, chunk_overlap):
+    rng = random.Random(chunk_size)
+    splitter = TextSplitter(chunk_size, chunk_overlap)
+    baseline = BaselineSplitter(chunk_size, chunk_overlap)
+    for paragraphs in [0, 1, 5, 60]:
+        text = synthetic_text(rng, paragraphs, words=PLAIN_WORDS)
+        assert splitter.split(text) == baseline.split(text)
+
+@pytest.mark.parametrize('chunk_size,chunk_overlap', PARAMETERS)
+def test_matches_baseline_merge_on_summed_sizes(chunk_size, chunk_overlap):
+    rng = random.Random(chunk_size)
+    splitter = TextSplitter(chunk_size, chunk_overlap)
+    reference = SummedSizesSplitter(chunk_size, chunk_overlap)
+    for paragraphs in [0, 1, 5, 60]:
+        text = synthetic_text(rng, paragraphs)
+        assert splitter.split(text) == reference.split(text)
+
+def test_known_difference_with_baseline_splitter():
+    # The sentence splitter breaks "a.b.?" into "a.b." and "?": 2 tokens summed, but 1 once joined
+    text = 'The insured section a.b.? \nClaim limit'
+    assert BaselineSplitter(3).split(text) == ['The insured section', 'a.b.? \nClaim limit']
+    assert TextSplitter(3).split(text) == ['The insured section', 'a.b.?', 'Claim limit']
+
+def test_split_spans_are_offsets_of_chunks():
+    text = synthetic_text(random.Random(0), 40)
+    splitter = TextSplitter(32, 10)
+    spans = splitter.split_spans(text)
+    assert [text[start:end] for start, end in spans] == splitter.split(text)
+    assert all(s1 <= s2 for (s1, _), (s2, _) in zip(spans, spans[1:]))
+
+def test_chunks_fit_and_overlap():
+    text = ' '.join(f'Sentence number {i} is here.' for i in range(200))
+    chunks = TextSplitter(20, 10).split(text)
+    assert all(token_size(chunk) <= 20 for chunk in chunks)
+    # Consecutive chunks share their boundary sentences
+    assert all(chunk[-8:] in next_chunk for chunk, next_chunk in zip(chunks, chunks[1:]))
+
+def test_split_many_matches_split_in_order(monkeypatch):
+    monkeypatch.setattr(splitter_module, 'PARALLEL_MIN_CHARS', 0)
+    rng = random.Random(1)
+    texts = [synthetic_text(rng, rng.randint(0, 30)) for _ in range(9)]
+    splitter = TextSplitter(32, 10)
+    assert list(splitter.split_many(iter(texts), workers=2)) == [splitter.split(text) for text in texts]
+
+def test_split_many_splits_small_inputs_in_process(monkeypatch):
+    def no_pool(self, workers):
+        raise AssertionError('small inputs should not start a process pool')
+    monkeypatch.setattr(TextSplitter, 'executor', no_pool)
+    texts = [synthetic_text(random.Random(i), 3) for i in range(3)]
+    splitter = TextSplitter(32, 10)
+    assert list(splitter.split_many(texts, workers=2)) == [splitter.split(text) for text in texts]
@@ -0,0 +1,78 @@
+import asyncio
+import pytest
+from app.utils.sse_stream import SSEStream, StreamClosed
+
+async def produce(stream, deltas, delay=0.0):
+    for delta in deltas:
+        await stream.send(delta)
+        await asyncio.sleep(delay)
+    await stream.close()
+
+async def consume(stream):
+    return [event.data async for event in stream]
+
+@pytest.mark.asyncio
+async def test_deltas_are_coalesced_in_order():
+    stream = SSEStream(flush_interval=0.02, flush_bytes=10 ** 6, max_buffer_bytes=10 ** 6)
+    deltas = [f'token{i} ' for i in range(200)]
+    producer = asyncio.create_task(produce(stream, deltas, delay=0.0005))
+    events = await consume(stream)
+    await producer
+    assert ''.join(events) == ''.join(deltas)
+    assert len(events) < len(deltas) / 5
+
+@pytest.mark.asyncio
+async def test_flushes_when_flush_bytes_are_buffered():
+    stream = SSEStream(flush_interval=10, flush_bytes=8, max_buffer_bytes=100)
+    await stream.send('12345')
+    await stream.send('6789')
+    events = stream.__aiter__()
+    event = await asyncio.wait_for(events.__anext__(), 1)
+    assert event.data == '123456789'
+
+@pytest.mark.asyncio
+async def test_send_waits_while_the_buffer_is_full():
+    stream = SSEStream(flush_interval=0, flush_bytes=1, max_buffer_bytes=4)
+    await stream.send('abcd')
+    blocked = asyncio.create_task(stream.send('efgh'))
+    await asyncio.sleep(0.01)
+    assert not blocked.done()
+    events = stream.__aiter__()
+    assert (await events.__anext__()).data == 'abcd'
+    await asyncio.wait_for(blocked, 1)
+    assert (await events.__anext__()).data == 'efgh'
+
+async def slow_consume(stream):
+    # Stuck writing the first event to a client that doesn't read
+    async for event in stream:
+        await asyncio.sleep(10)
+
+@pytest.mark.asyncio
+async def test_send_raises_once_the_consumer_is_cancelled():
+    stream = SSEStream(flush_interval=0, flush_bytes=1, max_buffer_bytes=4)
+    consumer = asyncio.create_task(consume(stream))
+    await asyncio.sleep(0.01)
+    # Cancelled while waiting for data, like a response task when its client disconnects
+    consumer.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await consumer
+    assert stream.disconnected
+    with pytest.raises(StreamClosed):
+        await stream.send('more')
+
+@pytest.mark.asyncio
+async def test_blocked_send_raises_when_a_stuck_consumer_is_cancelled():
+    stream = SSEStream(flush_interval=0, flush_bytes=1, max_buffer_bytes=4)
+    consumer = asyncio.create_task(slow_consume(stream))
+    await stream.send('abcd')
+    await asyncio.sleep(0.01)
+    await stream.send('efgh')
+    blocked = asyncio.create_task(stream.send('ijkl'))
+    await asyncio.sleep(0.01)
+    assert not blocked.done()
+    consumer.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await consumer
+    # Cancelled outside of the stream, which is closed when its iteration is finalized
+    with pytest.raises(StreamClosed):
+        await asyncio.wait_for(blocked, 1)
@@ -21,15 +21,13 @@ from app.config import Config
 @pytest.fixture(scope="session", autouse=True)
 def override_db_for_testing():
     """Override the database name for testing"""
-    original_db = Template.db
     # Switch to test database
-    Template.db = Template.client[Config.MONGODB_TEST_DB_NAME]
-    Template.collection = Template.db.templates
+    Template.connect(db_name=Config.MONGODB_TEST_DB_NAME)
     
     yield
     
     # Restore original database
-    Template.db = original_db
+    Template.connect()
 
 # Sample test data
 sample_template_chunks = [
@@ -455,4 +453,24 @@ async def test_update_template_content_preserve_metadata(template_db):
     assert len(chunks) == 1
     assert chunks[0].template_name == "Test Template"
     assert chunks[0].linked_prompt_id == "test-prompt"
-    assert chunks[0].template_content == "Updated content" 
\ No newline at end of file
+    assert chunks[0].template_content == "Updated content"
+
+
+@pytest.mark.asyncio
+async def test_update_template_content_keeps_unchanged_chunk_ids(sample_template):
+    """Test that unchanged sections keep their chunk IDs and only changed chunks are rewritten"""
+    chunks = await Template.get_chunks(sample_template)
+    sections = [chunk.template_content for chunk in chunks]
+    # Edit the second section, move the last one up front after the main one and drop the third
+    new_sections = [sections[0], sections[-1], "Edited producer section", *sections[3:-1]]
+
+    update_data = TemplateContentUpdate(content="\n\n---\n\n".join(new_sections))
+    await Template.update_content(sample_template, update_data)
+
+    updated_chunks = await Template.get_chunks(sample_template)
+    assert [chunk.template_content for chunk in updated_chunks] == new_sections
+    assert [chunk.template_chunk_order for chunk in updated_chunks] == list(range(len(new_sections)))
+    assert updated_chunks[0].template_chunk_id == chunks[0].template_chunk_id
+    assert updated_chunks[1].template_chunk_id == chunks[-1].template_chunk_id
+    assert [c.template_chunk_id for c in updated_chunks[3:]] == [c.template_chunk_id for c in chunks[3:-1]]
+    assert updated_chunks[0].template_name == "Commercial Certificate of Insurance"
@@ -0,0 +1,99 @@
+import asyncio
+import pytest
+from time import perf_counter
+from types import SimpleNamespace
+from redis.exceptions import ResponseError
+from app.db import MANIFEST_KEY
+from app.assistants.tools import run_tool_calls, resolve_doc_names, filtered_search
+from tests.fake_redis import FakeRedis
+
+class SleepTool:
+    running = 0
+    max_running = 0
+
+    def __init__(self, delay, result, fail=False):
+        self.delay = delay
+        self.result = result
+        self.fail = fail
+
+    async def __call__(self, rdb):
+        SleepTool.running += 1
+        SleepTool.max_running = max(SleepTool.max_running, SleepTool.running)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            SleepTool.running -= 1
+        if self.fail:
+            raise RuntimeError('boom')
+        return self.result
+
+def tool_call(call_id, tool):
+    return SimpleNamespace(id=call_id, function=SimpleNamespace(name='SleepTool', parsed_arguments=tool))
+
+@pytest.fixture(autouse=True)
+def reset_counters():
+    SleepTool.running = SleepTool.max_running = 0
+
+@pytest.mark.asyncio
+async def test_tool_calls_run_concurrently_in_order():
+    calls = [tool_call(f'call_{i}', SleepTool(delay, f'result {i}')) for i, delay in enumerate([0.05, 0.01, 0.03])]
+    start = perf_counter()
+    messages = await run_tool_calls(calls, rdb=None)
+    assert perf_counter() - start < 0.08
+    assert messages == [
+        {'role': 'tool', 'tool_call_id': f'call_{i}', 'content': f'result {i}'} for i in range(3)
+    ]
+    assert messages.all_ok
+
+@pytest.mark.asyncio
+async def test_concurrency_cap():
+    calls = [tool_call(f'call_{i}', SleepTool(0.01, 'ok')) for i in range(6)]
+    await run_tool_calls(calls, rdb=None, concurrency=2)
+    assert SleepTool.max_running == 2
+
+@pytest.mark.asyncio
+async def test_timeouts_and_errors_still_answer_every_call():
+    calls = [
+        tool_call('slow', SleepTool(1, 'late')),
+        tool_call('broken', SleepTool(0, None, fail=True)),
+        tool_call('fast', SleepTool(0, 'ok')),
+    ]
+    messages = await run_tool_calls(calls, rdb=None, timeout=0.05)
+    assert [m['tool_call_id'] for m in messages] == ['slow', 'broken', 'fast']
+    assert 'timed out' in messages[0]['content']
+    assert 'failed: boom' in messages[1]['content']
+    assert messages[2]['content'] == 'ok'
+    assert messages.statuses == ['timeout', 'error', 'ok'] and not messages.all_ok
+
+@pytest.mark.asyncio
+async def test_knowledge_base_chunks_are_formatted_and_kept():
+    chunks = [{'chunk_id': 'a', 'doc_name': 'policy.pdf', 'page': 3, 'text': 'Coverage A'}]
+    [message] = await run_tool_calls([tool_call('call_0', SleepTool(0, chunks))], rdb=None)
+    assert message['chunks'] == chunks
+    assert message['content'] == 'SOURCE: policy.pdf, page 3\n"""\nCoverage A\n"""\n\n---'
+
+@pytest.mark.asyncio
+async def test_doc_names_are_matched_against_the_manifest():
+    rdb = FakeRedis()
+    for doc_name in ['SampleISO-CGL', 'Umbrella Policy']:
+        await rdb.hset(MANIFEST_KEY, doc_name, '{}')
+    assert await resolve_doc_names(rdb, ['sampleiso-cgl.pdf', 'Made up', 'umbrella policy']) == [
+        'SampleISO-CGL', 'Umbrella Policy'
+    ]
+    assert await resolve_doc_names(rdb, ['Made up']) is None
+    assert await resolve_doc_names(rdb, None) is None
+
+@pytest.mark.asyncio
+async def test_filtered_search_falls_back_to_every_document():
+    searched = []
+
+    async def search(doc_names):
+        searched.append(doc_names)
+        if doc_names == ['old index']:
+            raise ResponseError('Unknown field at offset 1 near doc_tag')
+        return [] if doc_names else ['chunk']
+
+    assert await filtered_search(search, ['empty'], fallback_on_empty=True) == ['chunk']
+    assert await filtered_search(search, ['empty'], fallback_on_empty=False) == []
+    assert await filtered_search(search, ['old index'], fallback_on_empty=False) == ['chunk']
+    assert searched == [['empty'], None, ['empty'], ['old index'], None]
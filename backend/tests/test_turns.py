@@ -0,0 +1,69 @@
+import asyncio
+import pytest
+from app.turns import TurnRegistry, TurnLimitExceeded, ShuttingDown
+from app.utils.sse_stream import SSEStream
+
+async def wait_forever(started=None):
+    if started is not None:
+        started.set()
+    await asyncio.Event().wait()
+
+@pytest.mark.asyncio
+async def test_turns_beyond_active_and_queued_are_rejected():
+    registry = TurnRegistry(max_active=2, max_queued=1)
+    tasks = [registry.start(wait_forever, SSEStream()) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    assert registry.stats()['active'] == 2
+    assert registry.stats()['queued'] == 1
+    with pytest.raises(TurnLimitExceeded):
+        registry.start(wait_forever, SSEStream())
+    assert registry.stats()['rejected'] == 1
+
+    # A finished turn frees its slot for the queued one and makes room for a new turn
+    tasks[0].cancel()
+    await asyncio.sleep(0.01)
+    assert registry.stats()['active'] == 2
+    tasks.append(registry.start(wait_forever, SSEStream()))
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    assert registry.stats()['cancelled'] == 4
+    assert not registry.tasks
+
+@pytest.mark.asyncio
+async def test_turn_is_cancelled_when_the_client_disconnects():
+    registry = TurnRegistry(max_active=1, max_queued=1)
+    stream = SSEStream()
+    started = asyncio.Event()
+    task = registry.start(lambda: wait_forever(started), stream)
+    await started.wait()
+
+    async def consume():
+        async for _ in stream:
+            pass
+    consumer = asyncio.create_task(consume())
+    await asyncio.sleep(0.01)
+    # The response task is cancelled when the client goes away
+    consumer.cancel()
+    await asyncio.gather(consumer, return_exceptions=True)
+    await asyncio.wait([task], timeout=1)
+    assert task.cancelled()
+    assert registry.stats() == {'active': 0, 'queued': 0, 'completed': 0, 'cancelled': 1,
+                                'rejected': 0, 'draining': False}
+
+@pytest.mark.asyncio
+async def test_drain_waits_for_running_turns_and_cancels_the_rest():
+    registry = TurnRegistry(max_active=2, max_queued=0)
+    finished = []
+
+    async def short_turn():
+        await asyncio.sleep(0.01)
+        finished.append(True)
+
+    short = registry.start(short_turn, SSEStream())
+    stuck = registry.start(wait_forever, SSEStream())
+    await registry.drain(timeout=0.1)
+    assert finished and short.done() and not short.cancelled()
+    assert stuck.cancelled()
+    with pytest.raises(ShuttingDown):
+        registry.start(short_turn, SSEStream())